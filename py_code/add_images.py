@@ -0,0 +1,123 @@
+import os
+import shutil
+import pycolmap
+import colmap_db
+from matching import match_image_pairs
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp")
+
+
+def list_image_names(image_dir):
+    """Image names relative to image_dir, as COLMAP stores them in the database"""
+    names = []
+    for root, dirs, files in os.walk(image_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                names.append(os.path.relpath(os.path.join(root, name), image_dir).replace(os.sep, "/"))
+    return names
+
+
+def find_new_images(database_path, image_dir):
+    """Split the images of image_dir into (existing, new) relative to the database"""
+    connection = colmap_db.connect(database_path)
+    known = colmap_db.read_images(connection)
+    connection.close()
+
+    names = list_image_names(image_dir)
+    existing = [name for name in names if name in known]
+    new = [name for name in names if name not in known]
+    return existing, new
+
+
+def new_image_pairs(existing, new):
+    """New-to-existing and new-to-new pairs, existing images first so their descriptors load once"""
+    pairs = [(name1, name2) for name1 in existing for name2 in new]
+    pairs += [(new[i], new[j]) for i in range(len(new)) for j in range(i + 1, len(new))]
+    return pairs
+
+
+def add_images(pipeline):
+    """Register images added to the image directory into the saved sparse model"""
+    log = pipeline.log
+    if not os.path.exists(pipeline.database_path) or not os.path.isdir(os.path.join(pipeline.sparse_dir, "0")):
+        log("No existing reconstruction found, run a full reconstruction first.")
+        return False
+
+    existing, new = find_new_images(pipeline.database_path, pipeline.image_dir)
+    if not new:
+        log("No new images to add.")
+        return True
+    log(f"Adding {len(new)} new images to a reconstruction of {len(existing)} images")
+
+    # Step 1: Feature extraction for the new images only, prepared and masked like the others
+    if pipeline.options["prepare_images"] and not pipeline.prepare_images(new):
+        return False
+    if pipeline.options["mask_images"] and not pipeline.mask_images(new):
+        return False
+    pycolmap.extract_features(
+        database_path=pipeline.database_path,
+        image_path=pipeline.reader_image_dir(),
+        image_list=new,
+        sift_options=pipeline.sift_extraction_options(),
+        image_reader_options=pipeline.image_reader_options()
+    )
+    if pipeline.options["prepare_images"]:
+        pipeline.write_focal_lengths(new)
+
+    if pipeline.is_cancelled():
+        log("Reconstruction cancelled")
+        return False
+
+    # Step 2: Match new-to-existing and new-to-new pairs only
+    if not match_image_pairs(
+        pipeline.database_path,
+        new_image_pairs(existing, new),
+        pipeline.output_dir,
+        options={"min_num_matches": pipeline.options["min_num_matches"]},
+        log=log,
+        is_cancelled=pipeline.is_cancelled
+    ):
+        log("Reconstruction cancelled")
+        return False
+
+    # Step 3: Redo the match graph analysis so the new images can be kept
+    if pipeline.options["prune_images"] and not pipeline.prune_match_graph():
+        return False
+
+    # Step 4: Continue the saved model instead of starting an empty one
+    input_path = os.path.join(pipeline.sparse_dir, "0")
+    update_dir = os.path.join(pipeline.output_dir, "sparse_update")
+    shutil.rmtree(update_dir, ignore_errors=True)
+    os.makedirs(update_dir)
+
+    reconstruction_manager = pycolmap.ReconstructionManager()
+    pycolmap.incremental_mapping(
+        database_path=pipeline.database_path,
+        image_path=pipeline.reader_image_dir(),
+        output_path=update_dir,
+        input_path=input_path,
+        reconstruction_manager=reconstruction_manager,
+        mapper_options=pipeline.mapper_options()
+    )
+
+    if reconstruction_manager.size() == 0:
+        log("Registration of the new images failed, the saved model is unchanged.")
+        return False
+
+    # Swap the updated model in place of the saved one
+    shutil.rmtree(input_path)
+    shutil.move(os.path.join(update_dir, "0"), input_path)
+    shutil.rmtree(update_dir, ignore_errors=True)
+
+    reconstruction = pipeline.load_reconstruction()
+    log(f"Model now has {reconstruction.num_reg_images()} registered images "
+        f"and {reconstruction.num_points3D()} 3D points")
+
+    # The stages after mapping no longer match the sparse model, the ones before it stay valid
+    pipeline.manifest = pipeline.load_manifest()
+    stages = pipeline.stages()
+    for stage in stages[stages.index("incremental_mapping") + 1:]:
+        pipeline.manifest["stages"].pop(stage, None)
+    pipeline.save_manifest()
+    return True
@@ -0,0 +1,30 @@
+import numpy as np
+
+
+def umeyama(source, target):
+    """Similarity (scale, rotation, translation) best mapping source points onto target points"""
+    source_mean = source.mean(axis=0)
+    target_mean = target.mean(axis=0)
+    source_centered = source - source_mean
+    target_centered = target - target_mean
+
+    covariance = target_centered.T @ source_centered / len(source)
+    u, singular_values, vt = np.linalg.svd(covariance)
+    sign = np.eye(3)
+    if np.linalg.det(u) * np.linalg.det(vt) < 0:
+        sign[2, 2] = -1
+    rotation = u @ sign @ vt
+    source_variance = (source_centered ** 2).sum() / len(source)
+    scale = np.trace(np.diag(singular_values) @ sign) / max(source_variance, 1e-12)
+    translation = target_mean - scale * rotation @ source_mean
+    return scale, rotation, translation
+
+
+def robust_umeyama(source, target, min_inliers=3):
+    """Umeyama refitted on the points within three median residuals, if at least min_inliers remain"""
+    scale, rotation, translation = umeyama(source, target)
+    residuals = np.linalg.norm(target - (scale * source @ rotation.T + translation), axis=1)
+    inliers = residuals <= max(3 * np.median(residuals), 1e-9)
+    if min_inliers <= inliers.sum() < len(source):
+        scale, rotation, translation = umeyama(source[inliers], target[inliers])
+    return scale, rotation, translation
@@ -0,0 +1,182 @@
+import os
+import csv
+import json
+import time
+import shutil
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pipeline import ReconstructionPipeline, DEFAULT_OPTIONS, STAGES
+from metrics import peak_rss_mb
+
+RESULT_FIELDS = [
+    "config_id",
+    "success",
+    "total_time",
+    "peak_rss_mb",
+    "num_images",
+    "num_reg_images",
+    "num_points3D",
+    "mean_reprojection_error",
+    "mean_track_length",
+    "accuracy",
+    "completeness",
+    "chamfer_distance",
+]
+
+
+def sparse_metrics(pipeline):
+    """Quality metrics of the sparse model written by a pipeline run"""
+    if not os.path.isdir(os.path.join(pipeline.sparse_dir, "0")):
+        return {}
+    reconstruction = pipeline.load_reconstruction()
+    return {
+        "num_images": reconstruction.num_images(),
+        "num_reg_images": reconstruction.num_reg_images(),
+        "num_points3D": reconstruction.num_points3D(),
+        "mean_reprojection_error": reconstruction.compute_mean_reprojection_error(),
+        "mean_track_length": reconstruction.compute_mean_track_length(),
+    }
+
+
+def quality_metrics(pipeline):
+    """Flat scores of the model against the reference, when the run was evaluated"""
+    quality = pipeline.metrics.quality if pipeline.metrics else None
+    if not quality:
+        return {}
+    result = {
+        "accuracy": quality["accuracy"]["mean"],
+        "completeness": quality["completeness"]["mean"],
+        "chamfer_distance": quality["chamfer_distance"],
+    }
+    for score in quality["thresholds"]:
+        result[f"f_score_{score['threshold']:.4g}"] = score["f_score"]
+    return result
+
+
+def run_configuration(image_dir, output_dir, options, config_id=None):
+    """Run the pipeline once and return its timings and quality metrics"""
+    log_path = os.path.join(output_dir, "benchmark.log")
+    os.makedirs(output_dir, exist_ok=True)
+
+    with open(log_path, "w") as log_file:
+        def log(message):
+            log_file.write(message + "\n")
+            log_file.flush()
+
+        pipeline = ReconstructionPipeline(image_dir, output_dir, options, log=log)
+        start = time.time()
+        try:
+            success = pipeline.run()
+        except Exception as e:
+            log(f"Error: {str(e)}")
+            success = False
+        total_time = time.time() - start
+
+    result = {
+        "config_id": config_id,
+        "success": success,
+        "total_time": total_time,
+        # Stage records hold the per-stage peaks, which are reset between stages on Linux
+        "peak_rss_mb": max(filter(None, [peak_rss_mb(), pipeline.metrics.summary()["peak_rss_mb"]
+                                         if pipeline.metrics else None]), default=None),
+    }
+    for stage in STAGES:
+        record = pipeline.metrics.stage_record(stage) if pipeline.metrics else None
+        result[f"time_{stage}"] = record["wall_time"] if record else None
+        result[f"throughput_{stage}"] = record.get("throughput") if record else None
+    try:
+        result.update(sparse_metrics(pipeline))
+    except Exception as e:
+        result["metrics_error"] = str(e)
+    result.update(quality_metrics(pipeline))
+    result["options"] = dict(options)
+    return result
+
+
+def clear_workspace(workspace):
+    """Drop the heavy outputs of a run, keeping its log and manifest"""
+    for name in ("database.db", "sparse", "dense"):
+        path = os.path.join(workspace, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def expand_grid(grid):
+    """Cartesian product of a {option: [values]} grid as a list of option dicts"""
+    for key in grid:
+        if key not in DEFAULT_OPTIONS:
+            raise ValueError(f"Unknown option in grid: {key}")
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def write_results(results, output_dir):
+    """Write benchmark results as JSON and CSV"""
+    with open(os.path.join(output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+    option_keys = sorted({key for result in results for key in result["options"]})
+    stage_fields = [f"time_{stage}" for stage in STAGES] + [f"throughput_{stage}" for stage in STAGES]
+    # Thresholds default to fractions of each reference, so the columns follow the results
+    score_fields = sorted({key for result in results for key in result if key.startswith("f_score_")})
+    fields = RESULT_FIELDS + score_fields + stage_fields + option_keys
+
+    with open(os.path.join(output_dir, "results.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        for result in results:
+            row = dict(result)
+            row.update(result["options"])
+            writer.writerow(row)
+
+
+def run_benchmark(image_dir, output_dir, grid, base_options=None, keep_workspaces=False, log=print):
+    """Run every configuration of a grid on the same dataset, each in a fresh process"""
+    os.makedirs(output_dir, exist_ok=True)
+    configurations = expand_grid(grid)
+    log(f"Benchmarking {len(configurations)} configurations")
+
+    results = []
+    # A fresh process per configuration keeps peak memory measurements independent
+    context = multiprocessing.get_context("spawn")
+    for config_id, overrides in enumerate(configurations):
+        options = dict(base_options or {})
+        options.update(overrides)
+        workspace = os.path.join(output_dir, f"config_{config_id:03d}")
+        shutil.rmtree(workspace, ignore_errors=True)
+
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_configuration, image_dir, workspace, options, config_id).result()
+        results.append(result)
+        log(f"Configuration {config_id}: {overrides} -> "
+            f"{result.get('num_reg_images')} images, {result.get('num_points3D')} points "
+            f"in {result['total_time']:.1f} s")
+
+        if not keep_workspaces:
+            clear_workspace(workspace)
+
+        # Results are rewritten after each configuration so a long sweep can be inspected early
+        write_results(results, output_dir)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark COLMAP settings on a fixed dataset")
+    parser.add_argument("image_dir", help="Directory containing the benchmark images")
+    parser.add_argument("output_dir", help="Directory receiving the workspaces and results")
+    parser.add_argument("grid", help='JSON file {"base": {option: value}, "grid": {option: [values]}}')
+    parser.add_argument("--keep-workspaces", action="store_true", help="Keep databases and models of every run")
+    args = parser.parse_args()
+
+    with open(args.grid, "r") as f:
+        spec = json.load(f)
+
+    run_benchmark(args.image_dir, args.output_dir, spec.get("grid", {}), spec.get("base"), args.keep_workspaces)
+
+if __name__ == "__main__":
+    main()
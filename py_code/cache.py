@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where only one process at a time should then use a cache directory
+    fcntl = None
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "colmap_reconstruction")
+DEFAULT_CACHE_SIZE = 20 * 1024 ** 3
+
+INDEX_NAME = "index.json"
+
+# Held exclusively to read, merge and write the index, by every process sharing the cache directory
+INDEX_LOCK_NAME = "index.lock"
+# Held shared while copying out of entries, exclusively to replace or remove them
+ENTRIES_LOCK_NAME = "entries.lock"
+
+
+def path_size(path):
+    """Total size in bytes of a file or directory tree"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def copy_path(source, destination):
+    """Copy a file, or merge a directory tree into the destination"""
+    parent = os.path.dirname(destination)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    if os.path.isdir(source):
+        shutil.copytree(source, destination, dirs_exist_ok=True)
+    else:
+        shutil.copy2(source, destination)
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """Hold an advisory lock on a file, shared between readers or exclusive"""
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def remove_path(path):
+    """Remove a file or directory tree if it exists"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+# Options that change how fast a stage runs but not what it produces, and workspace paths whose
+# contents are already keyed by the stage that wrote them
+IGNORED_OPTION_KEYS = {"num_threads", "mask_path"}
+
+
+def options_fingerprint(value):
+    """JSON-serializable form of plain values and pycolmap option objects"""
+    if hasattr(value, "todict"):
+        return options_fingerprint(value.todict())
+    if isinstance(value, dict):
+        return {str(key): options_fingerprint(item) for key, item in value.items()
+                if key not in IGNORED_OPTION_KEYS}
+    if isinstance(value, (list, tuple)):
+        return [options_fingerprint(item) for item in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+class StageCache:
+    """Content-addressed cache of stage outputs with a size cap and LRU eviction"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.index_path = os.path.join(cache_dir, INDEX_NAME)
+        self.index_lock_path = os.path.join(cache_dir, INDEX_LOCK_NAME)
+        self.entries_lock_path = os.path.join(cache_dir, ENTRIES_LOCK_NAME)
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        with file_lock(self.index_lock_path):
+            self.index = self.load_index()
+        # Changes of this process not merged into the index on disk yet, see sync_index
+        self.dirty = False
+        self.added = {}
+        self.used = {}
+
+    def load_index(self):
+        """Load the cache index, dropping entries whose data has disappeared"""
+        index = {"entries": {}, "digests": {}}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r") as f:
+                    index.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+        index["entries"] = {
+            key: entry for key, entry in index["entries"].items()
+            if os.path.isdir(self.entry_dir(key))
+        }
+        index["digests"] = {
+            path: memo for path, memo in index["digests"].items()
+            if isinstance(memo, dict) and self.memo_is_current(path, memo)
+        }
+        return index
+
+    def memo_is_current(self, path, memo):
+        """Whether a memoized digest still describes the file at path"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return memo.get("size") == stat.st_size and memo.get("mtime_ns") == stat.st_mtime_ns
+
+    def write_index(self, index):
+        """Atomically write the cache index, with the index lock held"""
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def sync_index(self, evict=False, keep=()):
+        """Merge the changes of this process into the index on disk, which other processes update too"""
+        with self.lock:
+            with file_lock(self.index_lock_path):
+                changed = self.dirty or self.added or self.used
+                index = self.load_index()
+                # Entries missing on disk and not added here were evicted by another process
+                index["entries"].update(self.added)
+                for key, last_used in self.used.items():
+                    if key in index["entries"]:
+                        index["entries"][key]["last_used"] = max(index["entries"][key]["last_used"], last_used)
+                index["digests"].update((path, memo) for path, memo in self.index["digests"].items()
+                                        if self.memo_is_current(path, memo))
+                evicted = self.evict(index, keep) if evict else []
+                if changed or evicted:
+                    self.write_index(index)
+            self.index = index
+            self.added = {}
+            self.used = {}
+            self.dirty = False
+
+        if evicted:
+            # Removed once no process copies out of them, unless stored again in between
+            with file_lock(self.entries_lock_path):
+                with file_lock(self.index_lock_path):
+                    stored_again = set(self.load_index()["entries"])
+                for key in evicted:
+                    if key not in stored_again:
+                        remove_path(self.entry_dir(key))
+
+    def flush_index(self):
+        """Write the cache index if it changed since it was last written"""
+        if self.dirty:
+            self.sync_index()
+
+    def entry_dir(self, key):
+        """Directory holding the outputs stored under a key"""
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def file_digest(self, path):
+        """SHA-256 of a file, memoized on its path, size and modification time"""
+        path = os.path.abspath(path)
+        memo = self.index["digests"].get(path)
+        if memo is not None and self.memo_is_current(path, memo):
+            return memo["digest"]
+        stat = os.stat(path)
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(block)
+        # A changed file replaces the memo of its previous contents
+        self.index["digests"][path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": sha.hexdigest()}
+        self.dirty = True
+        return sha.hexdigest()
+
+    def input_digest(self, path):
+        """Digest of an input file or of every file below an input directory"""
+        if not path or not os.path.exists(path):
+            return None
+        if os.path.isfile(path):
+            return self.file_digest(path)
+        sha = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                sha.update(os.path.relpath(file_path, path).encode())
+                sha.update(self.file_digest(file_path).encode())
+        return sha.hexdigest()
+
+    def stage_key(self, stage, upstream_key, options, inputs=()):
+        """Key of a stage output from its upstream key, options and input files, see flush_index"""
+        with self.lock:
+            payload = {
+                "stage": stage,
+                "upstream": upstream_key,
+                "options": options_fingerprint(options),
+                "inputs": [self.input_digest(path) for path in inputs],
+            }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def item_keys(self, kind, options, paths):
+        """Keys of outputs each derived from one input file, such as the prepared version of an image"""
+        with self.lock:
+            keys = []
+            for path in paths:
+                payload = {"item": kind, "options": options_fingerprint(options), "input": self.file_digest(path)}
+                keys.append(hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest())
+        self.flush_index()
+        return keys
+
+    def contains(self, key):
+        """Whether outputs are stored under a key"""
+        with self.lock:
+            return key in self.index["entries"]
+
+    def restore(self, key, outputs):
+        """Copy stored outputs back to their destinations, return False on a miss"""
+        return bool(self.restore_items([(key, outputs)]))
+
+    def restore_items(self, items):
+        """Restore several (key, outputs) entries at once, returning the keys found"""
+        # Entries stored by other processes since the last merge are found too
+        self.sync_index()
+        found = set()
+        with file_lock(self.entries_lock_path, shared=True):
+            for key, outputs in items:
+                entry_dir = self.entry_dir(key)
+                if not self.contains(key) or not os.path.isdir(entry_dir):
+                    continue
+                for name, destination in outputs.items():
+                    source = os.path.join(entry_dir, name)
+                    if os.path.exists(source):
+                        copy_path(source, destination)
+                    else:
+                        remove_path(destination)
+                found.add(key)
+        if found:
+            with self.lock:
+                self.used.update((key, time.time()) for key in found)
+            self.sync_index()
+        return found
+
+    def store(self, key, outputs):
+        """Copy stage outputs into the cache and evict old entries above the size cap"""
+        self.store_items([(key, outputs)])
+
+    def store_items(self, items):
+        """Store several (key, outputs) entries at once, then evict old entries above the size cap"""
+        stored = {}
+        for key, outputs in items:
+            # Copied without any lock held, other jobs keep using the cache meanwhile
+            entry_dir = self.entry_dir(key)
+            tmp_dir = f"{entry_dir}.{uuid.uuid4().hex}.tmp"
+            os.makedirs(tmp_dir)
+            for name, source in outputs.items():
+                if os.path.exists(source):
+                    copy_path(source, os.path.join(tmp_dir, name))
+            size = path_size(tmp_dir)
+            with file_lock(self.entries_lock_path):
+                remove_path(entry_dir)
+                os.replace(tmp_dir, entry_dir)
+            stored[key] = {"size": size, "last_used": time.time()}
+        with self.lock:
+            self.added.update(stored)
+        self.sync_index(evict=True, keep=set(stored))
+
+    def evict(self, index, keep=()):
+        """Drop least recently used entries of an index until the cache fits its size cap, returns their keys"""
+        by_age = sorted(index["entries"].items(), key=lambda item: item[1]["last_used"])
+        total = sum(entry["size"] for entry in index["entries"].values())
+        evicted = []
+        for key, entry in by_age:
+            if total <= self.max_size:
+                break
+            if key in keep:
+                continue
+            del index["entries"][key]
+            evicted.append(key)
+            total -= entry["size"]
+        return evicted
+
+    def clear(self):
+        """Remove every stored output"""
+        # Locks are always taken in the order entries, self.lock, index
+        with file_lock(self.entries_lock_path):
+            with self.lock:
+                with file_lock(self.index_lock_path):
+                    keys = set(self.load_index()["entries"]) | set(self.index["entries"]) | set(self.added)
+                    for key in keys:
+                        remove_path(self.entry_dir(key))
+                    self.index = {"entries": {}, "digests": {}}
+                    self.added = {}
+                    self.used = {}
+                    self.write_index(self.index)
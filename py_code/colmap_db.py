@@ -0,0 +1,107 @@
+import sqlite3
+import numpy as np
+
+# COLMAP encodes an image pair as image_id1 * MAX_IMAGE_ID + image_id2 with image_id1 < image_id2
+MAX_IMAGE_ID = 2 ** 31 - 1
+
+# Camera models whose parameters start with a single focal length, the others start with fx, fy
+SINGLE_FOCAL_CAMERA_MODELS = {0, 2, 3, 8, 9}
+
+
+def connect(database_path):
+    """Open a COLMAP database"""
+    return sqlite3.connect(database_path)
+
+
+def image_ids_to_pair_id(image_id1, image_id2):
+    """Pair id of two images, works element-wise on NumPy arrays"""
+    image_id1 = np.asarray(image_id1, dtype=np.int64)
+    image_id2 = np.asarray(image_id2, dtype=np.int64)
+    return np.minimum(image_id1, image_id2) * MAX_IMAGE_ID + np.maximum(image_id1, image_id2)
+
+
+def pair_id_to_image_ids(pair_id):
+    """Image ids of a pair id, works element-wise on NumPy arrays"""
+    pair_id = np.asarray(pair_id, dtype=np.int64)
+    return pair_id // MAX_IMAGE_ID, pair_id % MAX_IMAGE_ID
+
+
+def read_images(connection):
+    """Map image names to image ids"""
+    return {name: image_id for image_id, name in connection.execute("SELECT image_id, name FROM images")}
+
+
+def read_image_cameras(connection):
+    """Map image names to camera ids"""
+    return {name: camera_id for name, camera_id in connection.execute("SELECT name, camera_id FROM images")}
+
+
+def write_focal_length(connection, camera_id, focal_length):
+    """Set the focal length of a camera, trusted as a prior like one read by COLMAP from EXIF"""
+    model, params = connection.execute("SELECT model, params FROM cameras WHERE camera_id = ?", (camera_id,)).fetchone()
+    params = np.frombuffer(params, dtype=np.float64).copy()
+    params[:1 if model in SINGLE_FOCAL_CAMERA_MODELS else 2] = focal_length
+    connection.execute("UPDATE cameras SET params = ?, prior_focal_length = 1 WHERE camera_id = ?",
+                       (params.tobytes(), camera_id))
+
+
+def read_cameras(connection):
+    """Map camera ids to their (model id, width, height, params)"""
+    cameras = {}
+    for camera_id, model, width, height, params in connection.execute(
+            "SELECT camera_id, model, width, height, params FROM cameras"):
+        cameras[camera_id] = (model, width, height, np.frombuffer(params, dtype=np.float64).copy())
+    return cameras
+
+
+def read_keypoints(connection, image_id):
+    """Keypoint positions of an image as a (N, 2) float32 array"""
+    row = connection.execute("SELECT rows, cols, data FROM keypoints WHERE image_id = ?", (image_id,)).fetchone()
+    if row is None or row[0] == 0:
+        return np.zeros((0, 2), dtype=np.float32)
+    rows, cols, data = row
+    return np.frombuffer(data, dtype=np.float32).reshape(rows, cols)[:, :2]
+
+
+def read_keypoint_counts(connection):
+    """Map image ids to their number of keypoints"""
+    return {image_id: rows for image_id, rows in connection.execute("SELECT image_id, rows FROM keypoints")}
+
+
+def read_descriptors(connection, image_id):
+    """SIFT descriptors of an image as a (N, 128) uint8 array"""
+    row = connection.execute(
+        "SELECT rows, cols, data FROM descriptors WHERE image_id = ?", (image_id,)
+    ).fetchone()
+    if row is None or row[0] == 0:
+        return np.zeros((0, 128), dtype=np.uint8)
+    rows, cols, data = row
+    return np.frombuffer(data, dtype=np.uint8).reshape(rows, cols)
+
+
+def read_matched_pair_ids(connection):
+    """Pair ids that already have raw matches"""
+    return {pair_id for (pair_id,) in connection.execute("SELECT pair_id FROM matches")}
+
+
+def write_matches(connection, image_id1, image_id2, matches):
+    """Store raw matches between two images, given as a (N, 2) array of keypoint indices"""
+    matches = np.asarray(matches, dtype=np.uint32).reshape(-1, 2)
+    if image_id1 > image_id2:
+        matches = matches[:, ::-1]
+    pair_id = int(image_ids_to_pair_id(image_id1, image_id2))
+    connection.execute(
+        "INSERT OR REPLACE INTO matches (pair_id, rows, cols, data) VALUES (?, ?, ?, ?)",
+        (pair_id, matches.shape[0], 2, np.ascontiguousarray(matches).tobytes())
+    )
+
+
+def read_two_view_geometry_arrays(connection):
+    """Verified pairs as NumPy arrays (image_id1, image_id2, num_inliers, config)"""
+    rows = connection.execute("SELECT pair_id, rows, config FROM two_view_geometries WHERE rows > 0").fetchall()
+    if not rows:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty
+    table = np.array(rows, dtype=np.int64)
+    image_id1, image_id2 = pair_id_to_image_ids(table[:, 0])
+    return image_id1, image_id2, table[:, 1], table[:, 2]
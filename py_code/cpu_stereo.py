@@ -0,0 +1,269 @@
+import os
+import numpy as np
+import cv2
+import pycolmap
+from collections import Counter
+from stage_runner import run_in_pool
+
+# 1 - NCC above which a depth estimate is discarded
+MAX_MATCHING_COST = 0.5
+
+# Intensity variance of a window below which it is too uniform to match
+MIN_WINDOW_VARIANCE = 1e-4
+
+# Cost of a window falling outside a source image
+MISSING_COST = 2.0
+
+# Relative margin added around the depth range of the sparse points
+DEPTH_MARGIN = 0.2
+
+# Sources seeing the reference from a smaller angle give no depth information
+MIN_TRIANGULATION_ANGLE = np.deg2rad(2.0)
+
+
+def write_array(path, array):
+    """Write a depth or normal map in the COLMAP binary format"""
+    if array.ndim == 2:
+        array = array[:, :, None]
+    height, width, channels = array.shape
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(f"{width}&{height}&{channels}&".encode())
+        # Column-major over (width, height, channels), as read back by COLMAP
+        np.transpose(array, (1, 0, 2)).astype(np.float32).reshape(-1, order="F").tofile(f)
+    os.replace(tmp_path, path)
+
+
+def read_array(path):
+    """Read a depth or normal map written in the COLMAP binary format"""
+    with open(path, "rb") as f:
+        header = b""
+        while header.count(b"&") < 3:
+            header += f.read(1)
+        width, height, channels = (int(value) for value in header.split(b"&")[:3])
+        array = np.fromfile(f, np.float32)
+    array = array.reshape((width, height, channels), order="F")
+    return np.transpose(array, (1, 0, 2)).squeeze()
+
+
+def select_views(reconstruction, num_sources):
+    """Most co-visible sources and sparse depth range of each registered image"""
+    views = {}
+    for image_id in reconstruction.reg_image_ids():
+        image = reconstruction.images[image_id]
+        point_ids = [point.point3D_id for point in image.points2D if point.has_point3D()]
+        if not point_ids:
+            continue
+        points = np.array([reconstruction.points3D[point_id].xyz for point_id in point_ids])
+        pose = image.cam_from_world.matrix()
+        depths = points @ pose[:, :3].T[:, 2] + pose[2, 3]
+        depths = depths[depths > 0]
+        if not len(depths):
+            continue
+
+        # Sources sharing the most points, seen from a wide enough angle
+        counts = Counter()
+        for point_id in point_ids:
+            counts.update({element.image_id for element in reconstruction.points3D[point_id].track.elements})
+        counts.pop(image_id, None)
+        center = np.asarray(image.projection_center())
+        target = np.median(points, axis=0)
+        sources = []
+        for source_id, _ in counts.most_common():
+            source_center = np.asarray(reconstruction.images[source_id].projection_center())
+            ray1, ray2 = center - target, source_center - target
+            cosine = ray1 @ ray2 / max(np.linalg.norm(ray1) * np.linalg.norm(ray2), 1e-12)
+            if np.arccos(np.clip(cosine, -1.0, 1.0)) >= MIN_TRIANGULATION_ANGLE:
+                sources.append(source_id)
+            if len(sources) == num_sources:
+                break
+        if sources:
+            depth_min = np.percentile(depths, 1) * (1 - DEPTH_MARGIN)
+            depth_max = np.percentile(depths, 99) * (1 + DEPTH_MARGIN)
+            views[image_id] = (sources, depth_min, depth_max)
+    return views
+
+
+def load_gray(path, calibration, max_image_size):
+    """Grayscale image in [0, 1] downscaled to max_image_size, with its rescaled calibration"""
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise RuntimeError(f"Cannot read image {path}")
+    height, width = image.shape
+    scale = min(1.0, max_image_size / max(height, width))
+    if scale < 1.0:
+        image = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    calibration = np.array(calibration, dtype=np.float64)
+    calibration[0] *= image.shape[1] / width
+    calibration[1] *= image.shape[0] / height
+    return image.astype(np.float32) / 255.0, calibration
+
+
+def pixel_rays(width, height, calibration):
+    """Viewing rays at depth 1 through the pixel centers, as a (3, height, width) array"""
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float64)
+    pixels = np.stack([xs + 0.5, ys + 0.5, np.ones_like(xs)])
+    return np.einsum("ij,jhw->ihw", np.linalg.inv(calibration), pixels)
+
+
+def window_mean(image, radius):
+    """Mean over the square window of each pixel"""
+    return cv2.boxFilter(image, -1, (2 * radius + 1, 2 * radius + 1), borderType=cv2.BORDER_REFLECT)
+
+
+def plane_sweep(reference, calibration, sources, rotations, translations, depth_min, depth_max, num_depths, radius):
+    """Winner-take-all depth over fronto-parallel planes scored by windowed NCC, with its matching cost"""
+    height, width = reference.shape
+    rays = pixel_rays(width, height, calibration).reshape(3, -1)
+    reference_mean = window_mean(reference, radius)
+    reference_variance = window_mean(reference * reference, radius) - reference_mean ** 2
+
+    # Source pixel of a reference pixel at depth d is (A * d + b), dehomogenized
+    projections = []
+    for (image, source_calibration), rotation, translation in zip(sources, rotations, translations):
+        projections.append(((source_calibration @ np.asarray(rotation) @ rays).astype(np.float32),
+                            (source_calibration @ np.asarray(translation)).astype(np.float32)))
+
+    # Planes are evenly spaced in inverse depth, like disparities
+    inverse_depths = np.linspace(1.0 / depth_min, 1.0 / depth_max, num_depths)
+    num_best = max(1, (len(sources) + 1) // 2)
+    best_cost = np.full((height, width), np.inf, dtype=np.float32)
+    best_index = np.zeros((height, width), dtype=np.int64)
+    cost_before = np.full((height, width), MISSING_COST, dtype=np.float32)
+    cost_after = np.full((height, width), MISSING_COST, dtype=np.float32)
+    previous = np.full((height, width), MISSING_COST, dtype=np.float32)
+
+    for index, inverse_depth in enumerate(inverse_depths):
+        costs = np.empty((len(sources), height, width), dtype=np.float32)
+        for source, ((image, _), (direction, offset)) in enumerate(zip(sources, projections)):
+            points = direction * np.float32(1.0 / inverse_depth) + offset[:, None]
+            z = np.maximum(points[2], 1e-9)
+            map_x = (points[0] / z - 0.5).reshape(height, width)
+            map_y = (points[1] / z - 0.5).reshape(height, width)
+            warped = cv2.remap(image, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+            inside = (points[2] > 1e-9).reshape(height, width) & (map_x >= 0) & (map_y >= 0) \
+                & (map_x <= image.shape[1] - 1) & (map_y <= image.shape[0] - 1)
+            coverage = window_mean(inside.astype(np.float32), radius)
+            warped_mean = window_mean(warped, radius)
+            warped_variance = window_mean(warped * warped, radius) - warped_mean ** 2
+            covariance = window_mean(reference * warped, radius) - reference_mean * warped_mean
+            ncc = covariance / np.sqrt(np.maximum(reference_variance * warped_variance, 1e-12))
+            costs[source] = np.where((coverage > 0.999) & (warped_variance > MIN_WINDOW_VARIANCE),
+                                     1.0 - np.clip(ncc, -1.0, 1.0), MISSING_COST)
+
+        # Occlusions are tolerated by only keeping the best half of the sources
+        cost = np.sort(costs, axis=0)[:num_best].mean(axis=0)
+
+        # Neighbour costs of the current best depth, for sub-plane refinement
+        follows_best = best_index == index - 1
+        cost_after[follows_best] = cost[follows_best]
+        better = cost < best_cost
+        best_cost[better] = cost[better]
+        best_index[better] = index
+        cost_before[better] = previous[better]
+        cost_after[better] = MISSING_COST
+        previous = cost
+
+    # Parabola through the best cost and its two neighbours
+    curvature = cost_before - 2.0 * best_cost + cost_after
+    shift = np.where(curvature > 1e-6, 0.5 * (cost_before - cost_after) / np.maximum(curvature, 1e-6), 0.0)
+    step = inverse_depths[1] - inverse_depths[0] if num_depths > 1 else 0.0
+    depth = 1.0 / (inverse_depths[best_index] + np.clip(shift, -0.5, 0.5) * step)
+
+    # Depths at the ends of the range are most likely outside of it
+    valid = (best_index > 0) & (best_index < num_depths - 1) & (reference_variance > MIN_WINDOW_VARIANCE)
+    best_cost[~valid] = MISSING_COST
+    return depth.astype(np.float32), best_cost
+
+
+def depth_normals(depth, calibration):
+    """Unit normals in the camera frame from the depth gradient, facing the camera"""
+    height, width = depth.shape
+    rays = pixel_rays(width, height, calibration)
+    points = rays * depth
+    normals = np.cross(np.gradient(points, axis=2), np.gradient(points, axis=1), axis=0)
+    length = np.linalg.norm(normals, axis=0)
+    normals[:, (normals * rays).sum(axis=0) > 0] *= -1
+
+    # Gradients across a missing neighbour are meaningless
+    valid = cv2.erode((depth > 0).astype(np.uint8), np.ones((3, 3), np.uint8)) > 0
+    valid &= length > 1e-12
+    normals = np.where(valid, normals / np.maximum(length, 1e-12), 0.0)
+    return normals.transpose(1, 2, 0).astype(np.float32), valid
+
+
+def estimate_depth_map(reference_path, source_paths, calibration, source_calibrations, rotations, translations,
+                       depth_min, depth_max, depth_path, normal_path, mask_path, settings):
+    """Worker entry point writing the depth and normal maps of one reference image, returns the valid pixels"""
+    # Images are spread over processes, not threads
+    cv2.setNumThreads(1)
+    max_image_size = settings["max_image_size"]
+    reference, calibration = load_gray(reference_path, calibration, max_image_size)
+    sources = [load_gray(path, source_calibration, max_image_size)
+               for path, source_calibration in zip(source_paths, source_calibrations)]
+
+    depth, cost = plane_sweep(reference, calibration, sources, rotations, translations, depth_min, depth_max,
+                              settings["num_depths"], settings["window_radius"])
+    depth[cost > MAX_MATCHING_COST] = 0
+    if mask_path and os.path.exists(mask_path):
+        mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+        depth[cv2.resize(mask, depth.shape[::-1], interpolation=cv2.INTER_NEAREST) == 0] = 0
+    normals, valid = depth_normals(depth, calibration)
+    depth[~valid] = 0
+
+    # The depth map is written last, it marks the image as done
+    write_array(normal_path, normals)
+    write_array(depth_path, depth)
+    return int(np.count_nonzero(depth))
+
+
+def cpu_patch_match_stereo(pipeline):
+    """Estimate photometric depth and normal maps of the undistorted images in a process pool"""
+    log = pipeline.log
+    options = pipeline.options
+    stereo_dir = os.path.join(pipeline.dense_dir, "stereo")
+    images_dir = os.path.join(pipeline.dense_dir, "images")
+    mask_dir = pipeline.dense_mask_dir if options["mask_images"] else ""
+    reconstruction = pycolmap.Reconstruction(os.path.join(pipeline.dense_dir, "sparse"))
+    views = select_views(reconstruction, options["cpu_stereo_num_sources"])
+    log(f"Estimating {len(views)} depth maps with {options['cpu_stereo_num_depths']} depth planes")
+
+    settings = {
+        "max_image_size": options["cpu_stereo_max_image_size"],
+        "num_depths": options["cpu_stereo_num_depths"],
+        "window_radius": options["patch_match_window_radius"],
+    }
+    tasks = []
+    for image_id, (source_ids, depth_min, depth_max) in views.items():
+        image = reconstruction.images[image_id]
+        pose = image.cam_from_world.matrix()
+        source_poses = [reconstruction.images[source_id].cam_from_world.matrix() for source_id in source_ids]
+        # Source poses relative to the reference camera
+        rotations = [source_pose[:, :3] @ pose[:, :3].T for source_pose in source_poses]
+        translations = [source_pose[:, 3] - rotation @ pose[:, 3]
+                        for source_pose, rotation in zip(source_poses, rotations)]
+        map_name = f"{image.name}.photometric.bin"
+        for name in ("depth_maps", "normal_maps"):
+            os.makedirs(os.path.dirname(os.path.join(stereo_dir, name, map_name)), exist_ok=True)
+        tasks.append((
+            os.path.join(images_dir, image.name),
+            [os.path.join(images_dir, reconstruction.images[source_id].name) for source_id in source_ids],
+            reconstruction.cameras[image.camera_id].calibration_matrix(),
+            [reconstruction.cameras[reconstruction.images[source_id].camera_id].calibration_matrix()
+             for source_id in source_ids],
+            rotations,
+            translations,
+            depth_min,
+            depth_max,
+            os.path.join(stereo_dir, "depth_maps", map_name),
+            os.path.join(stereo_dir, "normal_maps", map_name),
+            os.path.join(mask_dir, image.name + ".png") if mask_dir else "",
+            settings
+        ))
+
+    # Progress is polled from the depth maps written so far
+    num_workers = options["num_threads"] if options["num_threads"] > 0 else (os.cpu_count() or 1)
+    if not run_in_pool(estimate_depth_map, tasks, max(1, min(len(tasks), num_workers)), pipeline.is_cancelled):
+        log("Reconstruction cancelled")
+        return False
+    return True
@@ -0,0 +1,376 @@
+import os
+import json
+import argparse
+import numpy as np
+from alignment import umeyama
+from point_cloud import open_ply_vertices, chunks, xyz
+
+# Average number of points per occupied cell of the finest nearest neighbour grid
+POINTS_PER_CELL = 4
+
+# Queries searched at once, and (query, point) distances computed at once
+QUERY_CHUNK_SIZE = 100000
+MAX_PAIRS = 5000000
+
+# Cells holding at most this many points are searched point by point instead of being split
+LEAF_SIZE = 32
+
+# Grid cells along each axis are stored on 21 bits of the Morton codes
+MAX_GRID_BITS = 21
+
+# Points of each cloud used to pick the coarse alignment, and model points refining it
+COARSE_MODEL_SAMPLE_SIZE = 5000
+COARSE_REFERENCE_SAMPLE_SIZE = 20000
+ICP_SAMPLE_SIZE = 50000
+ICP_ITERATIONS = 50
+ICP_TOLERANCE = 1e-3
+
+# ICP ignores pairs farther apart than this many median distances, and searches twice as far
+ICP_TRIM = 3.0
+ICP_SEARCH_MARGIN = 2.0
+
+# Default thresholds, as fractions of the reference bounding box diagonal
+DEFAULT_THRESHOLD_FRACTIONS = (0.005, 0.01, 0.02)
+
+# Distances are capped at this multiple of the largest threshold, so outliers do not dominate the means
+MAX_DISTANCE_FACTOR = 5.0
+
+QUALITY_KEY = "quality"
+
+
+def load_points(path):
+    """(N, 3) float32 points of a PLY file (vertices of meshes), a .npy array or a text file"""
+    if path.lower().endswith(".ply"):
+        vertices = open_ply_vertices(path)
+        return np.concatenate([xyz(chunk).astype(np.float32) for chunk in chunks(vertices)]) \
+            if len(vertices) else np.zeros((0, 3), np.float32)
+    if path.lower().endswith(".npy"):
+        return np.load(path, mmap_mode="r")[:, :3].astype(np.float32)
+    return np.loadtxt(path, usecols=(0, 1, 2), ndmin=2).astype(np.float32)
+
+
+def sample_points(points, count, seed=0):
+    """At most count points drawn without replacement"""
+    if len(points) <= count:
+        return np.asarray(points, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    return np.asarray(points[np.sort(rng.choice(len(points), count, replace=False))], dtype=np.float64)
+
+
+def spread_bits(values):
+    """Insert two zero bits between the bits of each value"""
+    values = values.astype(np.uint64) & np.uint64(0x1FFFFF)
+    for shift, mask in ((32, 0x1F00000000FFFF), (16, 0x1F0000FF0000FF), (8, 0x100F00F00F00F00F),
+                        (4, 0x10C30C30C30C30C3), (2, 0x1249249249249249)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def morton_codes(cells):
+    """Z-order codes of integer cells, the cells of a coarser grid then cover contiguous code ranges"""
+    return spread_bits(cells[:, 0]) | (spread_bits(cells[:, 1]) << np.uint64(1)) \
+        | (spread_bits(cells[:, 2]) << np.uint64(2))
+
+
+# The cell of a query and its 26 neighbours, and the 8 cells a cell splits into on the next finer level
+NEIGHBOR_OFFSETS = np.stack(np.meshgrid(*[np.arange(-1, 2)] * 3, indexing="ij"), axis=-1).reshape(-1, 3)
+CHILD_OFFSETS = np.stack(np.meshgrid(*[np.arange(2)] * 3, indexing="ij"), axis=-1).reshape(-1, 3)
+
+
+class GridIndex:
+    """Exact nearest neighbour search on a pyramid of grids, each level doubling the cell size"""
+
+    def __init__(self, points, cell_size=None):
+        self.points = np.asarray(points)
+        self.low = self.points.min(axis=0).astype(np.float64)
+        extent = self.points.max(axis=0) - self.low
+        diagonal = max(float(np.linalg.norm(extent)), 1e-12)
+        self.cell_size = max(cell_size or self.estimate_cell_size(diagonal),
+                             float(extent.max()) / (2 ** MAX_GRID_BITS - 2), 1e-12)
+        cells = self.cells(self.points, 0)
+        self.max_cell = cells.max(axis=0)
+        # Points are sorted once along the Z-order curve, a cell of any level then covers one code range
+        codes = morton_codes(cells)
+        self.order = np.argsort(codes, kind="stable")
+        self.codes = codes[self.order]
+
+    def estimate_cell_size(self, diagonal):
+        """Cell size giving about POINTS_PER_CELL points per occupied cell on a surface"""
+        cell_size = diagonal / 128
+        cells = np.floor((self.points - self.low) / cell_size).astype(np.int64)
+        occupied = len(np.unique(cells[:, 0] + 129 * (cells[:, 1] + 129 * cells[:, 2])))
+        # Surface points per cell grow with the square of the cell size
+        return cell_size * np.sqrt(POINTS_PER_CELL * occupied / len(self.points))
+
+    def level_size(self, level):
+        return self.cell_size * 2 ** level
+
+    def cells(self, points, level):
+        return np.floor((np.asarray(points, dtype=np.float64) - self.low) / self.level_size(level)).astype(np.int64)
+
+    def neighbors(self, queries, rows, level):
+        """(query row, cell) of the grid cells around the query rows at a level"""
+        cells = (self.cells(queries[rows], level)[:, None, :] + NEIGHBOR_OFFSETS[None]).reshape(-1, 3)
+        owners = np.repeat(rows, len(NEIGHBOR_OFFSETS))
+        inside = np.all((cells >= 0) & (cells <= self.max_cell >> level), axis=1)
+        return owners[inside], cells[inside]
+
+    def cell_ranges(self, cells, level):
+        """First sorted point and point count of cells at a level"""
+        shift = np.uint64(3 * level)
+        codes = morton_codes(cells) << shift
+        first = np.searchsorted(self.codes, codes, side="left")
+        return first, np.searchsorted(self.codes, codes + (np.uint64(1) << shift), side="left") - first
+
+    def box_distances(self, queries, cells, level):
+        """Distance of each query to its cell"""
+        low = self.low + cells * self.level_size(level)
+        gap = np.maximum(np.maximum(low - queries, queries - low - self.level_size(level)), 0)
+        return np.sqrt((gap ** 2).sum(axis=1))
+
+    def query(self, queries, max_distance):
+        """Distance to and index of the nearest point of each query, inf and -1 beyond max_distance"""
+        distances = np.full(len(queries), np.inf)
+        indices = np.full(len(queries), -1, dtype=np.int64)
+        # Queries follow the Z-order curve too, so that nearby queries look up nearby cells
+        cells = np.clip(self.cells(queries, 0), 0, self.max_cell)
+        order = np.argsort(morton_codes(cells), kind="stable")
+        for start in range(0, len(queries), QUERY_CHUNK_SIZE):
+            rows = order[start:start + QUERY_CHUNK_SIZE]
+            distances[rows], indices[rows] = self.query_block(np.asarray(queries[rows], dtype=np.float64),
+                                                              max_distance)
+        return distances, indices
+
+    def query_block(self, queries, max_distance):
+        best = np.full(len(queries), np.inf)
+        best_index = np.full(len(queries), -1, dtype=np.int64)
+
+        # Step 1: Points of the 27 finest cells around each query, enough within one cell
+        owners, cells = self.neighbors(queries, np.arange(len(queries)), 0)
+        self.update_nearest(queries, owners, *self.cell_ranges(cells, 0), best, best_index)
+        far = np.flatnonzero(best > self.cell_size)
+        if self.cell_size >= max_distance:
+            far = far[:0]
+
+        # Step 2: Climb the pyramid until a cell around each remaining query holds a point
+        pending, level = far[np.isinf(best[far])], 0
+        while len(pending) and self.level_size(level) < max_distance and level < MAX_GRID_BITS:
+            level += 1
+            owners, cells = self.neighbors(queries, pending, level)
+            first, lengths = self.cell_ranges(cells, level)
+            keep = lengths > 0
+            # The first point of a cell bounds the nearest distance
+            self.update_nearest(queries, owners[keep], first[keep], np.ones(keep.sum(), np.int64),
+                                best, best_index)
+            pending = pending[np.isinf(best[pending])]
+
+        # Step 3: Descend from the level covering each bound, dropping cells farther than the best point so far
+        far = far[np.isfinite(best[far])]
+        top = np.ceil(np.log2(np.maximum(np.minimum(best[far], max_distance) / self.cell_size, 1))).astype(np.int64)
+        owners, cells = np.zeros(0, np.int64), np.zeros((0, 3), np.int64)
+        for level in range(int(top.max()) if len(far) else -1, -1, -1):
+            new_owners, new_cells = self.neighbors(queries, far[top == level], level)
+            owners, cells = np.concatenate([owners, new_owners]), np.concatenate([cells, new_cells])
+            first, lengths = self.cell_ranges(cells, level)
+            keep = lengths > 0
+            order = np.argsort(owners[keep], kind="stable")
+            owners, cells, first, lengths = (values[keep][order] for values in (owners, cells, first, lengths))
+            self.update_nearest(queries, owners, first, np.ones(len(owners), np.int64), best, best_index)
+            keep = self.box_distances(queries[owners], cells, level) <= np.minimum(best[owners], max_distance)
+            owners, cells, first, lengths = owners[keep], cells[keep], first[keep], lengths[keep]
+            # Small cells are searched right away, which tightens the bounds used to prune the others
+            leaves = (lengths <= LEAF_SIZE) | (level == 0)
+            self.update_nearest(queries, owners[leaves], first[leaves], lengths[leaves], best, best_index)
+            split = ~leaves
+            split[split] = self.box_distances(queries[owners[split]], cells[split], level) \
+                <= np.minimum(best[owners[split]], max_distance)
+            owners = np.repeat(owners[split], len(CHILD_OFFSETS))
+            cells = (2 * cells[split][:, None, :] + CHILD_OFFSETS[None]).reshape(-1, 3)
+
+        beyond = best > max_distance
+        best[beyond] = np.inf
+        best_index[beyond] = -1
+        return best, best_index
+
+    def update_nearest(self, queries, owners, first, lengths, best, best_index):
+        """Keep the nearest of the points in the sorted point ranges, the owner rows being sorted"""
+        keep = lengths > 0
+        owners, first, lengths = owners[keep], first[keep], lengths[keep]
+        if not len(lengths):
+            return
+        # Ranges are split so that each part expands at most about MAX_PAIRS (query, point) pairs
+        bounds = np.searchsorted(np.cumsum(lengths), np.arange(MAX_PAIRS, lengths.sum(), MAX_PAIRS))
+        for part in zip(np.split(owners, bounds), np.split(first, bounds), np.split(lengths, bounds)):
+            if len(part[0]):
+                self.update_pairs(queries, *part, best, best_index)
+
+    def update_pairs(self, queries, owners, first, lengths, best, best_index):
+        pair_owners = np.repeat(owners, lengths)
+        pair_points = self.order[np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - first, lengths)]
+        distances = np.sqrt(((self.points[pair_points].astype(np.float64) - queries[pair_owners]) ** 2).sum(axis=1))
+
+        # First pair reaching the smallest distance of each query
+        starts = np.flatnonzero(np.r_[True, pair_owners[1:] != pair_owners[:-1]])
+        minima = np.minimum.reduceat(distances, starts)
+        candidates = np.flatnonzero(distances == np.repeat(minima, np.diff(np.r_[starts, len(distances)])))
+        nearest = candidates[np.r_[True, pair_owners[candidates][1:] != pair_owners[candidates][:-1]]]
+        nearer = nearest[distances[nearest] < best[pair_owners[nearest]]]
+        best[pair_owners[nearer]] = distances[nearer]
+        best_index[pair_owners[nearer]] = pair_points[nearer]
+
+
+def apply_similarity(transform, points):
+    """Points mapped by a (scale, rotation, translation) similarity"""
+    scale, rotation, translation = transform
+    return scale * np.asarray(points, dtype=np.float64) @ rotation.T + translation
+
+
+def compose(first, second):
+    """Similarity applying second, then first"""
+    scale1, rotation1, translation1 = first
+    scale2, rotation2, translation2 = second
+    return scale1 * scale2, rotation1 @ rotation2, scale1 * rotation1 @ translation2 + translation1
+
+
+def principal_alignments(source, target):
+    """Similarities matching centroids, spreads and principal axes, one per axis orientation"""
+    source_mean, target_mean = source.mean(axis=0), target.mean(axis=0)
+    source_variances, source_axes = np.linalg.eigh(np.cov((source - source_mean).T))
+    target_variances, target_axes = np.linalg.eigh(np.cov((target - target_mean).T))
+    scale = np.sqrt(target_variances.sum() / max(source_variances.sum(), 1e-12))
+    alignments = []
+    for signs in ((1, 1, 1), (1, -1, -1), (-1, 1, -1), (-1, -1, 1)):
+        rotation = target_axes @ np.diag(signs) @ source_axes.T
+        if np.linalg.det(rotation) < 0:
+            rotation = target_axes @ np.diag(np.array(signs) * [1, 1, -1]) @ source_axes.T
+        alignments.append((scale, rotation, target_mean - scale * rotation @ source_mean))
+    return alignments
+
+
+def icp(source, index, transform, max_distance, iterations=ICP_ITERATIONS):
+    """Similarity ICP of source points onto an indexed cloud, returns the refined transform"""
+    previous, radius = np.inf, max_distance
+    for _ in range(iterations):
+        moved = apply_similarity(transform, source)
+        distances, nearest = index.query(moved, radius)
+        found = np.isfinite(distances)
+        if found.sum() < 3:
+            break
+        trim = ICP_TRIM * np.median(distances[found])
+        pairs = found & (distances <= trim)
+        # Later iterations only look as far as the pairs they may keep
+        radius = min(max_distance, ICP_SEARCH_MARGIN * trim)
+        if pairs.sum() < 3:
+            break
+        error = distances[pairs].mean()
+        transform = compose(umeyama(moved[pairs], index.points[nearest[pairs]].astype(np.float64)), transform)
+        if previous - error < ICP_TOLERANCE * max(error, 1e-12):
+            break
+        previous = error
+    return transform
+
+
+def align(model_points, reference_points, reference_index, max_distance, initial=None, log=print):
+    """Similarity aligning the model onto the reference, from the given or the best principal alignment"""
+    source = sample_points(model_points, COARSE_MODEL_SAMPLE_SIZE)
+    target = sample_points(reference_points, COARSE_REFERENCE_SAMPLE_SIZE, seed=1)
+    target_index = GridIndex(target)
+    reach = float(np.linalg.norm(target.max(axis=0) - target.min(axis=0)))
+
+    # Step 1: Coarse ICP on small samples from every candidate, kept by symmetric distance
+    best, best_score = None, np.inf
+    for candidate in [initial] if initial is not None else principal_alignments(source, target):
+        candidate = icp(source, target_index, candidate, reach)
+        moved = apply_similarity(candidate, source)
+        accuracy = np.minimum(target_index.query(moved, reach)[0], reach).mean()
+        completeness = np.minimum(GridIndex(moved).query(target, reach)[0], reach).mean()
+        if accuracy + completeness < best_score:
+            best, best_score = candidate, accuracy + completeness
+
+    # Step 2: Refinement of a larger sample against the full reference
+    best = icp(sample_points(model_points, ICP_SAMPLE_SIZE, seed=2), reference_index, best, max_distance)
+    log(f"Aligned the model with scale {best[0]:.4g}")
+    return best
+
+
+def f_scores(accuracy, completeness, thresholds):
+    """Precision, recall and F-score at each threshold"""
+    scores = []
+    for threshold in thresholds:
+        precision = float(np.mean(accuracy < threshold)) if len(accuracy) else 0.0
+        recall = float(np.mean(completeness < threshold)) if len(completeness) else 0.0
+        f_score = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+        scores.append({"threshold": float(threshold), "precision": precision, "recall": recall,
+                       "f_score": f_score})
+    return scores
+
+
+def evaluate(model_points, reference_points, thresholds=None, initial=None, log=print):
+    """Accuracy, completeness, Chamfer distance and F-scores of a model against a reference after alignment"""
+    reference_points = np.asarray(reference_points, dtype=np.float32)
+    diagonal = float(np.linalg.norm(reference_points.max(axis=0) - reference_points.min(axis=0)))
+    thresholds = sorted(thresholds or [fraction * diagonal for fraction in DEFAULT_THRESHOLD_FRACTIONS])
+    max_distance = MAX_DISTANCE_FACTOR * thresholds[-1]
+    log(f"Evaluating {len(model_points)} points against {len(reference_points)} reference points")
+
+    reference_index = GridIndex(reference_points)
+    transform = align(model_points, reference_points, reference_index, max_distance, initial, log)
+    aligned = np.concatenate([apply_similarity(transform, model_points[start:start + QUERY_CHUNK_SIZE])
+                              .astype(np.float32) for start in range(0, len(model_points), QUERY_CHUNK_SIZE)])
+
+    # Distances beyond the cap count as the cap
+    accuracy = np.minimum(reference_index.query(aligned, max_distance)[0], max_distance)
+    completeness = np.minimum(GridIndex(aligned).query(reference_points, max_distance)[0], max_distance)
+    scale, rotation, translation = transform
+    return {
+        "model_points": int(len(aligned)),
+        "reference_points": int(len(reference_points)),
+        "alignment": {"scale": float(scale), "rotation": rotation.tolist(), "translation": translation.tolist()},
+        "max_distance": max_distance,
+        "accuracy": {"mean": float(accuracy.mean()), "median": float(np.median(accuracy))},
+        "completeness": {"mean": float(completeness.mean()), "median": float(np.median(completeness))},
+        "chamfer_distance": float(accuracy.mean() + completeness.mean()) / 2,
+        "thresholds": f_scores(accuracy, completeness, thresholds),
+    }
+
+
+def read_transform(path):
+    """(scale, rotation, translation) of a 4x4 similarity matrix stored as text"""
+    matrix = np.loadtxt(path).reshape(4, 4)
+    scale = np.cbrt(np.linalg.det(matrix[:3, :3]))
+    return scale, matrix[:3, :3] / scale, matrix[:3, 3]
+
+
+def write_quality(metrics_path, quality):
+    """Add the evaluation to the metrics file of a run"""
+    metrics = {}
+    if os.path.exists(metrics_path):
+        with open(metrics_path, "r") as f:
+            metrics = json.load(f)
+    metrics[QUALITY_KEY] = quality
+    tmp_path = metrics_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(metrics, f, indent=2)
+    os.replace(tmp_path, metrics_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a reconstruction against a reference model")
+    parser.add_argument("model", help="Generated fused.ply, filtered.ply or meshed.ply")
+    parser.add_argument("reference", help="Reference point cloud or mesh (.ply, .npy or x y z text)")
+    parser.add_argument("--thresholds", type=float, nargs="+",
+                        help="Distance thresholds of the F-scores, in reference units")
+    parser.add_argument("--initial-transform", help="4x4 similarity roughly mapping the model onto the reference")
+    parser.add_argument("--metrics", help="metrics.json of the run receiving the scores")
+    args = parser.parse_args()
+
+    initial = read_transform(args.initial_transform) if args.initial_transform else None
+    quality = evaluate(load_points(args.model), load_points(args.reference), args.thresholds, initial)
+    quality["model"] = os.path.abspath(args.model)
+    quality["reference"] = os.path.abspath(args.reference)
+    if args.metrics:
+        write_quality(args.metrics, quality)
+    print(json.dumps(quality, indent=2))
+
+if __name__ == "__main__":
+    main()
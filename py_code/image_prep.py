@@ -0,0 +1,149 @@
+import os
+import json
+import shutil
+from PIL import Image, ImageOps
+from stage_runner import run_in_pool
+
+# Version of the prepared images, part of their cache keys
+PREPARE_VERSION = 1
+
+JPEG_QUALITY = 95
+
+# Reduced JPEG decoding stops at this multiple of the target size, the rest is resampled
+DECODE_REDUCING_GAP = 1.0
+
+# EXIF tags giving the focal length
+ORIENTATION = 0x0112
+EXIF_IFD = 0x8769
+FOCAL_LENGTH = 0x920A
+FOCAL_LENGTH_35MM = 0xA405
+FOCAL_PLANE_X_RESOLUTION = 0xA20E
+FOCAL_PLANE_RESOLUTION_UNIT = 0xA210
+
+# Millimetres per focal plane resolution unit: inch, centimetre, millimetre
+RESOLUTION_UNIT_MM = {2: 25.4, 3: 10.0, 4: 1.0}
+
+# Diagonal of a 35mm film frame, in millimetres
+FILM_35MM_DIAGONAL = 43.27
+
+# Pillow formats of the image extensions COLMAP reads
+SAVE_FORMATS = {".jpg": "JPEG", ".jpeg": "JPEG", ".png": "PNG", ".tif": "TIFF", ".tiff": "TIFF", ".bmp": "BMP"}
+
+
+def camera_path(camera_dir, image_name):
+    """Location of the camera information of a prepared image"""
+    return os.path.join(camera_dir, image_name + ".json")
+
+
+def exif_focal_length(exif, width, height):
+    """Focal length in pixels of an image of the given stored size from its EXIF tags, or None"""
+    tags = exif.get_ifd(EXIF_IFD)
+    focal_35mm = tags.get(FOCAL_LENGTH_35MM)
+    if focal_35mm:
+        # The 35mm equivalent keeps the field of view along the diagonal
+        return float(focal_35mm) * (width ** 2 + height ** 2) ** 0.5 / FILM_35MM_DIAGONAL
+    focal_mm = tags.get(FOCAL_LENGTH)
+    resolution = tags.get(FOCAL_PLANE_X_RESOLUTION)
+    unit_mm = RESOLUTION_UNIT_MM.get(tags.get(FOCAL_PLANE_RESOLUTION_UNIT, 2))
+    if focal_mm and resolution and unit_mm:
+        return float(focal_mm) * float(resolution) / unit_mm
+    return None
+
+
+def prepare_image(source_path, output_path, output_camera_path, max_image_size):
+    """Worker entry point writing the upright image downscaled to max_image_size, returns its camera"""
+    with Image.open(source_path) as image:
+        exif = image.getexif()
+        width, height = image.size
+        focal_length = exif_focal_length(exif, width, height)
+        scale = min(1.0, max_image_size / max(width, height)) if max_image_size > 0 else 1.0
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        tmp_path = output_path + ".tmp"
+
+        if scale == 1.0 and exif.get(ORIENTATION, 1) == 1:
+            # Small and upright images are used as they are
+            shutil.copyfile(source_path, tmp_path)
+        else:
+            # JPEG images are decoded straight at the smallest reduced scale still above the target size,
+            # which skips most of the decoding work
+            image.thumbnail((round(max(width, height) * scale),) * 2, Image.Resampling.LANCZOS,
+                            reducing_gap=DECODE_REDUCING_GAP)
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            extension = os.path.splitext(output_path)[1].lower()
+            save_format = SAVE_FORMATS.get(extension, "PNG")
+            if save_format == "JPEG":
+                image.save(tmp_path, save_format, quality=JPEG_QUALITY)
+            else:
+                image.save(tmp_path, save_format)
+            scale = max(image.size) / max(width, height)
+            width, height = image.size
+        os.replace(tmp_path, output_path)
+
+    camera = {
+        "width": width,
+        "height": height,
+        "focal_length": focal_length * scale if focal_length else None,
+    }
+    os.makedirs(os.path.dirname(output_camera_path), exist_ok=True)
+    with open(output_camera_path, "w") as f:
+        json.dump(camera, f)
+    return camera
+
+
+def prepare_images(image_dir, output_dir, camera_dir, image_names, max_image_size, cache=None, num_workers=1,
+                   is_cancelled=None, log=print):
+    """Upright images downscaled to max_image_size in output_dir through the cache, returns their cameras or None"""
+    is_cancelled = is_cancelled or (lambda: False)
+    source_paths = [os.path.join(image_dir, name) for name in image_names]
+    outputs = [{"image": os.path.join(output_dir, name), "camera.json": camera_path(camera_dir, name)}
+               for name in image_names]
+
+    # Step 1: Images prepared before at the same size, by any run
+    keys = None
+    if cache is not None:
+        options = {"max_image_size": max_image_size, "version": PREPARE_VERSION}
+        keys = cache.item_keys("prepared_image", options, source_paths)
+        found = cache.restore_items(list(zip(keys, outputs)))
+        todo = [index for index, key in enumerate(keys) if key not in found]
+        log(f"Reusing {len(image_names) - len(todo)} prepared images, preparing {len(todo)}")
+    else:
+        todo = list(range(len(image_names)))
+        log(f"Preparing {len(todo)} images")
+
+    # Step 2: Decode and downscale the others in parallel
+    tasks = [(source_paths[index], outputs[index]["image"], outputs[index]["camera.json"], max_image_size)
+             for index in todo]
+    prepared = []
+    if num_workers <= 1:
+        # Daemon stage workers cannot start a pool of their own
+        for task_index, task in enumerate(tasks):
+            if is_cancelled():
+                break
+            prepare_image(*task)
+            prepared.append(todo[task_index])
+        completed = len(prepared) == len(tasks)
+    else:
+        def on_prepared(task_index, camera):
+            prepared.append(todo[task_index])
+
+        completed = run_in_pool(prepare_image, tasks, min(num_workers, max(1, len(tasks))), is_cancelled,
+                                on_prepared)
+
+    # Images finished before a cancel are kept for the next run
+    if cache is not None and prepared:
+        cache.store_items([(keys[index], outputs[index]) for index in prepared])
+    if not completed:
+        return None
+
+    return read_cameras(camera_dir, image_names)
+
+
+def read_cameras(camera_dir, image_names):
+    """Camera information of the prepared images, by image name"""
+    cameras = {}
+    for name in image_names:
+        with open(camera_path(camera_dir, name), "r") as f:
+            cameras[name] = json.load(f)
+    return cameras
@@ -0,0 +1,143 @@
+import os
+import queue
+import logging
+import threading
+import tkinter as tk
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+DEFAULT_LOG_DIR = os.path.join(os.path.expanduser("~"), ".cache", "colmap_reconstruction", "logs")
+
+# Drain the queue every DRAIN_INTERVAL_MS, at most MAX_BATCH records at a time
+DRAIN_INTERVAL_MS = 100
+MAX_BATCH = 500
+
+# Records waiting for the widget, newer ones are dropped and counted beyond this
+MAX_QUEUED = 20000
+
+# Number of lines kept in the text widget
+MAX_LINES = 2000
+
+LOG_FILE_SIZE = 10 * 1024 ** 2
+LOG_FILE_BACKUPS = 5
+
+
+class StreamToLogger:
+    """File-like object forwarding complete lines to a logger, usable as sys.stdout"""
+
+    def __init__(self, logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+        self.buffer = ""
+
+    def write(self, string):
+        self.buffer += string
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            self.logger.log(self.level, line)
+        return len(string)
+
+    def flush(self):
+        if self.buffer:
+            self.logger.log(self.level, self.buffer)
+            self.buffer = ""
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler counting the records it drops when the queue is full instead of growing it"""
+
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def take_dropped(self):
+        """Number of records dropped since the last call"""
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+
+class LogPump:
+    """Queue-based logging: any thread enqueues, the Tk main loop drains in batches"""
+
+    def __init__(self, name="colmap_reconstruction", log_dir=DEFAULT_LOG_DIR, max_lines=MAX_LINES):
+        self.queue = queue.Queue(maxsize=MAX_QUEUED)
+        self.calls = queue.Queue()
+        self.max_lines = max_lines
+        self.text_widget = None
+        self.root = None
+
+        self.logger = logging.getLogger(name)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.handlers.clear()
+
+        # Records for the widget only carry the message, the queue is bounded for stages logging faster than
+        # the widget drains
+        self.queue_handler = DroppingQueueHandler(self.queue)
+        self.logger.addHandler(self.queue_handler)
+
+        # The full log is streamed to a rotating file on disk
+        os.makedirs(log_dir, exist_ok=True)
+        self.log_path = os.path.join(log_dir, f"{name}.log")
+        file_handler = RotatingFileHandler(self.log_path, maxBytes=LOG_FILE_SIZE, backupCount=LOG_FILE_BACKUPS)
+        file_handler.setFormatter(logging.Formatter("%(asctime)s %(threadName)s %(message)s"))
+        self.logger.addHandler(file_handler)
+
+    def log(self, message):
+        """Enqueue a message, safe to call from any thread"""
+        self.logger.info(message)
+
+    def call_soon(self, function, *args):
+        """Run a widget update on the Tk main loop, safe to call from any thread"""
+        self.calls.put((function, args))
+
+    def stream(self):
+        """File-like object to replace sys.stdout with"""
+        return StreamToLogger(self.logger)
+
+    def attach(self, root, text_widget):
+        """Start draining into a text widget from the Tk main loop"""
+        self.root = root
+        self.text_widget = text_widget
+        self.root.after(DRAIN_INTERVAL_MS, self.drain)
+
+    def drain(self):
+        """Move a batch of queued records to the widget in a single insert"""
+        lines = []
+        while len(lines) < MAX_BATCH:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            lines.append(record.getMessage())
+        dropped = self.queue_handler.take_dropped()
+        if dropped:
+            lines.append(f"... {dropped} messages dropped, see {self.log_path}")
+
+        if lines:
+            self.text_widget.insert(tk.END, "\n".join(lines) + "\n")
+
+            # Keep the widget as a bounded ring buffer
+            num_lines = int(self.text_widget.index("end-1c").split(".")[0])
+            if num_lines > self.max_lines:
+                self.text_widget.delete("1.0", f"{num_lines - self.max_lines + 1}.0")
+            self.text_widget.see(tk.END)
+
+        # Widget updates run after this batch of log lines
+        try:
+            while True:
+                try:
+                    function, args = self.calls.get_nowait()
+                except queue.Empty:
+                    break
+                function(*args)
+        finally:
+            self.root.after(DRAIN_INTERVAL_MS, self.drain)
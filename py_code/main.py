@@ -6,13 +6,19 @@ import pycolmap
 import threading
 import numpy as np
 from pathlib import Path
+from pipeline import ReconstructionPipeline
+from add_images import add_images
+from progressive import progressive_reconstruction
+from cache import StageCache
+from log_pump import LogPump
+from scheduler import Scheduler, JobStore
 
 class ColmapGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("COLMAP 3D Reconstruction")
-        self.root.geometry("800x600")
-        self.root.minsize(800, 600)
+        self.root.geometry("800x770")
+        self.root.minsize(800, 770)
 
         # Create main frame
         self.main_frame = ttk.Frame(root, padding="20")
@@ -38,6 +44,12 @@ class ColmapGUI:
         ttk.Entry(input_frame, textvariable=self.output_dir_var, width=50).grid(row=1, column=1, padx=5, pady=5)
         ttk.Button(input_frame, text="Browse...", command=self.browse_output_dir).grid(row=1, column=2, padx=5, pady=5)
 
+        # Optional input video, keyframes are extracted into the image directory
+        ttk.Label(input_frame, text="Video File (optional):").grid(row=2, column=0, sticky=tk.W, pady=5)
+        self.video_path_var = tk.StringVar()
+        ttk.Entry(input_frame, textvariable=self.video_path_var, width=50).grid(row=2, column=1, padx=5, pady=5)
+        ttk.Button(input_frame, text="Browse...", command=self.browse_video_file).grid(row=2, column=2, padx=5, pady=5)
+
         # Create options frame
         options_frame = ttk.LabelFrame(self.main_frame, text="Reconstruction Options", padding="10")
         options_frame.pack(fill=tk.X, pady=10)
@@ -66,9 +78,25 @@ class ColmapGUI:
         self.use_gpu_var = tk.BooleanVar(value=True)
         ttk.Checkbutton(options_frame, text="Use GPU (if available)", variable=self.use_gpu_var).grid(row=4, column=0, columnspan=2, sticky=tk.W, pady=5)
 
+        # Resume from checkpoint
+        self.resume_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(options_frame, text="Resume from last finished stage", variable=self.resume_var).grid(row=5, column=0, columnspan=2, sticky=tk.W, pady=5)
+
+        # Add new images to an existing reconstruction
+        self.add_images_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(options_frame, text="Only add new images to existing reconstruction", variable=self.add_images_var).grid(row=6, column=0, columnspan=2, sticky=tk.W, pady=5)
+
+        # Low resolution preview before the full resolution run
+        self.progressive_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(options_frame, text="Progressive: quick preview, then full resolution", variable=self.progressive_var).grid(row=7, column=0, columnspan=2, sticky=tk.W, pady=5)
+
+        # Restrict features and fusion to the object in the middle of the images
+        self.mask_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(options_frame, text="Mask the central object (turntable or single object captures)", variable=self.mask_var).grid(row=8, column=0, columnspan=2, sticky=tk.W, pady=5)
+
         # Advanced options
         advanced_button = ttk.Button(options_frame, text="Advanced Options...", command=self.show_advanced_options)
-        advanced_button.grid(row=5, column=0, columnspan=2, sticky=tk.W, pady=10)
+        advanced_button.grid(row=9, column=0, columnspan=2, sticky=tk.W, pady=10)
 
         # Create log frame
         log_frame = ttk.LabelFrame(self.main_frame, text="Log", padding="10")
@@ -88,6 +116,10 @@ class ColmapGUI:
         self.progress_bar = ttk.Progressbar(self.main_frame, variable=self.progress_var, maximum=100)
         self.progress_bar.pack(fill=tk.X, pady=10)
 
+        # Current stage and ETA
+        self.status_var = tk.StringVar()
+        ttk.Label(self.main_frame, textvariable=self.status_var).pack(fill=tk.X)
+
         # Buttons frame
         buttons_frame = ttk.Frame(self.main_frame)
         buttons_frame.pack(fill=tk.X, pady=10)
@@ -96,6 +128,9 @@ class ColmapGUI:
         self.start_button = ttk.Button(buttons_frame, text="Start Reconstruction", command=self.start_reconstruction)
         self.start_button.pack(side=tk.RIGHT, padx=5)
 
+        # Queue button, queued jobs run concurrently under the scheduler's resource budget
+        ttk.Button(buttons_frame, text="Add to Queue", command=self.queue_reconstruction).pack(side=tk.RIGHT, padx=5)
+
         # Cancel button
         self.cancel_button = ttk.Button(buttons_frame, text="Cancel", command=self.cancel_reconstruction, state=tk.DISABLED)
         self.cancel_button.pack(side=tk.RIGHT, padx=5)
@@ -103,6 +138,7 @@ class ColmapGUI:
         # Initialize advanced options
         self.advanced_options = {
             "min_num_matches": 15,
+            "retrieval_num_neighbors": 50,
             "mapper_min_model_size": 10,
             "mapper_max_extra_param": 1.0,
             "patch_match_window_radius": 5,
@@ -111,10 +147,20 @@ class ColmapGUI:
             "meshing_trim": 7
         }
 
+        # Cache of stage outputs shared by successive runs
+        self.stage_cache = StageCache()
+
+        # Job scheduler, started on the first queued job or at once when jobs are left from a previous session
+        self.scheduler = None
+
         # Initialize reconstruction thread
         self.reconstruction_thread = None
         self.cancel_flag = False
 
+        # Log records are queued by any thread and drained by the Tk main loop
+        self.log_pump = LogPump()
+        self.log_pump.attach(self.root, self.log_text)
+
         # Redirect stdout to log
         self.redirect_stdout()
 
@@ -122,25 +168,15 @@ class ColmapGUI:
         self.log("COLMAP 3D Reconstruction GUI initialized")
         self.log("Please select an image directory and output directory to begin")
 
-    def redirect_stdout(self):
-        """Redirect stdout to the log text widget"""
-        class StdoutRedirector:
-            def __init__(self, text_widget):
-                self.text_widget = text_widget
-
-            def write(self, string):
-                self.text_widget.insert(tk.END, string)
-                self.text_widget.see(tk.END)
-
-            def flush(self):
-                pass
+        self.resume_pending_jobs()
 
-        sys.stdout = StdoutRedirector(self.log_text)
+    def redirect_stdout(self):
+        """Redirect stdout to the log pump"""
+        sys.stdout = self.log_pump.stream()
 
     def log(self, message):
-        """Add a message to the log"""
-        self.log_text.insert(tk.END, message + "\n")
-        self.log_text.see(tk.END)
+        """Add a message to the log, safe to call from the reconstruction thread"""
+        self.log_pump.log(message)
 
     def browse_image_dir(self):
         """Browse for image directory"""
@@ -154,11 +190,20 @@ class ColmapGUI:
         if directory:
             self.output_dir_var.set(directory)
 
+    def browse_video_file(self):
+        """Browse for an input video"""
+        path = filedialog.askopenfilename(
+            title="Select Video File",
+            filetypes=[("Video files", "*.mp4 *.mov *.avi *.mkv"), ("All files", "*.*")]
+        )
+        if path:
+            self.video_path_var.set(path)
+
     def show_advanced_options(self):
         """Show advanced options dialog"""
         advanced_window = tk.Toplevel(self.root)
         advanced_window.title("Advanced Options")
-        advanced_window.geometry("500x400")
+        advanced_window.geometry("500x440")
         advanced_window.transient(self.root)
         advanced_window.grab_set()
 
@@ -173,6 +218,10 @@ class ColmapGUI:
         min_matches_var = tk.IntVar(value=self.advanced_options["min_num_matches"])
         ttk.Entry(match_frame, textvariable=min_matches_var, width=10).grid(row=0, column=1, sticky=tk.W, padx=5, pady=5)
 
+        ttk.Label(match_frame, text="Retrieval Neighbors:").grid(row=1, column=0, sticky=tk.W, pady=5)
+        retrieval_neighbors_var = tk.IntVar(value=self.advanced_options["retrieval_num_neighbors"])
+        ttk.Entry(match_frame, textvariable=retrieval_neighbors_var, width=10).grid(row=1, column=1, sticky=tk.W, padx=5, pady=5)
+
         # Mapper options
         mapper_frame = ttk.LabelFrame(frame, text="Mapper Options", padding="10")
         mapper_frame.pack(fill=tk.X, pady=5)
@@ -211,6 +260,7 @@ class ColmapGUI:
 
         def save_options():
             self.advanced_options["min_num_matches"] = min_matches_var.get()
+            self.advanced_options["retrieval_num_neighbors"] = retrieval_neighbors_var.get()
             self.advanced_options["mapper_min_model_size"] = min_model_size_var.get()
             self.advanced_options["mapper_max_extra_param"] = max_extra_param_var.get()
             self.advanced_options["patch_match_window_radius"] = window_radius_var.get()
@@ -222,19 +272,74 @@ class ColmapGUI:
         ttk.Button(buttons_frame, text="Save", command=save_options).pack(side=tk.RIGHT, padx=5)
         ttk.Button(buttons_frame, text="Cancel", command=advanced_window.destroy).pack(side=tk.RIGHT, padx=5)
 
-    def start_reconstruction(self):
-        """Start the reconstruction process"""
-        # Validate inputs
+    def validate_inputs(self):
+        """Return (image_dir, output_dir, video_path), or None after showing an error"""
         image_dir = self.image_dir_var.get()
         output_dir = self.output_dir_var.get()
+        video_path = self.video_path_var.get()
 
-        if not image_dir or not os.path.isdir(image_dir):
+        if not output_dir:
+            messagebox.showerror("Error", "Please select an output directory")
+            return None
+
+        if video_path:
+            if not os.path.isfile(video_path):
+                messagebox.showerror("Error", "Please select a valid video file")
+                return None
+            # Keyframes go to the image directory, defaulting to one inside the output directory
+            if not image_dir:
+                image_dir = os.path.join(output_dir, "images")
+                self.image_dir_var.set(image_dir)
+        elif not image_dir or not os.path.isdir(image_dir):
             messagebox.showerror("Error", "Please select a valid image directory")
+            return None
+
+        return image_dir, output_dir, video_path
+
+    def start_scheduler(self):
+        """Start the job scheduler if it is not running yet"""
+        if self.scheduler is None:
+            self.scheduler = Scheduler(JobStore(), cache=self.stage_cache, log=self.log)
+            self.scheduler.start()
+
+    def resume_pending_jobs(self):
+        """Start the scheduler for jobs queued or interrupted in a previous session"""
+        pending = [job for job in JobStore().list() if job["status"] in ("queued", "running")]
+        if pending:
+            self.log(f"Resuming {len(pending)} queued jobs")
+            # Running jobs of a dead scheduler are requeued by start()
+            self.start_scheduler()
+
+    def queue_reconstruction(self):
+        """Add a reconstruction with the current settings to the job queue"""
+        inputs = self.validate_inputs()
+        if inputs is None:
             return
+        image_dir, output_dir, video_path = inputs
 
-        if not output_dir:
-            messagebox.showerror("Error", "Please select an output directory")
+        options = dict(self.advanced_options)
+        options.update({
+            "max_image_size": self.max_image_size_var.get(),
+            "max_num_features": self.max_features_var.get(),
+            "match_method": self.match_method_var.get(),
+            "dense": self.dense_var.get(),
+            "use_gpu": self.use_gpu_var.get(),
+            "mask_images": self.mask_var.get(),
+            "video_path": video_path
+        })
+
+        self.start_scheduler()
+
+        job = self.scheduler.store.submit(image_dir, output_dir, options)
+        self.log(f"Job {job['id']} queued, its log is written to {os.path.join(output_dir, 'job.log')}")
+
+    def start_reconstruction(self):
+        """Start the reconstruction process"""
+        # Validate inputs
+        inputs = self.validate_inputs()
+        if inputs is None:
             return
+        image_dir, output_dir, video_path = inputs
 
         # Create output directory if it doesn't exist
         os.makedirs(output_dir, exist_ok=True)
@@ -258,7 +363,12 @@ class ColmapGUI:
                 self.max_features_var.get(),
                 self.match_method_var.get(),
                 self.dense_var.get(),
-                self.use_gpu_var.get()
+                self.use_gpu_var.get(),
+                video_path,
+                self.mask_var.get(),
+                self.progressive_var.get(),
+                self.add_images_var.get(),
+                self.resume_var.get()
             )
         )
         self.reconstruction_thread.daemon = True
@@ -270,238 +380,65 @@ class ColmapGUI:
             self.cancel_flag = True
             self.log("Cancelling reconstruction...")
 
-    def run_reconstruction(self, image_dir, output_dir, max_image_size, max_features, match_method, dense, use_gpu):
-        """Run the reconstruction process"""
+    def run_reconstruction(self, image_dir, output_dir, max_image_size, max_features, match_method, dense, use_gpu, video_path="", mask_images=False, progressive=False, add_new_images=False, resume=False):
+        """Run the reconstruction process, with every Tk variable read beforehand on the main thread"""
         try:
-            # Set up database path
-            database_path = os.path.join(output_dir, "database.db")
-
-            # Create timer to measure performance
-            timer = pycolmap.Timer()
-            timer.start()
-
-            # Update progress
-            self.update_progress(5, "Setting up reconstruction...")
-
-            # Step 1: Feature extraction
-            self.log(f"Extracting features from images in {image_dir}")
-
-            # Configure feature extraction
-            sift_options = pycolmap.SiftExtractionOptions()
-            sift_options.max_num_features = max_features
-            sift_options.use_gpu = use_gpu
-
-            # Configure image reader
-            image_reader_options = pycolmap.ImageReaderOptions()
-            image_reader_options.camera_model = "RADIAL"
-            image_reader_options.single_camera_per_folder = False
-            image_reader_options.default_focal_length_factor = 1.2
-            image_reader_options.max_image_size = max_image_size
-
-            # Extract features
-            if self.cancel_flag:
-                self.finish_reconstruction(False)
-                return
-
-            pycolmap.extract_features(
-                database_path=database_path,
-                image_path=image_dir,
-                sift_options=sift_options,
-                image_reader_options=image_reader_options
-            )
-
-            # Update progress
-            self.update_progress(20, "Feature extraction completed")
-
-            # Step 2: Feature matching
-            self.log("Matching features between images")
-
-            if match_method == "exhaustive":
-                # Exhaustive matching (compare all image pairs)
-                match_options = pycolmap.ExhaustiveMatchingOptions()
-                pycolmap.match_exhaustive(
-                    database_path=database_path,
-                    match_options=match_options
-                )
-            elif match_method == "sequential":
-                # Sequential matching (for ordered image sequences)
-                match_options = pycolmap.SequentialMatchingOptions()
-                match_options.overlap = 10
-                pycolmap.match_sequential(
-                    database_path=database_path,
-                    match_options=match_options
-                )
-            elif match_method == "vocab_tree":
-                # Vocabulary tree matching (faster for large image sets)
-                match_options = pycolmap.VocabTreeMatchingOptions()
-                match_options.num_images = 50
-
-                # Check if vocab tree file exists
-                vocab_tree_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vocab_tree.bin")
-                if not os.path.exists(vocab_tree_path):
-                    self.log("Warning: vocab_tree.bin not found. Downloading...")
-                    # You would need to implement downloading the vocab tree file here
-                    # For now, fallback to exhaustive matching
-                    match_options = pycolmap.ExhaustiveMatchingOptions()
-                    pycolmap.match_exhaustive(
-                        database_path=database_path,
-                        match_options=match_options
-                    )
-                else:
-                    pycolmap.match_vocabtree(
-                        database_path=database_path,
-                        match_options=match_options,
-                        vocab_tree_path=vocab_tree_path
-                    )
-            elif match_method == "spatial":
-                # Spatial matching (for images with GPS data)
-                match_options = pycolmap.SpatialMatchingOptions()
-                match_options.max_num_neighbors = 50
-                pycolmap.match_spatial(
-                    database_path=database_path,
-                    match_options=match_options
+            options = dict(self.advanced_options)
+            options.update({
+                "max_image_size": max_image_size,
+                "max_num_features": max_features,
+                "match_method": match_method,
+                "dense": dense,
+                "use_gpu": use_gpu,
+                "mask_images": mask_images,
+                "video_path": video_path
+            })
+
+            if progressive and not add_new_images:
+                success = progressive_reconstruction(
+                    image_dir,
+                    output_dir,
+                    options,
+                    log=self.log,
+                    progress=self.update_progress,
+                    is_cancelled=lambda: self.cancel_flag,
+                    cache=self.stage_cache,
+                    on_preview=lambda preview: self.log_pump.call_soon(
+                        self.status_var.set, f"Preview ready in {preview.sparse_dir}, refining at full resolution"),
+                    resume=resume
                 )
-
-            # Verify matches to filter outliers
-            if self.cancel_flag:
-                self.finish_reconstruction(False)
-                return
-
-            pycolmap.verify_matches(database_path)
-
-            # Update progress
-            self.update_progress(40, "Feature matching completed")
-
-            # Step 3: Sparse reconstruction (Structure from Motion)
-            self.log("Performing incremental mapping (sparse reconstruction)")
-
-            # Configure mapper
-            mapper_options = pycolmap.IncrementalMapperOptions()
-            mapper_options.min_model_size = self.advanced_options["mapper_min_model_size"]
-            mapper_options.max_extra_param = self.advanced_options["mapper_max_extra_param"]
-
-            # Create reconstruction manager
-            reconstruction_manager = pycolmap.ReconstructionManager()
-
-            # Run incremental mapping
-            sparse_dir = os.path.join(output_dir, "sparse")
-            os.makedirs(sparse_dir, exist_ok=True)
-
-            if self.cancel_flag:
-                self.finish_reconstruction(False)
+                self.log_pump.call_soon(self.finish_reconstruction, success)
                 return
 
-            pycolmap.incremental_mapping(
-                database_path=database_path,
-                image_path=image_dir,
-                output_path=sparse_dir,
-                reconstruction_manager=reconstruction_manager,
-                mapper_options=mapper_options
+            pipeline = ReconstructionPipeline(
+                image_dir,
+                output_dir,
+                options,
+                log=self.log,
+                progress=self.update_progress,
+                is_cancelled=lambda: self.cancel_flag,
+                cache=self.stage_cache
             )
+            if add_new_images:
+                # Dense stages are redone on the updated model
+                success = add_images(pipeline) and pipeline.run(resume=True)
+            else:
+                success = pipeline.run(resume=resume)
 
-            if reconstruction_manager.size() == 0:
-                self.log("Reconstruction failed. No models were created.")
-                self.finish_reconstruction(False)
-                return
-
-            # Get the largest reconstruction
-            reconstruction = reconstruction_manager.get(0)
-            self.log(f"Sparse reconstruction completed with {reconstruction.num_points3D()} 3D points")
-
-            # Update progress
-            self.update_progress(70, "Sparse reconstruction completed")
-
-            # Step 4: Dense reconstruction (if requested)
-            if dense:
-                dense_dir = os.path.join(output_dir, "dense")
-                os.makedirs(dense_dir, exist_ok=True)
-
-                # Step 4.1: Undistort images
-                self.log("Undistorting images")
-                undistort_options = pycolmap.UndistortCameraOptions()
-                undistort_options.max_image_size = max_image_size
-
-                if self.cancel_flag:
-                    self.finish_reconstruction(False)
-                    return
-
-                pycolmap.undistort_images(
-                    output_path=dense_dir,
-                    image_path=image_dir,
-                    reconstruction=reconstruction,
-                    options=undistort_options
-                )
-
-                # Update progress
-                self.update_progress(80, "Images undistorted")
-
-                # Step 4.2: Patch match stereo
-                self.log("Running patch match stereo")
-                patch_match_options = pycolmap.PatchMatchOptions()
-                patch_match_options.gpu_index = "0" if use_gpu else "-1"
-                patch_match_options.window_radius = self.advanced_options["patch_match_window_radius"]
-                patch_match_options.window_step = self.advanced_options["patch_match_window_step"]
-
-                if self.cancel_flag:
-                    self.finish_reconstruction(False)
-                    return
-
-                pycolmap.patch_match_stereo(
-                    workspace_path=dense_dir,
-                    options=patch_match_options
-                )
-
-                # Update progress
-                self.update_progress(90, "Patch match stereo completed")
-
-                # Step 4.3: Stereo fusion
-                self.log("Performing stereo fusion")
-                fusion_options = pycolmap.StereoFusionOptions()
-                fusion_options.min_num_pixels = self.advanced_options["fusion_min_num_pixels"]
-
-                if self.cancel_flag:
-                    self.finish_reconstruction(False)
-                    return
-
-                pycolmap.stereo_fusion(
-                    workspace_path=dense_dir,
-                    output_path=os.path.join(dense_dir, "fused.ply"),
-                    options=fusion_options
-                )
-
-                # Step 4.4: Meshing (create a textured mesh)
-                self.log("Creating mesh from point cloud")
-                meshing_options = pycolmap.PoissonMeshingOptions()
-                meshing_options.trim = self.advanced_options["meshing_trim"]
-
-                if self.cancel_flag:
-                    self.finish_reconstruction(False)
-                    return
-
-                pycolmap.poisson_meshing(
-                    input_path=os.path.join(dense_dir, "fused.ply"),
-                    output_path=os.path.join(dense_dir, "meshed.ply"),
-                    options=meshing_options
-                )
-
-            # Stop timer and print elapsed time
-            timer.pause()
-            self.log(f"Total execution time: {timer.elapsed_seconds():.2f} seconds")
-
-            # Update progress
-            self.update_progress(100, "Reconstruction completed successfully")
-
-            # Show success message
-            self.finish_reconstruction(True)
+            # Show result message
+            self.log_pump.call_soon(self.finish_reconstruction, success)
 
         except Exception as e:
             self.log(f"Error: {str(e)}")
-            self.finish_reconstruction(False)
-
-    def update_progress(self, value, message):
-        """Update progress bar and log message"""
-        self.progress_var.set(value)
-        self.log(message)
+            self.log_pump.call_soon(self.finish_reconstruction, False)
+
+    def update_progress(self, value, message=None, status=None):
+        """Update progress bar, stage status and log message"""
+        self.log_pump.call_soon(self.progress_var.set, value)
+        if status is not None:
+            self.log_pump.call_soon(self.status_var.set, status)
+        if message:
+            self.log(message)
 
     def finish_reconstruction(self, success):
         """Finish the reconstruction process"""
@@ -0,0 +1,97 @@
+import os
+import cv2
+import numpy as np
+from stage_runner import run_in_pool
+
+DEFAULT_MASK_OPTIONS = {
+    "mask_center_fraction": 0.7,
+    "mask_dilation": 0.02,
+}
+
+# Images are segmented at this size, masks are upsampled back to the image size
+SEGMENTATION_SIZE = 640
+GRABCUT_ITERATIONS = 5
+
+# Below this foreground fraction the segmentation failed and the image is left unmasked
+MIN_FOREGROUND_FRACTION = 0.02
+
+
+def mask_path(mask_dir, image_name):
+    """Mask location COLMAP looks up for an image"""
+    return os.path.join(mask_dir, image_name + ".png")
+
+
+def segment_object(image, center_fraction, dilation):
+    """Foreground mask (255 on the object) of the object in the central region of a BGR image, or None"""
+    height, width = image.shape[:2]
+    scale = min(1.0, SEGMENTATION_SIZE / max(height, width))
+    if scale < 1.0:
+        image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+    small_height, small_width = image.shape[:2]
+
+    # Everything outside the central rectangle seeds the background model
+    margin_x = round(small_width * (1 - center_fraction) / 2)
+    margin_y = round(small_height * (1 - center_fraction) / 2)
+    rect = (margin_x, margin_y, small_width - 2 * margin_x, small_height - 2 * margin_y)
+    labels = np.zeros((small_height, small_width), np.uint8)
+    background_model = np.zeros((1, 65), np.float64)
+    foreground_model = np.zeros((1, 65), np.float64)
+    cv2.grabCut(image, labels, rect, background_model, foreground_model, GRABCUT_ITERATIONS,
+                cv2.GC_INIT_WITH_RECT)
+    foreground = ((labels == cv2.GC_FGD) | (labels == cv2.GC_PR_FGD)).astype(np.uint8)
+
+    # The object is the largest blob, grown so its silhouette keeps some context
+    count, components, stats, _ = cv2.connectedComponentsWithStats(foreground, connectivity=8)
+    if count > 1:
+        foreground = (components == 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])).astype(np.uint8)
+    radius = max(1, round(dilation * max(small_height, small_width)))
+    foreground = cv2.dilate(foreground, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1,) * 2))
+    if foreground.mean() < MIN_FOREGROUND_FRACTION:
+        return None
+    return cv2.resize(foreground * 255, (width, height), interpolation=cv2.INTER_NEAREST)
+
+
+def mask_image(image_path, output_path, center_fraction, dilation):
+    """Worker entry point writing the mask of one image, returns its foreground fraction or None"""
+    # Images are spread over processes, not threads
+    cv2.setNumThreads(1)
+    image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    mask = segment_object(image, center_fraction, dilation)
+    if mask is None:
+        # Without a mask file COLMAP uses the whole image
+        return None
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = output_path + ".tmp.png"
+    cv2.imwrite(tmp_path, mask)
+    os.replace(tmp_path, output_path)
+    return float(np.count_nonzero(mask)) / mask.size
+
+
+def create_masks(image_dir, mask_dir, image_names, options=None, num_workers=1, is_cancelled=None):
+    """Masks of the given images, in a process pool when num_workers > 1, returns the foreground fractions"""
+    settings = dict(DEFAULT_MASK_OPTIONS)
+    if options:
+        settings.update({key: options[key] for key in DEFAULT_MASK_OPTIONS if key in options})
+    is_cancelled = is_cancelled or (lambda: False)
+    tasks = [(os.path.join(image_dir, name), mask_path(mask_dir, name), settings["mask_center_fraction"],
+              settings["mask_dilation"]) for name in image_names]
+    os.makedirs(mask_dir, exist_ok=True)
+
+    fractions = [None] * len(tasks)
+    if num_workers <= 1:
+        # Daemon stage workers cannot start a pool of their own
+        for index, task in enumerate(tasks):
+            if is_cancelled():
+                return None
+            fractions[index] = mask_image(*task)
+        return fractions
+
+    def on_masked(index, fraction):
+        fractions[index] = fraction
+
+    if not run_in_pool(mask_image, tasks, min(num_workers, max(1, len(tasks))), is_cancelled, on_masked):
+        return None
+    return fractions
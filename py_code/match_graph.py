@@ -0,0 +1,138 @@
+import os
+import json
+import numpy as np
+import colmap_db
+
+DEFAULT_PRUNING_OPTIONS = {
+    "min_num_matches": 15,
+    "prune_min_degree": 2,
+    "prune_duplicate_overlap": 0.5,
+    "mapper_min_model_size": 10,
+}
+
+MATCH_GRAPH_NAME = "match_graph.json"
+
+
+def connected_components(num_nodes, nodes1, nodes2):
+    """Component label of each node, the smallest node index of its component"""
+    labels = np.arange(num_nodes)
+    while True:
+        # Propagate the smallest label along every edge, then shortcut label chains
+        smallest = np.minimum(labels[nodes1], labels[nodes2])
+        previous = labels.copy()
+        np.minimum.at(labels, nodes1, smallest)
+        np.minimum.at(labels, nodes2, smallest)
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def drop_weak_images(num_images, nodes1, nodes2, dropped, min_degree, min_model_size):
+    """Drop weakly connected images and components too small to form a model, until none are left"""
+    while True:
+        kept = np.ones(num_images, dtype=bool)
+        kept[list(dropped)] = False
+        # Only the edges between images still kept count
+        edges = kept[nodes1] & kept[nodes2]
+        kept_nodes1, kept_nodes2 = nodes1[edges], nodes2[edges]
+        degree = np.bincount(kept_nodes1, minlength=num_images) + np.bincount(kept_nodes2, minlength=num_images)
+        labels = connected_components(num_images, kept_nodes1, kept_nodes2)
+        component_sizes = np.bincount(labels[kept], minlength=num_images)
+
+        num_dropped = len(dropped)
+        for node in np.flatnonzero(kept).tolist():
+            if degree[node] < min_degree:
+                dropped[node] = "weakly connected"
+            elif component_sizes[labels[node]] < min_model_size:
+                dropped[node] = "small component"
+        if len(dropped) == num_dropped:
+            return dropped
+
+
+def load_match_graph(database_path, min_num_matches):
+    """(image names, node index pairs, inlier counts, keypoint counts) of the verified pairs"""
+    connection = colmap_db.connect(database_path)
+    image_ids = colmap_db.read_images(connection)
+    keypoint_counts = colmap_db.read_keypoint_counts(connection)
+    image_id1, image_id2, num_inliers, _ = colmap_db.read_two_view_geometry_arrays(connection)
+    connection.close()
+
+    names = sorted(image_ids, key=image_ids.get)
+    ids = np.array([image_ids[name] for name in names], dtype=np.int64)
+    keypoints = np.array([keypoint_counts.get(image_id, 0) for image_id in ids], dtype=np.int64)
+
+    # Image ids are mapped to dense node indices
+    nodes1 = np.searchsorted(ids, image_id1)
+    nodes2 = np.searchsorted(ids, image_id2)
+    strong = num_inliers >= min_num_matches
+    return names, nodes1[strong], nodes2[strong], num_inliers[strong], keypoints
+
+
+def analyze_match_graph(database_path, options=None):
+    """Connectivity report of the verified match graph with the images to keep for mapping"""
+    settings = dict(DEFAULT_PRUNING_OPTIONS)
+    if options:
+        settings.update({key: options[key] for key in DEFAULT_PRUNING_OPTIONS if key in options})
+
+    names, nodes1, nodes2, num_inliers, keypoints = load_match_graph(database_path, settings["min_num_matches"])
+    num_images = len(names)
+    degree = np.bincount(nodes1, minlength=num_images) + np.bincount(nodes2, minlength=num_images)
+    strength = np.bincount(nodes1, weights=num_inliers, minlength=num_images) \
+        + np.bincount(nodes2, weights=num_inliers, minlength=num_images)
+    labels = connected_components(num_images, nodes1, nodes2)
+    component_sizes = np.bincount(labels, minlength=num_images)
+
+    # Same bound as the mapper, which keeps smaller models on small datasets
+    min_model_size = min(settings["mapper_min_model_size"], 0.8 * num_images)
+    dropped = {}
+
+    # Step 1: Weakly connected images and components too small to form a model
+    drop_weak_images(num_images, nodes1, nodes2, dropped, settings["prune_min_degree"], min_model_size)
+
+    # Step 2: Near duplicates, most overlapping pairs first, dropping the less connected image of each
+    overlap = num_inliers / np.maximum(np.minimum(keypoints[nodes1], keypoints[nodes2]), 1)
+    for edge in np.argsort(-overlap):
+        if overlap[edge] < settings["prune_duplicate_overlap"]:
+            break
+        node1, node2 = nodes1[edge], nodes2[edge]
+        if node1 in dropped or node2 in dropped:
+            continue
+        duplicate, kept = (node1, node2) if strength[node1] < strength[node2] else (node2, node1)
+        dropped[duplicate] = f"near duplicate of {names[kept]}"
+
+    # Step 3: Images left weakly connected, or in a component split too small, by the removed duplicates
+    drop_weak_images(num_images, nodes1, nodes2, dropped, settings["prune_min_degree"], min_model_size)
+
+    component_ids = {label: index for index, label in enumerate(np.argsort(-component_sizes))}
+    return {
+        "num_images": num_images,
+        "num_pairs": int(len(nodes1)),
+        "components": sorted((int(size) for size in component_sizes[component_sizes > 0]), reverse=True),
+        "images": {
+            name: {
+                "component": component_ids[labels[node]],
+                "degree": int(degree[node]),
+                "inliers": int(strength[node]),
+            }
+            for node, name in enumerate(names)
+        },
+        "kept": [name for node, name in enumerate(names) if node not in dropped],
+        "dropped": {names[node]: reason for node, reason in sorted(dropped.items())},
+    }
+
+
+def write_match_graph(path, report):
+    """Atomically write a match graph report"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_kept_images(path):
+    """Images kept for mapping by a previous analysis, or None"""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)["kept"]
+    except (OSError, ValueError, KeyError):
+        return None
@@ -0,0 +1,158 @@
+import os
+from collections import OrderedDict
+import numpy as np
+import pycolmap
+import colmap_db
+
+DEFAULT_PAIR_MATCHING_OPTIONS = {
+    "max_ratio": 0.8,
+    "max_distance": 0.7,
+    "cross_check": True,
+    "min_num_matches": 15,
+}
+
+# Number of descriptor sets kept in memory while matching pairs
+DESCRIPTOR_CACHE_SIZE = 256
+
+# Descriptors of the first image matched at once, bounding the similarity block to 1024 x N2 float32 values
+MATCH_CHUNK_ROWS = 1024
+
+
+def normalize_descriptors(descriptors):
+    """Convert uint8 SIFT descriptors to unit-length float32 rows"""
+    descriptors = descriptors.astype(np.float32)
+    norms = np.linalg.norm(descriptors, axis=1, keepdims=True)
+    return descriptors / np.maximum(norms, 1e-12)
+
+
+def match_descriptors(descriptors1, descriptors2, max_ratio=0.8, max_distance=0.7, cross_check=True):
+    """Nearest neighbour matching with ratio test, returns a (N, 2) array of indices"""
+    if len(descriptors1) < 2 or len(descriptors2) < 2:
+        return np.zeros((0, 2), dtype=np.uint32)
+
+    # Rows are processed in chunks so that only MATCH_CHUNK_ROWS x N2 similarities exist at once
+    best_index = np.empty(len(descriptors1), dtype=np.int64)
+    best_similarity = np.empty(len(descriptors1), dtype=np.float32)
+    second_similarity = np.empty(len(descriptors1), dtype=np.float32)
+    column_best_similarity = np.full(len(descriptors2), -np.inf, dtype=np.float32)
+    column_best_index = np.zeros(len(descriptors2), dtype=np.int64)
+    for start in range(0, len(descriptors1), MATCH_CHUNK_ROWS):
+        end = min(start + MATCH_CHUNK_ROWS, len(descriptors1))
+        similarity = descriptors1[start:end] @ descriptors2.T
+        rows = np.arange(end - start)
+
+        if cross_check:
+            chunk_column_best = np.argmax(similarity, axis=0)
+            chunk_column_similarity = similarity[chunk_column_best, np.arange(len(descriptors2))]
+            better = chunk_column_similarity > column_best_similarity
+            column_best_similarity[better] = chunk_column_similarity[better]
+            column_best_index[better] = chunk_column_best[better] + start
+
+        # The best match is masked in place to find the second best
+        best = np.argmax(similarity, axis=1)
+        best_index[start:end] = best
+        best_similarity[start:end] = similarity[rows, best]
+        similarity[rows, best] = -np.inf
+        second_similarity[start:end] = similarity.max(axis=1)
+
+    # Angular distances between unit descriptors, as in COLMAP's SIFT matcher
+    best_distance = np.arccos(np.clip(best_similarity, -1.0, 1.0))
+    second_distance = np.arccos(np.clip(second_similarity, -1.0, 1.0))
+    keep = (best_distance <= max_distance) & (best_distance < max_ratio * second_distance)
+
+    indices1 = np.nonzero(keep)[0]
+    indices2 = best_index[keep]
+
+    if cross_check and len(indices1) > 0:
+        mutual = column_best_index[indices2] == indices1
+        indices1 = indices1[mutual]
+        indices2 = indices2[mutual]
+
+    return np.stack([indices1, indices2], axis=1).astype(np.uint32)
+
+
+def write_pairs_file(path, pairs):
+    """Write image name pairs in COLMAP's match list format"""
+    with open(path, "w") as f:
+        for name1, name2 in pairs:
+            f.write(f"{name1} {name2}\n")
+
+
+def read_pairs_file(path):
+    """Read image name pairs written by write_pairs_file"""
+    pairs = []
+    with open(path, "r") as f:
+        for line in f:
+            names = line.split()
+            if len(names) == 2:
+                pairs.append((names[0], names[1]))
+    return pairs
+
+
+def match_image_pairs(database_path, pairs, output_dir, options=None, log=print, is_cancelled=None):
+    """Match only the given image name pairs, then verify them geometrically"""
+    match_options = dict(DEFAULT_PAIR_MATCHING_OPTIONS)
+    if options:
+        match_options.update({key: options[key] for key in DEFAULT_PAIR_MATCHING_OPTIONS if key in options})
+    is_cancelled = is_cancelled or (lambda: False)
+
+    connection = colmap_db.connect(database_path)
+    image_ids = colmap_db.read_images(connection)
+    already_matched = colmap_db.read_matched_pair_ids(connection)
+
+    # Pairs files may name images that are not in this database
+    unknown = sorted({name for pair in pairs for name in pair if name not in image_ids})
+    if unknown:
+        log(f"Skipping the pairs of {len(unknown)} images missing from the database: {', '.join(unknown[:10])}"
+            + (" ..." if len(unknown) > 10 else ""))
+    pairs = [
+        (name1, name2) for name1, name2 in pairs
+        if name1 in image_ids and name2 in image_ids
+        and int(colmap_db.image_ids_to_pair_id(image_ids[name1], image_ids[name2])) not in already_matched
+    ]
+    log(f"Matching {len(pairs)} image pairs")
+
+    # Group pairs by first image so each of its descriptor sets is loaded once
+    partners = {}
+    for name1, name2 in pairs:
+        partners.setdefault(name1, []).append(name2)
+
+    # Bounded LRU of normalized descriptors for the partner images
+    descriptor_cache = OrderedDict()
+
+    def descriptors(name):
+        if name in descriptor_cache:
+            descriptor_cache.move_to_end(name)
+        else:
+            descriptor_cache[name] = normalize_descriptors(colmap_db.read_descriptors(connection, image_ids[name]))
+            if len(descriptor_cache) > DESCRIPTOR_CACHE_SIZE:
+                descriptor_cache.popitem(last=False)
+        return descriptor_cache[name]
+
+    num_matched = 0
+    for name1, names2 in partners.items():
+        if is_cancelled():
+            connection.close()
+            return False
+        descriptors1 = descriptors(name1)
+        for name2 in names2:
+            matches = match_descriptors(
+                descriptors1,
+                descriptors(name2),
+                match_options["max_ratio"],
+                match_options["max_distance"],
+                match_options["cross_check"]
+            )
+            if len(matches) < match_options["min_num_matches"]:
+                matches = matches[:0]
+            colmap_db.write_matches(connection, image_ids[name1], image_ids[name2], matches)
+            num_matched += 1
+        connection.commit()
+    connection.close()
+
+    # Geometric verification restricted to the matched pairs
+    pairs_path = os.path.join(output_dir, "match_pairs.txt")
+    write_pairs_file(pairs_path, pairs)
+    pycolmap.verify_matches(database_path, pairs_path)
+    log(f"Matched and verified {num_matched} image pairs")
+    return True
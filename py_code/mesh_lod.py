@@ -0,0 +1,457 @@
+import os
+import json
+import shutil
+import struct
+import argparse
+import numpy as np
+from point_cloud import PLY_TYPES, CHUNK_SIZE, chunks, xyz
+
+# Triangle budgets of the levels of detail, from the finest
+DEFAULT_TRIANGLE_BUDGETS = [1000000, 250000, 50000]
+
+# Positions are quantized on this many bits per axis, which also bounds the clustering grid
+POSITION_BITS = 16
+MAX_RESOLUTION = 2 ** POSITION_BITS - 1
+
+# A level within this fraction under its budget ends the grid search
+BUDGET_TOLERANCE = 0.05
+MAX_SEARCH_STEPS = 16
+
+# Counting stops past this multiple of the budget, so grids that are far too fine never fill the memory
+SEARCH_LIMIT = 4
+
+# Quadric eigenvalues below this fraction of the largest are ignored when placing a vertex
+EIGENVALUE_CUTOFF = 1e-3
+
+LOD_MANIFEST_NAME = "lod.json"
+
+# glTF constants
+GLB_MAGIC = 0x46546C67
+GLB_JSON_CHUNK = 0x4E4F534A
+GLB_BIN_CHUNK = 0x004E4942
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+COMPONENT_TYPES = {"i1": 5120, "u1": 5121, "i2": 5122, "u2": 5123, "u4": 5125, "f4": 5126}
+
+
+def read_ply_mesh(path):
+    """Read-only memory maps of the vertices and (N, 3) triangle indices of a binary PLY mesh"""
+    elements = []
+    with open(path, "rb") as f:
+        if f.readline().strip() != b"ply":
+            raise ValueError(f"{path} is not a PLY file")
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f"{path} has no end_header line")
+            words = line.decode("ascii").split()
+            if not words or words[0] in ("comment", "obj_info"):
+                continue
+            if words[0] == "format" and words[1] != "binary_little_endian":
+                raise ValueError(f"{path} is {words[1]}, only binary_little_endian PLY files are supported")
+            elif words[0] == "element":
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == "property" and words[1] == "list":
+                # Triangle meshes store 3 indices after each list count
+                elements[-1][2].extend([(words[4] + "_count", PLY_TYPES[words[2]]),
+                                        (words[4], PLY_TYPES[words[3]], (3,))])
+            elif words[0] == "property":
+                elements[-1][2].append((words[2], PLY_TYPES[words[1]]))
+            elif words[0] == "end_header":
+                break
+        offset = f.tell()
+
+    arrays = {}
+    for name, count, fields in elements:
+        dtype = np.dtype(fields)
+        arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,)) if count \
+            else np.zeros(0, dtype=dtype)
+        offset += count * dtype.itemsize
+    if "vertex" not in arrays or "face" not in arrays:
+        raise ValueError(f"{path} is not a mesh")
+    faces = arrays["face"]
+    index_field = [field for field in faces.dtype.names if not field.endswith("_count")][0]
+    return arrays["vertex"], faces, index_field
+
+
+def has_colors(vertices):
+    """Whether PLY vertices carry RGB colors"""
+    return all(name in vertices.dtype.names for name in ("red", "green", "blue"))
+
+
+def face_chunks(faces, index_field):
+    """In-memory (N, 3) int64 index chunks of the faces, checking that they are triangles"""
+    for chunk in chunks(faces):
+        if np.any(chunk[index_field + "_count"] != 3):
+            raise ValueError("Only triangle meshes can be simplified")
+        yield chunk[index_field].astype(np.int64)
+
+
+def plane_quadrics(points, normals):
+    """Area weighted quadrics of the planes of triangles, from a corner and the cross product of two edges"""
+    double_areas = np.linalg.norm(normals, axis=1)
+    normals = normals / np.maximum(double_areas, 1e-300)[:, None]
+    planes = np.concatenate([normals, -(normals * points).sum(axis=1, keepdims=True)], axis=1)
+    quadrics = np.empty((len(planes), 10))
+    for column, (row, col) in enumerate(zip(*np.triu_indices(4))):
+        quadrics[:, column] = planes[:, row] * planes[:, col] * double_areas / 2
+    return quadrics
+
+
+def grid_cell_size(extent, resolution):
+    """Side of the cubic cells splitting the longest side of the extent into resolution cells"""
+    return max(extent.max(), 1e-12) / resolution
+
+
+def cell_keys(points, low, cell_size, resolution):
+    """Flat index of the grid cell of each point"""
+    cells = np.clip(np.floor((points - low) / cell_size), 0, resolution - 1).astype(np.int64)
+    return cells[:, 0] + resolution * (cells[:, 1] + resolution * cells[:, 2])
+
+
+def unique_triangles(triangles, num_cells):
+    """Triangles without degenerate or repeated ones, keeping the first orientation met"""
+    triangles = triangles[(triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2])
+                          & (triangles[:, 0] != triangles[:, 2])]
+    corners = np.sort(triangles, axis=1)
+    if num_cells ** 3 < 2 ** 63:
+        # Sorting single integer keys is much faster than sorting rows
+        _, first = np.unique(corners[:, 0] + num_cells * (corners[:, 1] + num_cells * corners[:, 2]),
+                             return_index=True)
+    else:
+        _, first = np.unique(corners, axis=0, return_index=True)
+    return triangles[np.sort(first)]
+
+
+def merge_sums(sums, index, values, size):
+    """Add rows of values to the sums of their index"""
+    for column in range(values.shape[1]):
+        sums[:, column] += np.bincount(index, weights=values[:, column], minlength=size)
+
+
+class ClusteredMesh:
+    """Mesh whose vertices carry the quadrics, surface normals, position sums and counts of the vertices merged
+    into them"""
+
+    def __init__(self, quadrics, normal_sums, position_sums, counts, color_sums, faces, keys, low, cell_size,
+                 resolution):
+        self.quadrics = quadrics
+        self.normal_sums = normal_sums
+        self.position_sums = position_sums
+        self.counts = counts
+        self.color_sums = color_sums
+        self.faces = faces
+        self.resolution = resolution
+        self.positions = self.place_vertices(keys, low, cell_size)
+        self.remove_folds()
+        self.drop_unused_vertices()
+
+    def place_vertices(self, keys, low, cell_size):
+        """Point of each cell minimizing its quadric error, kept inside the cell"""
+        means = self.position_sums / self.counts[:, None]
+        q = self.quadrics
+        matrices = np.stack([q[:, [0, 1, 2]], q[:, [1, 4, 5]], q[:, [2, 5, 7]]], axis=1)
+        vectors = q[:, [3, 6, 8]]
+        # Truncated pseudo-inverse around the mean, flat directions keep the mean
+        values, bases = np.linalg.eigh(matrices)
+        residuals = -vectors - np.einsum("nij,nj->ni", matrices, means)
+        projected = np.einsum("nji,nj->ni", bases, residuals)
+        keep = values > EIGENVALUE_CUTOFF * np.maximum(values[:, -1:], 1e-300)
+        projected = np.where(keep, projected / np.where(keep, values, 1.0), 0.0)
+        positions = means + np.einsum("nij,nj->ni", bases, projected)
+
+        resolution = self.resolution
+        cells = np.stack([keys % resolution, keys // resolution % resolution, keys // resolution ** 2], axis=1)
+        cell_low = low + cells * cell_size
+        return np.clip(positions, cell_low, cell_low + cell_size)
+
+    def remove_folds(self):
+        """Drop the triangles facing away from the surface they replace, folded over by the clustering"""
+        corners = self.positions[self.faces]
+        normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        surface_normals = self.normal_sums[self.faces].sum(axis=1)
+        self.faces = self.faces[(normals * surface_normals).sum(axis=1) > 0]
+
+    def drop_unused_vertices(self):
+        """Remove the vertices of cells left without triangles"""
+        used = np.zeros(len(self.counts), dtype=bool)
+        used[self.faces.ravel()] = True
+        remap = np.cumsum(used) - 1
+        for name in ("quadrics", "normal_sums", "position_sums", "counts", "color_sums", "positions"):
+            values = getattr(self, name)
+            if values is not None:
+                setattr(self, name, values[used])
+        self.faces = remap[self.faces]
+
+    def cluster(self, low, cell_size, resolution):
+        """Coarser mesh merging the vertices of each cell of another grid, quadrics add up"""
+        keys, inverse = np.unique(cell_keys(self.positions, low, cell_size, resolution), return_inverse=True)
+        size = len(keys)
+        quadrics = np.zeros((size, 10))
+        merge_sums(quadrics, inverse, self.quadrics, size)
+        normal_sums = np.zeros((size, 3))
+        merge_sums(normal_sums, inverse, self.normal_sums, size)
+        position_sums = np.zeros((size, 3))
+        merge_sums(position_sums, inverse, self.position_sums, size)
+        counts = np.bincount(inverse, weights=self.counts, minlength=size)
+        color_sums = None
+        if self.color_sums is not None:
+            color_sums = np.zeros((size, 3))
+            merge_sums(color_sums, inverse, self.color_sums, size)
+        faces = unique_triangles(inverse[self.faces], size)
+        return ClusteredMesh(quadrics, normal_sums, position_sums, counts, color_sums, faces, keys, low, cell_size,
+                             resolution)
+
+    def count_triangles(self, low, cell_size, resolution, limit):
+        """Number of triangles left by clustering on a grid"""
+        keys, inverse = np.unique(cell_keys(self.positions, low, cell_size, resolution), return_inverse=True)
+        return len(unique_triangles(inverse[self.faces], len(keys)))
+
+    def normals(self):
+        """Unit vertex normals of the full resolution surface"""
+        return self.normal_sums / np.maximum(np.linalg.norm(self.normal_sums, axis=1, keepdims=True), 1e-300)
+
+    def colors(self):
+        """Mean 8 bit color of each vertex, or None"""
+        if self.color_sums is None:
+            return None
+        return np.clip(np.round(self.color_sums / self.counts[:, None]), 0, 255).astype(np.uint8)
+
+
+class SourceMesh:
+    """Full resolution PLY mesh, clustered one chunk at a time"""
+
+    def __init__(self, path, work_dir):
+        self.vertices, self.faces, self.index_field = read_ply_mesh(path)
+        self.work_dir = work_dir
+        self.colored = has_colors(self.vertices)
+        self.low = np.full(3, np.inf)
+        self.high = np.full(3, -np.inf)
+        for chunk in chunks(self.vertices):
+            points = xyz(chunk)
+            self.low = np.minimum(self.low, points.min(axis=0))
+            self.high = np.maximum(self.high, points.max(axis=0))
+
+    def assign_cells(self, cell_size, resolution, limit=None):
+        """Sorted occupied cell keys and the cell of every vertex in a memory mapped file, None past limit cells"""
+        keys = np.zeros(0, dtype=np.int64)
+        for chunk in chunks(self.vertices):
+            keys = np.union1d(keys, cell_keys(xyz(chunk), self.low, cell_size, resolution))
+            if limit is not None and 2 * len(keys) > limit:
+                return keys, None
+        cell_index = np.lib.format.open_memmap(os.path.join(self.work_dir, "cells.npy"), mode="w+",
+                                               dtype=np.int64, shape=(len(self.vertices),))
+        for start in range(0, len(self.vertices), CHUNK_SIZE):
+            points = xyz(np.array(self.vertices[start:start + CHUNK_SIZE]))
+            cell_index[start:start + len(points)] = np.searchsorted(
+                keys, cell_keys(points, self.low, cell_size, resolution))
+        return keys, cell_index
+
+    def clustered_triangles(self, cell_index, num_cells, limit=None):
+        """Triangles left between the cells, stopping once there are more than limit"""
+        triangles = np.zeros((0, 3), dtype=np.int64)
+        for indices in face_chunks(self.faces, self.index_field):
+            chunk_triangles = unique_triangles(cell_index[indices], num_cells)
+            triangles = unique_triangles(np.concatenate([triangles, chunk_triangles]), num_cells)
+            if limit is not None and len(triangles) > limit:
+                break
+        return triangles
+
+    def count_triangles(self, low, cell_size, resolution, limit):
+        keys, cell_index = self.assign_cells(cell_size, resolution, limit)
+        if cell_index is None:
+            # A surface keeps about two triangles per cell
+            return 2 * len(keys)
+        count = len(self.clustered_triangles(cell_index, len(keys), limit))
+        del cell_index
+        return count
+
+    def cluster(self, low, cell_size, resolution):
+        """Mesh of one vertex per occupied cell, with the quadrics of the triangles touching the cell"""
+        keys, cell_index = self.assign_cells(cell_size, resolution)
+        size = len(keys)
+        position_sums = np.zeros((size, 3))
+        color_sums = np.zeros((size, 3)) if self.colored else None
+        counts = np.zeros(size)
+        for start in range(0, len(self.vertices), CHUNK_SIZE):
+            chunk = np.array(self.vertices[start:start + CHUNK_SIZE])
+            index = np.asarray(cell_index[start:start + len(chunk)])
+            merge_sums(position_sums, index, xyz(chunk), size)
+            counts += np.bincount(index, minlength=size)
+            if self.colored:
+                merge_sums(color_sums, index, np.stack([chunk["red"], chunk["green"], chunk["blue"]], axis=1)
+                           .astype(np.float64), size)
+
+        # Every triangle adds its plane and its area weighted normal to the cells of its three corners
+        quadrics = np.zeros((size, 10))
+        normal_sums = np.zeros((size, 3))
+        for indices in face_chunks(self.faces, self.index_field):
+            corners = [xyz(self.vertices[indices[:, corner]]) for corner in range(3)]
+            normals = np.cross(corners[1] - corners[0], corners[2] - corners[0])
+            face_quadrics = plane_quadrics(corners[0], normals)
+            for corner in range(3):
+                index = np.asarray(cell_index[indices[:, corner]])
+                merge_sums(quadrics, index, face_quadrics, size)
+                merge_sums(normal_sums, index, normals, size)
+        faces = self.clustered_triangles(cell_index, size)
+        del cell_index
+        return ClusteredMesh(quadrics, normal_sums, position_sums, counts, color_sums, faces, keys, low, cell_size,
+                             resolution)
+
+
+def search_resolution(count_triangles, budget, max_resolution, log=print):
+    """Finest grid resolution whose clustering stays within the triangle budget"""
+    below, above = 1, max_resolution + 1
+    target = (1 - BUDGET_TOLERANCE / 2) * budget
+    resolution = min(max_resolution, max(1, round((target / 2) ** 0.5)))
+    for _ in range(MAX_SEARCH_STEPS):
+        count = count_triangles(resolution)
+        log(f"Grid of {resolution} cells: {count} triangles")
+        if count <= budget:
+            below = resolution
+            if count >= (1 - BUDGET_TOLERANCE) * budget:
+                break
+        else:
+            above = resolution
+        if above - below <= 1:
+            break
+        # Surfaces keep about resolution squared triangles, the next guess stays inside the bracket
+        guess = round(resolution * (target / max(count, 1)) ** 0.5)
+        resolution = min(max(guess, below + 1), above - 1)
+    return below
+
+
+def write_glb(path, mesh, low, extent):
+    """Binary glTF mesh with 16 bit positions and 8 bit normals (KHR_mesh_quantization)"""
+    step = np.maximum(extent, 1e-12) / MAX_RESOLUTION
+    quantized = np.zeros((len(mesh.positions), 4), dtype=np.uint16)
+    quantized[:, :3] = np.clip(np.round((mesh.positions - low) / step), 0, MAX_RESOLUTION)
+    normals = np.zeros((len(mesh.positions), 4), dtype=np.int8)
+    normals[:, :3] = np.round(mesh.normals() * 127)
+    index_type = np.uint16 if len(mesh.positions) <= 0xFFFF else np.uint32
+    attributes = [("POSITION", quantized, "VEC3", False), ("NORMAL", normals, "VEC3", True)]
+    colors = mesh.colors()
+    if colors is not None:
+        padded = np.zeros((len(colors), 4), dtype=np.uint8)
+        padded[:, :3] = colors
+        attributes.append(("COLOR_0", padded, "VEC3", True))
+
+    # Vertex attributes are padded to 4 byte strides, every view starts on a 4 byte boundary
+    blobs, views, accessors, primitive = [], [], [], {"attributes": {}, "mode": 4}
+    offset = 0
+    for name, values, kind, normalized in attributes + [("indices", mesh.faces.astype(index_type).ravel(),
+                                                         "SCALAR", False)]:
+        data = values.tobytes()
+        view = {"buffer": 0, "byteOffset": offset, "byteLength": len(data)}
+        if name == "indices":
+            view["target"] = ELEMENT_ARRAY_BUFFER
+        else:
+            view["target"] = ARRAY_BUFFER
+            view["byteStride"] = values.strides[0]
+        accessor = {"bufferView": len(views), "componentType": COMPONENT_TYPES[values.dtype.str[1:]],
+                    "count": len(values), "type": kind}
+        if normalized:
+            accessor["normalized"] = True
+        if name == "POSITION":
+            accessor["min"] = quantized[:, :3].min(axis=0).tolist() if len(quantized) else [0, 0, 0]
+            accessor["max"] = quantized[:, :3].max(axis=0).tolist() if len(quantized) else [0, 0, 0]
+        views.append(view)
+        if name == "indices":
+            primitive["indices"] = len(accessors)
+        else:
+            primitive["attributes"][name] = len(accessors)
+        accessors.append(accessor)
+        blobs.append(data + b"\0" * (-len(data) % 4))
+        offset += len(blobs[-1])
+
+    document = {
+        "asset": {"version": "2.0", "generator": "project_COLMAP mesh_lod"},
+        "extensionsUsed": ["KHR_mesh_quantization"],
+        "extensionsRequired": ["KHR_mesh_quantization"],
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        # The node transform turns the quantized positions back into model units
+        "nodes": [{"mesh": 0, "translation": low.tolist(), "scale": step.tolist()}],
+        "meshes": [{"primitives": [primitive]}],
+        "buffers": [{"byteLength": offset}],
+        "bufferViews": views,
+        "accessors": accessors,
+    }
+    header = json.dumps(document, separators=(",", ":")).encode("utf-8")
+    header += b" " * (-len(header) % 4)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<III", GLB_MAGIC, 2, 12 + 8 + len(header) + 8 + offset))
+        f.write(struct.pack("<II", len(header), GLB_JSON_CHUNK))
+        f.write(header)
+        f.write(struct.pack("<II", offset, GLB_BIN_CHUNK))
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_path, path)
+
+
+def build_mesh_lods(mesh_path, output_dir, budgets=None, log=print, is_cancelled=None, work_dir=None):
+    """Write a chain of simplified levels of a PLY mesh as quantized glTF files, returns the levels or None"""
+    is_cancelled = is_cancelled or (lambda: False)
+    budgets = sorted(budgets or DEFAULT_TRIANGLE_BUDGETS, reverse=True)
+    work_dir = work_dir or output_dir + ".work"
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    try:
+        source = SourceMesh(mesh_path, work_dir)
+        extent = source.high - source.low
+        low = source.low
+        log(f"Simplifying {len(source.faces)} triangles into {len(budgets)} levels of detail")
+
+        levels = []
+        mesh, max_resolution = source, MAX_RESOLUTION
+        for level, budget in enumerate(budgets):
+            if is_cancelled():
+                return None
+            # Step 1: Finest grid keeping the level under its budget, each level clusters the previous one
+            resolution = search_resolution(
+                lambda r: mesh.count_triangles(low, grid_cell_size(extent, r), r, SEARCH_LIMIT * budget), budget,
+                max_resolution, log=log)
+            if is_cancelled():
+                return None
+            mesh = mesh.cluster(low, grid_cell_size(extent, resolution), resolution)
+            max_resolution = resolution
+
+            # Step 2: Quantized binary output
+            name = f"lod{level}.glb"
+            write_glb(os.path.join(output_dir, name), mesh, low, extent)
+            levels.append({
+                "file": name,
+                "triangle_budget": budget,
+                "triangles": len(mesh.faces),
+                "vertices": len(mesh.positions),
+                "grid_resolution": resolution,
+            })
+            log(f"Level {level}: {len(mesh.faces)} triangles, {len(mesh.positions)} vertices")
+
+        manifest = {
+            "source": os.path.abspath(mesh_path),
+            "source_triangles": len(source.faces),
+            "bounds": [low.tolist(), source.high.tolist()],
+            "position_bits": POSITION_BITS,
+            "levels": levels,
+        }
+        with open(os.path.join(output_dir, LOD_MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f, indent=2)
+        return levels
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write levels of detail of a PLY mesh as quantized glTF files")
+    parser.add_argument("mesh", help="Binary PLY triangle mesh, such as dense/meshed.ply")
+    parser.add_argument("output_dir")
+    parser.add_argument("--budgets", type=int, nargs="+", default=DEFAULT_TRIANGLE_BUDGETS,
+                        help="Triangle budget of each level")
+    args = parser.parse_args()
+    build_mesh_lods(args.mesh, args.output_dir, args.budgets)
+
+if __name__ == "__main__":
+    main()
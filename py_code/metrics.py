@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory then falls back to None
+    resource = None
+
+
+def read_proc_fields(path):
+    """Parse a 'key: value' file from /proc, or return an empty dict"""
+    fields = {}
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                fields[key.strip()] = value.strip()
+    except OSError:
+        pass
+    return fields
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process where the platform allows it (Linux)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+# ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+RUSAGE_UNIT = 1024 ** 2 if sys.platform == "darwin" else 1024
+
+
+def self_peak_rss_mb():
+    """Peak resident set size of this process alone, in MB"""
+    status = read_proc_fields("/proc/self/status")
+    if "VmHWM" in status:
+        # Reported in kB, and resettable between stages
+        return int(status["VmHWM"].split()[0]) / 1024
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / RUSAGE_UNIT
+    return None
+
+
+def children_peak_rss_mb():
+    """Largest peak resident set size of the finished children of this process, in MB, over its lifetime"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / RUSAGE_UNIT
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and its children, in MB"""
+    peak = self_peak_rss_mb()
+    children_peak = children_peak_rss_mb()
+    if peak is None or children_peak is None:
+        return peak
+    return max(peak, children_peak)
+
+
+def io_bytes():
+    """(read, written) storage bytes of this process, or (None, None) when unavailable"""
+    fields = read_proc_fields("/proc/self/io")
+    if "read_bytes" not in fields:
+        return None, None
+    return int(fields["read_bytes"]), int(fields["write_bytes"])
+
+
+def process_usage():
+    """Peak memory and I/O of this process and its finished children, sent back by stage workers"""
+    read_bytes, write_bytes = io_bytes()
+    return {"peak_rss_mb": peak_rss_mb(), "read_bytes": read_bytes, "write_bytes": write_bytes}
+
+
+def cpu_seconds():
+    """User plus system CPU time of this process and its finished children"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class RunMetrics:
+    """Per-stage wall time, CPU time, peak memory, I/O and throughput of a run"""
+
+    def __init__(self, run_info=None):
+        self.run_info = dict(run_info or {})
+        self.stages = []
+        # Scores against a reference model, see evaluation.py
+        self.quality = None
+        # Disk footprint of the output directory at the end of the run
+        self.storage = None
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the enclosed block as one stage, yielding its record
+
+        A stage run in a worker process stores process_usage() of the worker as record["worker_usage"]
+        """
+        record = {"stage": name, "start": time.time(), "thread_id": threading.get_ident()}
+        has_peak_reset = reset_peak_rss()
+        children_peak_start = children_peak_rss_mb()
+        read_start, write_start = io_bytes()
+        cpu_start = cpu_seconds()
+        wall_start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_time"] = time.perf_counter() - wall_start
+            record["cpu_time"] = cpu_seconds() - cpu_start
+            worker_usage = record.pop("worker_usage", None)
+            # Without a reset the peak covers the whole process lifetime
+            peak = self_peak_rss_mb()
+            children_peak = children_peak_rss_mb()
+            # The children peak is a lifetime maximum, it only belongs to this stage if it grew during it
+            if peak is not None and children_peak is not None and children_peak > children_peak_start:
+                peak = max(peak, children_peak)
+            per_stage = has_peak_reset
+            read_end, write_end = io_bytes()
+            if read_start is not None and read_end is not None:
+                record["read_bytes"] = read_end - read_start
+                record["write_bytes"] = write_end - write_start
+            else:
+                record["read_bytes"] = None
+                record["write_bytes"] = None
+            if worker_usage is not None:
+                # A fresh worker measures the stage alone, including the pools it started
+                if worker_usage["peak_rss_mb"] is not None:
+                    # The parent peak only counts when it was reset at the start of the stage
+                    parent_peak = peak if has_peak_reset and peak is not None else 0
+                    peak = max(parent_peak, worker_usage["peak_rss_mb"])
+                    per_stage = True
+                if worker_usage["read_bytes"] is not None:
+                    record["read_bytes"] = worker_usage["read_bytes"]
+                    record["write_bytes"] = worker_usage["write_bytes"]
+            record["peak_rss_mb"] = peak
+            record["peak_rss_is_per_stage"] = per_stage
+            if record.get("items") is not None and record["wall_time"] > 0:
+                record["throughput"] = record["items"] / record["wall_time"]
+            with self.lock:
+                self.stages.append(record)
+
+    def stage_record(self, name):
+        """Last record of a stage, or None"""
+        for record in reversed(self.stages):
+            if record["stage"] == name:
+                return record
+        return None
+
+    def summary(self):
+        """Machine-readable metrics of the run"""
+        peaks = [record["peak_rss_mb"] for record in self.stages if record["peak_rss_mb"] is not None]
+        return {
+            "run": self.run_info,
+            "start": self.start_time,
+            "total_wall_time": sum(record["wall_time"] for record in self.stages),
+            "total_cpu_time": sum(record["cpu_time"] for record in self.stages),
+            "peak_rss_mb": max(peaks) if peaks else None,
+            "stages": self.stages,
+            "quality": self.quality,
+            "storage": self.storage,
+        }
+
+    def write_json(self, path):
+        """Write the metrics summary as JSON"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    def write_chrome_trace(self, path):
+        """Write the stages as complete events of the Chrome trace format"""
+        events = []
+        for record in self.stages:
+            args = {key: value for key, value in record.items()
+                    if key not in ("stage", "start", "wall_time", "thread_id")}
+            events.append({
+                "name": record["stage"],
+                "cat": "stage",
+                "ph": "X",
+                "ts": (record["start"] - self.start_time) * 1e6,
+                "dur": record["wall_time"] * 1e6,
+                "pid": os.getpid(),
+                "tid": record["thread_id"],
+                "args": args,
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def ply_element_count(path, element):
+    """Number of elements of a kind ('vertex', 'face') declared in a PLY header"""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        for raw_line in f:
+            line = raw_line.decode("ascii", errors="replace").strip()
+            if line.startswith(f"element {element} "):
+                return int(line.split()[2])
+            if line == "end_header":
+                break
+    return None
@@ -0,0 +1,235 @@
+import os
+import math
+import shutil
+import numpy as np
+import pycolmap
+from alignment import robust_umeyama
+from match_graph import connected_components, load_match_graph
+from stage_runner import run_in_pool
+
+# Shared registered images needed to align a cluster model onto the merged one
+MIN_SHARED_IMAGES = 3
+
+CLUSTERS_DIR_NAME = "sparse_clusters"
+
+
+def adjacency(num_nodes, nodes1, nodes2):
+    """Neighbour lists of an undirected graph in compressed sparse row form"""
+    sources = np.concatenate([nodes1, nodes2])
+    targets = np.concatenate([nodes2, nodes1])
+    order = np.argsort(sources, kind="stable")
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=num_nodes))])
+    return indptr, targets[order]
+
+
+def breadth_first_order(start, indptr, indices, num_nodes):
+    """Nodes in breadth-first order from start, unreachable nodes last"""
+    visited = np.zeros(num_nodes, dtype=bool)
+    order = []
+    for root in [start] + list(range(num_nodes)):
+        if visited[root]:
+            continue
+        visited[root] = True
+        frontier = [root]
+        while frontier:
+            order.extend(frontier)
+            neighbors = np.concatenate([indices[indptr[node]:indptr[node + 1]] for node in frontier])
+            neighbors = np.unique(neighbors[~visited[neighbors]])
+            visited[neighbors] = True
+            frontier = neighbors.tolist()
+    return np.array(order)
+
+
+def bisect(num_nodes, nodes1, nodes2):
+    """Split a graph in two halves by growing a region from a pseudo-peripheral node"""
+    indptr, indices = adjacency(num_nodes, nodes1, nodes2)
+    # The last node reached from anywhere lies on the periphery of the graph
+    start = breadth_first_order(0, indptr, indices, num_nodes)[-1]
+    order = breadth_first_order(int(start), indptr, indices, num_nodes)
+    half = num_nodes // 2
+    return order[:half], order[half:]
+
+
+def partition_graph(num_nodes, nodes1, nodes2, max_cluster_size):
+    """Split the graph into clusters of at most max_cluster_size connected nodes by recursive bisection"""
+    labels = connected_components(num_nodes, nodes1, nodes2)
+    pending = [np.nonzero(labels == label)[0] for label in np.unique(labels)]
+    clusters = []
+    while pending:
+        nodes = pending.pop()
+        if len(nodes) <= max_cluster_size:
+            clusters.append(nodes)
+            continue
+
+        # Edges inside the cluster, renumbered to local node indices
+        local = np.full(num_nodes, -1)
+        local[nodes] = np.arange(len(nodes))
+        inside = (local[nodes1] >= 0) & (local[nodes2] >= 0)
+        first, second = bisect(len(nodes), local[nodes1[inside]], local[nodes2[inside]])
+        pending.append(nodes[first])
+        pending.append(nodes[second])
+    return sorted(clusters, key=len, reverse=True)
+
+
+def add_overlap(clusters, num_nodes, nodes1, nodes2, weights, overlap):
+    """Grow every cluster with its most strongly connected outside images"""
+    membership = np.full(num_nodes, -1)
+    for index, nodes in enumerate(clusters):
+        membership[nodes] = index
+
+    expanded = []
+    for index, nodes in enumerate(clusters):
+        inside = membership == index
+        leaving1 = inside[nodes1] & ~inside[nodes2]
+        leaving2 = inside[nodes2] & ~inside[nodes1]
+        outside = np.concatenate([nodes2[leaving1], nodes1[leaving2]])
+        strength = np.bincount(outside, np.concatenate([weights[leaving1], weights[leaving2]]), num_nodes)
+
+        count = max(2 * MIN_SHARED_IMAGES, math.ceil(overlap * len(nodes)))
+        candidates = np.nonzero(strength)[0]
+        shared = candidates[np.argsort(-strength[candidates])[:count]]
+        expanded.append(np.concatenate([nodes, shared]))
+    return expanded
+
+
+def map_cluster(image_dir, output_dir, options, image_names, cluster_dir):
+    """Worker entry point mapping one cluster, returns the number of models"""
+    # Imported here because the pipeline module imports this one
+    from pipeline import ReconstructionPipeline
+
+    pipeline = ReconstructionPipeline(image_dir, output_dir, options, log=lambda message: None)
+    mapper_options = pipeline.mapper_options()
+    mapper_options.image_names = image_names
+
+    shutil.rmtree(cluster_dir, ignore_errors=True)
+    os.makedirs(cluster_dir)
+    reconstruction_manager = pycolmap.ReconstructionManager()
+    pycolmap.incremental_mapping(
+        database_path=pipeline.database_path,
+        image_path=image_dir,
+        output_path=cluster_dir,
+        reconstruction_manager=reconstruction_manager,
+        mapper_options=mapper_options
+    )
+    return reconstruction_manager.size()
+
+
+def camera_centers(reconstruction):
+    """Projection centers of the registered images, keyed by image name"""
+    centers = {}
+    for image_id in reconstruction.reg_image_ids():
+        image = reconstruction.images[image_id]
+        centers[image.name] = np.asarray(image.projection_center(), dtype=np.float64)
+    return centers
+
+
+def merge_models(models, log=print):
+    """Align the cluster models onto the largest one through their shared images and merge them"""
+    models = sorted(models, key=lambda model: model.num_reg_images(), reverse=True)
+    merged_centers = camera_centers(models[0])
+    aligned = [models[0]]
+    remaining = models[1:]
+
+    # Each step merges the cluster sharing the most images with the merged model
+    while remaining:
+        centers = [camera_centers(model) for model in remaining]
+        shared = [[name for name in model_centers if name in merged_centers] for model_centers in centers]
+        best = max(range(len(remaining)), key=lambda index: len(shared[index]))
+        if len(shared[best]) < MIN_SHARED_IMAGES:
+            log(f"{len(remaining)} cluster models share too few images with the merged model and are dropped")
+            break
+
+        names = shared[best]
+        scale, rotation, translation = robust_umeyama(
+            np.array([centers[best][name] for name in names]),
+            np.array([merged_centers[name] for name in names]),
+            MIN_SHARED_IMAGES
+        )
+        model = remaining.pop(best)
+        model.transform(pycolmap.Sim3d(scale, pycolmap.Rotation3d(rotation), translation))
+        for name, center in camera_centers(model).items():
+            merged_centers.setdefault(name, center)
+        aligned.append(model)
+
+    # Poses of the images mapped by several clusters come from the first aligned one
+    merged = pycolmap.Reconstruction()
+    for model in aligned:
+        for camera_id, camera in model.cameras.items():
+            if not merged.exists_camera(camera_id):
+                merged.add_camera(camera)
+        for image_id in model.reg_image_ids():
+            if merged.exists_image(image_id):
+                continue
+            image = model.images[image_id]
+            merged.add_image(pycolmap.Image(
+                name=image.name,
+                points2D=[pycolmap.Point2D(point.xy) for point in image.points2D],
+                cam_from_world=image.cam_from_world,
+                camera_id=image.camera_id,
+                id=image_id
+            ))
+            merged.register_image(image_id)
+    return merged
+
+
+def partitioned_mapping(pipeline):
+    """Map overlapping clusters of the match graph in parallel processes, then merge and refine them"""
+    log = pipeline.log
+    options = pipeline.options
+    names, nodes1, nodes2, num_inliers, _ = load_match_graph(pipeline.database_path, options["min_num_matches"])
+
+    # Only the images kept by the match graph pruning are mapped
+    kept = pipeline.mapping_image_names()
+    if kept:
+        kept_nodes = np.isin(np.array(names), kept)
+        edges = kept_nodes[nodes1] & kept_nodes[nodes2]
+        nodes1, nodes2, num_inliers = nodes1[edges], nodes2[edges], num_inliers[edges]
+    else:
+        kept_nodes = np.ones(len(names), dtype=bool)
+
+    weights = num_inliers.astype(np.float64)
+    clusters = partition_graph(len(names), nodes1, nodes2, options["max_cluster_size"])
+    clusters = [nodes for nodes in clusters if kept_nodes[nodes].all()]
+    clusters = add_overlap(clusters, len(names), nodes1, nodes2, weights, options["cluster_overlap"])
+    log(f"Mapping {len(clusters)} clusters of sizes {[len(nodes) for nodes in clusters[:10]]}")
+
+    # Threads are split between the cluster workers
+    total_threads = options["num_threads"] if options["num_threads"] > 0 else (os.cpu_count() or 1)
+    num_workers = max(1, min(len(clusters), total_threads))
+    worker_options = dict(options)
+    worker_options["num_threads"] = max(1, total_threads // num_workers)
+
+    clusters_dir = os.path.join(pipeline.output_dir, CLUSTERS_DIR_NAME)
+    cluster_dirs = [os.path.join(clusters_dir, str(index)) for index in range(len(clusters))]
+    def on_mapped(index, num_models):
+        log(f"Cluster {index + 1}/{len(clusters)} mapped into {num_models} models")
+        if pipeline.tracker is not None:
+            for _ in range(len(clusters[index])):
+                pipeline.tracker.increment()
+
+    tasks = [(pipeline.reader_image_dir(), pipeline.output_dir, worker_options, [names[node] for node in nodes], cluster_dir)
+             for nodes, cluster_dir in zip(clusters, cluster_dirs)]
+    if not run_in_pool(map_cluster, tasks, num_workers, pipeline.is_cancelled, on_mapped):
+        log("Reconstruction cancelled")
+        return False
+
+    models = [pycolmap.Reconstruction(os.path.join(cluster_dir, "0")) for cluster_dir in cluster_dirs
+              if os.path.isdir(os.path.join(cluster_dir, "0"))]
+    if not models:
+        log("Reconstruction failed. No cluster could be mapped.")
+        return False
+
+    merged = merge_models(models, log=log)
+    log(f"Merged {len(models)} cluster models into {merged.num_reg_images()} registered images")
+
+    # Points are triangulated again over all merged images, then refined together
+    output_path = os.path.join(pipeline.sparse_dir, "0")
+    shutil.rmtree(pipeline.sparse_dir, ignore_errors=True)
+    os.makedirs(output_path)
+    merged = pycolmap.triangulate_points(merged, pipeline.database_path, pipeline.reader_image_dir(), output_path)
+    pycolmap.bundle_adjustment(merged, pycolmap.BundleAdjustmentOptions())
+    merged.write(output_path)
+    shutil.rmtree(clusters_dir, ignore_errors=True)
+
+    log(f"Sparse reconstruction completed with {merged.num_points3D()} 3D points")
+    return True
@@ -0,0 +1,1407 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import numpy as np
+import pycolmap
+import colmap_db
+from cache import StageCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE
+from evaluation import evaluate, load_points, read_transform
+from add_images import add_images, list_image_names
+from matching import match_image_pairs, read_pairs_file
+from match_graph import analyze_match_graph, write_match_graph, read_kept_images, MATCH_GRAPH_NAME
+from mesh_lod import build_mesh_lods, DEFAULT_TRIANGLE_BUDGETS, LOD_MANIFEST_NAME
+from metrics import RunMetrics, ply_element_count
+from partitioned_mapping import partitioned_mapping, CLUSTERS_DIR_NAME
+from point_cloud import filter_point_cloud, sparse_bounding_box
+from progress import ProgressTracker, ThroughputHistory
+from retrieval import RetrievalIndex, retrieval_pairs, INDEX_NAME
+from sparse_export import export_reconstruction, SparseColumns, COLUMNS_DIR_NAME, COLUMNS_MANIFEST_NAME
+from stage_runner import run_stage_in_process
+from storage import footprint, release_dense_intermediates, restore_maps, DISCARDED_OUTPUTS, RETENTION_POLICIES
+
+# Ordered list of the reconstruction stages
+STAGES = [
+    "extract_keyframes",
+    "prepare_images",
+    "mask_images",
+    "extract_features",
+    "match_features",
+    "prune_match_graph",
+    "incremental_mapping",
+    "export_sparse_model",
+    "undistort_images",
+    "patch_match_stereo",
+    "stereo_fusion",
+    "filter_point_cloud",
+    "poisson_meshing",
+    "mesh_lod",
+]
+
+# Stages that only run when dense reconstruction is requested
+DENSE_STAGES = STAGES[STAGES.index("undistort_images"):]
+
+# Stages wrapping long pycolmap calls, run in a worker process that can be killed on cancel
+ISOLATED_STAGES = STAGES[1:]
+
+# Stages storing their outputs in the cache item by item, rather than as a whole
+ITEM_CACHED_STAGES = ["prepare_images"]
+
+# Options each stage depends on, used to decide whether a checkpoint is still valid
+STAGE_OPTION_KEYS = {
+    "extract_keyframes": [
+        "video_path",
+        "keyframe_analysis_width",
+        "keyframe_min_sharpness",
+        "keyframe_blur_ratio",
+        "keyframe_min_motion",
+        "keyframe_min_overlap",
+        "keyframe_window",
+        "keyframe_jpeg_quality",
+    ],
+    "prepare_images": ["max_image_size"],
+    "mask_images": ["mask_center_fraction", "mask_dilation"],
+    "extract_features": ["max_image_size", "max_num_features", "use_gpu", "prepare_images", "mask_images"],
+    "match_features": [
+        "match_method",
+        "min_num_matches",
+        "retrieval_num_neighbors",
+        "retrieval_sequential_overlap",
+        "match_pairs_path",
+    ],
+    "prune_match_graph": ["min_num_matches", "prune_min_degree", "prune_duplicate_overlap", "mapper_min_model_size"],
+    "incremental_mapping": [
+        "mapper_min_model_size",
+        "mapper_max_extra_param",
+        "partition_mapping",
+        "max_cluster_size",
+        "cluster_overlap",
+        "pose_prior_path",
+        "prune_images",
+    ],
+    "export_sparse_model": [],
+    "undistort_images": ["max_image_size", "mask_images", "mask_center_fraction", "mask_dilation"],
+    "patch_match_stereo": [
+        "use_gpu",
+        "patch_match_window_radius",
+        "patch_match_window_step",
+        "cpu_stereo_max_image_size",
+        "cpu_stereo_num_depths",
+        "cpu_stereo_num_sources",
+    ],
+    "stereo_fusion": ["use_gpu", "fusion_min_num_pixels", "mask_images"],
+    "filter_point_cloud": ["crop_point_cloud", "crop_margin", "voxel_size", "outlier_min_neighbors"],
+    "poisson_meshing": ["meshing_trim", "filter_points"],
+    "mesh_lod": ["lod_triangle_budgets"],
+}
+
+# Unit of the work items counted for each stage's throughput
+STAGE_ITEM_UNITS = {
+    "extract_keyframes": "keyframes",
+    "prepare_images": "images",
+    "mask_images": "masks",
+    "extract_features": "images",
+    "match_features": "pairs",
+    "prune_match_graph": "kept images",
+    "incremental_mapping": "registered images",
+    "export_sparse_model": "points",
+    "undistort_images": "images",
+    "patch_match_stereo": "depth maps",
+    "stereo_fusion": "points",
+    "filter_point_cloud": "kept points",
+    "poisson_meshing": "faces",
+    "mesh_lod": "levels",
+}
+
+# Stages whose item count is in the unit of stage_work_total, so the throughput history learns from the work
+# actually done rather than from the expected total
+WORK_ITEM_STAGES = {"prepare_images", "mask_images", "extract_features", "match_features", "incremental_mapping",
+                    "undistort_images", "patch_match_stereo"}
+
+# Minimum delay between two progress lines in headless runs
+STATUS_LOG_INTERVAL = 30.0
+
+DEFAULT_OPTIONS = {
+    "video_path": "",
+    "max_image_size": 2000,
+    "max_num_features": 8000,
+    "match_method": "exhaustive",
+    "dense": True,
+    "prepare_images": False,
+    "mask_images": False,
+    "mask_center_fraction": 0.7,
+    "mask_dilation": 0.02,
+    "use_gpu": True,
+    "min_num_matches": 15,
+    "retrieval_num_neighbors": 50,
+    "retrieval_sequential_overlap": 10,
+    "match_pairs_path": "",
+    "prune_images": True,
+    "prune_min_degree": 2,
+    "prune_duplicate_overlap": 0.5,
+    "mapper_min_model_size": 10,
+    "mapper_max_extra_param": 1.0,
+    "partition_mapping": False,
+    "max_cluster_size": 300,
+    "cluster_overlap": 0.15,
+    "pose_prior_path": "",
+    "export_sparse": True,
+    "patch_match_window_radius": 5,
+    "patch_match_window_step": 1,
+    "cpu_stereo_max_image_size": 1000,
+    "cpu_stereo_num_depths": 128,
+    "cpu_stereo_num_sources": 4,
+    "fusion_min_num_pixels": 5,
+    "filter_points": True,
+    "crop_point_cloud": True,
+    "crop_margin": 0.1,
+    "voxel_size": 0.0,
+    "outlier_min_neighbors": 6,
+    "meshing_trim": 7,
+    "mesh_lod": True,
+    "lod_triangle_budgets": list(DEFAULT_TRIANGLE_BUDGETS),
+    "retention": "keep",
+    "reference_model": "",
+    "reference_alignment": "",
+    "evaluation_thresholds": [],
+    "trace": False,
+    "isolate_stages": True,
+    "num_threads": -1,
+}
+
+MATCH_METHODS = ("exhaustive", "sequential", "vocab_tree", "spatial")
+
+MANIFEST_NAME = "pipeline_manifest.json"
+METRICS_NAME = "metrics.json"
+TRACE_NAME = "trace.json"
+
+
+class ReconstructionPipeline:
+    """Headless COLMAP reconstruction pipeline with a checkpoint manifest"""
+
+    def __init__(self, image_dir, output_dir, options=None, log=print, progress=None, is_cancelled=None, cache=None,
+                 history=None):
+        self.image_dir = image_dir
+        self.output_dir = output_dir
+        self.options = dict(DEFAULT_OPTIONS)
+        if options:
+            self.options.update(options)
+        self.log = log
+        self.progress = progress
+        self.is_cancelled = is_cancelled or (lambda: False)
+        self.cache = cache
+        self.history = history or ThroughputHistory()
+
+        # Workspace layout
+        self.database_path = os.path.join(output_dir, "database.db")
+        self.sparse_dir = os.path.join(output_dir, "sparse")
+        self.columns_dir = os.path.join(output_dir, COLUMNS_DIR_NAME)
+        self.dense_dir = os.path.join(output_dir, "dense")
+        self.fused_path = os.path.join(self.dense_dir, "fused.ply")
+        self.filtered_path = os.path.join(self.dense_dir, "filtered.ply")
+        self.meshed_path = os.path.join(self.dense_dir, "meshed.ply")
+        self.lod_dir = os.path.join(self.dense_dir, "lod")
+        self.prepared_dir = os.path.join(output_dir, "prepared_images")
+        self.camera_dir = os.path.join(output_dir, "prepared_cameras")
+        self.mask_dir = os.path.join(output_dir, "masks")
+        self.dense_mask_dir = os.path.join(self.dense_dir, "masks")
+        self.manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        self.match_graph_path = os.path.join(output_dir, MATCH_GRAPH_NAME)
+
+        self.manifest = None
+        self.metrics = None
+        self.tracker = None
+        self.last_status_log = 0.0
+        self.released_bytes = 0
+        # Peak memory and I/O reported by the worker of the last isolated stage, see stage_runner.py
+        self.worker_usage = None
+
+    def stages(self):
+        """Return the stages to run for the current options"""
+        stages = list(STAGES)
+        if not self.options["video_path"]:
+            stages.remove("extract_keyframes")
+        if not self.options["prepare_images"]:
+            stages.remove("prepare_images")
+        if not self.options["mask_images"]:
+            stages.remove("mask_images")
+        if not self.options["prune_images"]:
+            stages.remove("prune_match_graph")
+        if not self.options["export_sparse"]:
+            stages.remove("export_sparse_model")
+        if not self.options["filter_points"]:
+            stages.remove("filter_point_cloud")
+        if not self.options["mesh_lod"]:
+            stages.remove("mesh_lod")
+        if not self.options["dense"]:
+            stages = [stage for stage in stages if stage not in DENSE_STAGES]
+        return stages
+
+    def stage_options(self, stage):
+        """Return the subset of options a stage depends on"""
+        return {key: self.options.get(key) for key in STAGE_OPTION_KEYS[stage]}
+
+    def load_manifest(self):
+        """Load the checkpoint manifest, or return an empty one"""
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        return {"image_dir": self.image_dir, "stages": {}}
+
+    def save_manifest(self):
+        """Atomically write the checkpoint manifest"""
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def completed_stages(self):
+        """Return the leading stages whose checkpoints are still valid"""
+        completed = []
+        if self.manifest.get("image_dir") != self.image_dir:
+            return completed
+        for stage in self.stages():
+            entry = self.manifest["stages"].get(stage)
+            if not entry or entry.get("status") != "done":
+                break
+            if entry.get("options") != self.stage_options(stage):
+                break
+            completed.append(stage)
+        # Intermediates removed by the retention policy are produced again when a stage reading them is redone
+        while completed and len(completed) < len(self.stages()) and self.outputs_discarded(completed[-1]):
+            completed.pop()
+        return completed
+
+    def outputs_discarded(self, stage):
+        """Whether the retention policy removed the outputs of a finished stage"""
+        relative_path = DISCARDED_OUTPUTS.get(stage)
+        return relative_path is not None and not os.path.isdir(os.path.join(self.dense_dir, relative_path))
+
+    def update_progress(self, value, message=None, status=None):
+        """Report progress to the caller, or log it at a limited rate"""
+        if self.progress:
+            self.progress(value, message, status)
+            return
+        if message:
+            self.log(message)
+        if status and time.time() - self.last_status_log >= STATUS_LOG_INTERVAL:
+            self.last_status_log = time.time()
+            self.log(f"[{value:.0f}%] {status}")
+
+    def run(self, resume=False):
+        """Run all stages, returning True on success"""
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        # Create timer to measure performance
+        timer = pycolmap.Timer()
+        timer.start()
+
+        self.update_progress(0, "Setting up reconstruction...")
+
+        self.metrics = RunMetrics({"image_dir": self.image_dir, "output_dir": self.output_dir,
+                                   "options": self.options, "resume": resume})
+
+        self.manifest = self.load_manifest() if resume else {"image_dir": self.image_dir, "stages": {}}
+        completed = self.completed_stages() if resume else []
+        if completed:
+            self.log(f"Resuming after stage '{completed[-1]}'")
+
+        # Stages after the last valid checkpoint must be redone
+        self.manifest["image_dir"] = self.image_dir
+        for stage in STAGES:
+            if stage not in completed:
+                self.manifest["stages"].pop(stage, None)
+        self.save_manifest()
+
+        # Progress is weighted by the expected duration of every stage
+        self.tracker = ProgressTracker(self.stages(), self.history, self.update_progress)
+        for stage in self.stages():
+            self.tracker.set_total(stage, self.stage_work_total(stage))
+        self.tracker.start()
+        try:
+            success = self.run_stages(completed)
+        finally:
+            self.tracker.stop()
+        sizes = footprint(self.output_dir)
+        self.metrics.storage = {"total_bytes": sum(sizes.values()), "released_bytes": self.released_bytes,
+                                "footprint": sizes}
+        self.write_metrics()
+        if not success:
+            return False
+
+        if self.options["reference_model"]:
+            self.evaluate_model()
+
+        # Stop timer and print elapsed time
+        timer.pause()
+        self.log(f"Total execution time: {timer.elapsed_seconds():.2f} seconds")
+
+        self.update_progress(100, "Reconstruction completed successfully", "")
+        return True
+
+    def run_stages(self, completed):
+        """Run the stages not yet completed, returning True on success"""
+        upstream_key = None
+        for stage in self.stages():
+            # Keys chain through the upstream stages, so they are computed even for finished ones
+            key = self.cache_key(stage, upstream_key) if self.cache else None
+            upstream_key = key
+            if self.cache:
+                # New input digests are written once per stage rather than on every lookup
+                self.cache.flush_index()
+            if stage in completed:
+                self.tracker.skip_stage(stage)
+                continue
+
+            if self.is_cancelled():
+                self.log("Reconstruction cancelled")
+                return False
+
+            self.reset_stage(stage)
+
+            # Totals are refined now that the upstream outputs exist
+            self.tracker.set_total(stage, self.stage_work_total(stage))
+            self.tracker.start_stage(stage, self.stage_counter(stage))
+
+            with self.metrics.stage(stage) as record:
+                cacheable = key is not None and stage not in ITEM_CACHED_STAGES
+                cached = cacheable and self.cache.restore(key, self.stage_outputs(stage))
+                if cached:
+                    self.log(f"Reusing cached outputs of stage '{stage}'")
+                    success = True
+                else:
+                    self.worker_usage = None
+                    success = self.execute_stage(stage)
+                    record["worker_usage"] = self.worker_usage
+                    if success and cacheable:
+                        self.cache.store(key, self.stage_outputs(stage))
+
+                record["success"] = success
+                record["cached"] = cached
+                record["item_unit"] = STAGE_ITEM_UNITS[stage]
+                record["items"] = self.stage_item_count(stage) if success else None
+                record["workspace_bytes"] = sum(footprint(self.output_dir).values())
+            self.tracker.finish_stage(stage, items=record["items"] if stage in WORK_ITEM_STAGES else None,
+                                      measured=success and not cached)
+            self.write_metrics()
+            if not success:
+                return False
+
+            self.manifest["stages"][stage] = {
+                "status": "done",
+                "options": self.stage_options(stage),
+                "elapsed": record["wall_time"],
+                "cache_key": key,
+                "cached": cached,
+            }
+            self.save_manifest()
+            if not self.apply_retention(stage):
+                return False
+
+            percent, _, status = self.tracker.snapshot()
+            self.update_progress(percent, f"Stage '{stage}' completed", status)
+        return True
+
+    def execute_stage(self, stage):
+        """Run a stage, in a worker process when stage isolation is enabled"""
+        if self.options["isolate_stages"] and stage in ISOLATED_STAGES and not self.runs_own_workers(stage):
+            return run_stage_in_process(self, stage)
+        return getattr(self, stage)()
+
+    def apply_retention(self, stage):
+        """Compress or remove the intermediates a finished stage leaves unused, returns False if cancelled"""
+        policy = self.options["retention"]
+        if policy == "keep" or stage != "stereo_fusion":
+            return True
+        num_workers = self.options["num_threads"] if self.options["num_threads"] > 0 else (os.cpu_count() or 1)
+        released = release_dense_intermediates(self.dense_dir, policy, num_workers, self.is_cancelled, log=self.log)
+        if released is None:
+            self.log("Reconstruction cancelled")
+            return False
+        self.released_bytes += released
+        return True
+
+    def runs_own_workers(self, stage):
+        """Whether a stage supervises its own killable worker processes"""
+        if stage in ("prepare_images", "mask_images"):
+            return True
+        if stage == "patch_match_stereo":
+            return not self.options["use_gpu"]
+        return stage == "incremental_mapping" and self.partitioned()
+
+    def partitioned(self):
+        """Whether mapping is split into clusters for the current options and images"""
+        return self.options["partition_mapping"] and self.mapping_image_count() > self.options["max_cluster_size"]
+
+    def mapping_image_count(self):
+        """Number of images given to the mapper"""
+        image_names = self.mapping_image_names()
+        if image_names:
+            return len(image_names)
+        try:
+            return self.count_database_rows("SELECT COUNT(*) FROM images")
+        except sqlite3.Error:
+            return 0
+
+    def write_metrics(self):
+        """Write the metrics of the run, and the Chrome trace if requested"""
+        self.metrics.write_json(os.path.join(self.output_dir, METRICS_NAME))
+        if self.options["trace"]:
+            self.metrics.write_chrome_trace(os.path.join(self.output_dir, TRACE_NAME))
+
+    def evaluated_model(self):
+        """(path, points) of the most refined model of the run: mesh, dense cloud or sparse points"""
+        for stage, path in (("poisson_meshing", self.meshed_path), ("filter_point_cloud", self.filtered_path),
+                            ("stereo_fusion", self.fused_path)):
+            if stage in self.stages():
+                return path, load_points(path)
+        if "export_sparse_model" in self.stages():
+            return self.sparse_dir, np.asarray(SparseColumns(self.columns_dir).point_xyz, dtype=np.float32)
+        reconstruction = self.load_reconstruction()
+        points = [point.xyz for point in reconstruction.points3D.values()]
+        return self.sparse_dir, np.array(points, dtype=np.float32).reshape(-1, 3)
+
+    def evaluate_model(self):
+        """Score the model against the reference model, the scores join the run metrics"""
+        self.update_progress(100, "Evaluating the model against the reference...")
+        try:
+            with self.metrics.stage("evaluation"):
+                model_path, model_points = self.evaluated_model()
+                initial = read_transform(self.options["reference_alignment"]) \
+                    if self.options["reference_alignment"] else None
+                quality = evaluate(model_points, load_points(self.options["reference_model"]),
+                                   self.options["evaluation_thresholds"], initial, log=self.log)
+        except (OSError, ValueError) as e:
+            # The reconstruction itself succeeded
+            self.log(f"Evaluation failed: {str(e)}")
+            return
+
+        quality["model"] = model_path
+        quality["reference"] = os.path.abspath(self.options["reference_model"])
+        self.metrics.quality = quality
+        self.write_metrics()
+        scores = ", ".join(f"F-score {score['f_score']:.3f} at {score['threshold']:.4g}"
+                           for score in quality["thresholds"])
+        self.log(f"Chamfer distance {quality['chamfer_distance']:.4g}, {scores}")
+
+    def stage_item_count(self, stage):
+        """Number of work items produced by a finished stage"""
+        try:
+            if stage == "extract_keyframes":
+                return len([name for name in os.listdir(self.image_dir) if name.startswith("frame_")])
+            elif stage == "prepare_images":
+                return len(list_image_names(self.prepared_dir))
+            elif stage == "mask_images":
+                return len(os.listdir(self.mask_dir))
+            elif stage == "extract_features":
+                return self.count_database_rows("SELECT COUNT(*) FROM images")
+            elif stage == "match_features":
+                return self.count_database_rows("SELECT COUNT(*) FROM matches WHERE rows > 0")
+            elif stage == "prune_match_graph":
+                return len(read_kept_images(self.match_graph_path) or [])
+            elif stage == "incremental_mapping":
+                return self.load_reconstruction().num_reg_images()
+            elif stage == "export_sparse_model":
+                with open(os.path.join(self.columns_dir, COLUMNS_MANIFEST_NAME), "r") as f:
+                    return json.load(f)["num_points"]
+            elif stage == "undistort_images":
+                return len(os.listdir(os.path.join(self.dense_dir, "images")))
+            elif stage == "patch_match_stereo":
+                depth_dir = os.path.join(self.dense_dir, "stereo", "depth_maps")
+                # Each image has a photometric and/or a geometric map
+                return len({name.rsplit(".", 2)[0] for name in os.listdir(depth_dir)})
+            elif stage == "stereo_fusion":
+                return ply_element_count(self.fused_path, "vertex")
+            elif stage == "filter_point_cloud":
+                return ply_element_count(self.filtered_path, "vertex")
+            elif stage == "poisson_meshing":
+                return ply_element_count(self.meshed_path, "face")
+            elif stage == "mesh_lod":
+                with open(os.path.join(self.lod_dir, LOD_MANIFEST_NAME), "r") as f:
+                    return len(json.load(f)["levels"])
+        except (OSError, ValueError, sqlite3.Error):
+            return None
+        return None
+
+    def stage_work_total(self, stage):
+        """Expected number of work items of a stage, on which its throughput is measured"""
+        if stage == "extract_keyframes":
+            return 1
+        num_images = len(list_image_names(self.image_dir)) if os.path.isdir(self.image_dir) else 0
+        if stage in ("prepare_images", "mask_images", "extract_features", "prune_match_graph"):
+            return num_images
+        elif stage == "incremental_mapping":
+            return len(self.mapping_image_names() or []) or num_images
+        elif stage == "match_features":
+            return self.expected_num_pairs(num_images)
+        # Dense stages scale with the registered images
+        return self.registered_image_count() or num_images
+
+    def expected_num_pairs(self, num_images):
+        """Number of image pairs the selected matcher is expected to match"""
+        all_pairs = num_images * (num_images - 1) // 2
+        if self.options["match_pairs_path"]:
+            return len(read_pairs_file(self.options["match_pairs_path"]))
+        match_method = self.options["match_method"]
+        if match_method == "sequential":
+            return min(all_pairs, num_images * self.matching_options().overlap)
+        elif match_method == "vocab_tree":
+            num_pairs = num_images * self.options["retrieval_num_neighbors"]
+            if self.options["video_path"]:
+                num_pairs += num_images * self.options["retrieval_sequential_overlap"]
+            return min(all_pairs, num_pairs)
+        elif match_method == "spatial":
+            return min(all_pairs, num_images * self.matching_options().max_num_neighbors)
+        return all_pairs
+
+    def registered_image_count(self):
+        """Number of registered images of the sparse model, read from the images.bin header"""
+        images_path = os.path.join(self.sparse_dir, "0", "images.bin")
+        if not os.path.exists(images_path):
+            return None
+        with open(images_path, "rb") as f:
+            return int.from_bytes(f.read(8), "little")
+
+    def stage_counter(self, stage):
+        """Function polling the number of items done by a running stage, if observable"""
+        if stage == "prepare_images":
+            return lambda: len(list_image_names(self.prepared_dir)) if os.path.isdir(self.prepared_dir) else 0
+        elif stage == "mask_images":
+            return lambda: len(os.listdir(self.mask_dir)) if os.path.isdir(self.mask_dir) else 0
+        elif stage == "extract_features":
+            return lambda: self.count_database_rows("SELECT COUNT(*) FROM descriptors")
+        elif stage == "match_features":
+            return lambda: self.count_database_rows("SELECT COUNT(*) FROM matches")
+        elif stage == "undistort_images":
+            images_dir = os.path.join(self.dense_dir, "images")
+            return lambda: len(os.listdir(images_dir)) if os.path.isdir(images_dir) else 0
+        elif stage == "patch_match_stereo":
+            depth_dir = os.path.join(self.dense_dir, "stereo", "depth_maps")
+            return lambda: len([name for name in os.listdir(depth_dir) if name.endswith(".photometric.bin")]) \
+                if os.path.isdir(depth_dir) else 0
+        # Registered images are counted through the mapper callback
+        return None
+
+    def count_database_rows(self, query):
+        """Run a COUNT query on the database"""
+        connection = sqlite3.connect(self.database_path)
+        try:
+            return connection.execute(query).fetchone()[0]
+        finally:
+            connection.close()
+
+    def reset_stage(self, stage):
+        """Remove partial outputs left behind by a previous attempt of a stage"""
+        if stage == "extract_keyframes":
+            if os.path.isdir(self.image_dir):
+                from video import clear_keyframes
+                clear_keyframes(self.image_dir)
+        elif stage == "prepare_images":
+            shutil.rmtree(self.prepared_dir, ignore_errors=True)
+            shutil.rmtree(self.camera_dir, ignore_errors=True)
+        elif stage == "mask_images":
+            shutil.rmtree(self.mask_dir, ignore_errors=True)
+        elif stage == "extract_features":
+            if os.path.exists(self.database_path):
+                os.remove(self.database_path)
+        elif stage == "match_features":
+            connection = sqlite3.connect(self.database_path)
+            with connection:
+                for table in ("matches", "two_view_geometries"):
+                    try:
+                        connection.execute(f"DELETE FROM {table}")
+                    except sqlite3.OperationalError:
+                        pass
+            connection.close()
+        elif stage == "prune_match_graph":
+            if os.path.exists(self.match_graph_path):
+                os.remove(self.match_graph_path)
+        elif stage == "incremental_mapping":
+            shutil.rmtree(self.sparse_dir, ignore_errors=True)
+            shutil.rmtree(os.path.join(self.output_dir, CLUSTERS_DIR_NAME), ignore_errors=True)
+            shutil.rmtree(os.path.join(self.output_dir, "sparse_prior"), ignore_errors=True)
+        elif stage == "export_sparse_model":
+            shutil.rmtree(self.columns_dir, ignore_errors=True)
+            shutil.rmtree(self.columns_dir + ".tmp", ignore_errors=True)
+        elif stage == "undistort_images":
+            shutil.rmtree(self.dense_dir, ignore_errors=True)
+        elif stage == "patch_match_stereo":
+            for name in ("depth_maps", "normal_maps", "consistency_graphs"):
+                maps_dir = os.path.join(self.dense_dir, "stereo", name)
+                if os.path.isdir(maps_dir):
+                    for map_name in os.listdir(maps_dir):
+                        os.remove(os.path.join(maps_dir, map_name))
+        elif stage == "stereo_fusion":
+            if os.path.exists(self.fused_path):
+                os.remove(self.fused_path)
+        elif stage == "filter_point_cloud":
+            if os.path.exists(self.filtered_path):
+                os.remove(self.filtered_path)
+            shutil.rmtree(self.filtered_path + ".work", ignore_errors=True)
+        elif stage == "poisson_meshing":
+            if os.path.exists(self.meshed_path):
+                os.remove(self.meshed_path)
+        elif stage == "mesh_lod":
+            shutil.rmtree(self.lod_dir, ignore_errors=True)
+            shutil.rmtree(self.lod_dir + ".work", ignore_errors=True)
+
+    def load_reconstruction(self):
+        """Load the largest sparse model written by the mapping stage"""
+        return pycolmap.Reconstruction(os.path.join(self.sparse_dir, "0"))
+
+    def extract_keyframes(self):
+        """Step 0: Keyframe selection from the input video"""
+        # OpenCV is only required when the input is a video
+        from video import extract_keyframes
+
+        video_path = self.options["video_path"]
+        self.log(f"Selecting keyframes from video {video_path}")
+
+        keyframe_options = {key: value for key, value in self.stage_options("extract_keyframes").items()
+                            if value is not None}
+        num_keyframes = extract_keyframes(
+            video_path,
+            self.image_dir,
+            options=keyframe_options,
+            log=self.log,
+            is_cancelled=self.is_cancelled
+        )
+
+        if self.is_cancelled():
+            self.log("Reconstruction cancelled")
+            return False
+        if num_keyframes == 0:
+            self.log("No usable keyframes found in the video.")
+            return False
+        return True
+
+    def sift_extraction_options(self):
+        """Configure feature extraction"""
+        sift_options = pycolmap.SiftExtractionOptions()
+        sift_options.max_num_features = self.options["max_num_features"]
+        sift_options.use_gpu = self.options["use_gpu"]
+        sift_options.num_threads = self.options["num_threads"]
+        return sift_options
+
+    def sift_matching_options(self):
+        """Configure descriptor matching"""
+        sift_options = pycolmap.SiftMatchingOptions()
+        sift_options.use_gpu = self.options["use_gpu"]
+        sift_options.num_threads = self.options["num_threads"]
+        return sift_options
+
+    def image_reader_options(self):
+        """Configure image reader"""
+        image_reader_options = pycolmap.ImageReaderOptions()
+        image_reader_options.camera_model = "RADIAL"
+        image_reader_options.single_camera_per_folder = False
+        image_reader_options.default_focal_length_factor = 1.2
+        image_reader_options.max_image_size = self.options["max_image_size"]
+        if self.options["mask_images"]:
+            image_reader_options.mask_path = self.mask_dir
+        return image_reader_options
+
+    def matching_options(self):
+        """Configure the matcher selected by the match method"""
+        match_method = self.options["match_method"]
+        if match_method == "exhaustive":
+            return pycolmap.ExhaustiveMatchingOptions()
+        elif match_method == "sequential":
+            match_options = pycolmap.SequentialMatchingOptions()
+            match_options.overlap = 10
+            return match_options
+        elif match_method == "vocab_tree":
+            match_options = pycolmap.VocabTreeMatchingOptions()
+            match_options.num_images = self.options["retrieval_num_neighbors"]
+            return match_options
+        elif match_method == "spatial":
+            match_options = pycolmap.SpatialMatchingOptions()
+            match_options.max_num_neighbors = 50
+            return match_options
+        return None
+
+    def mapper_options(self):
+        """Configure mapper"""
+        mapper_options = pycolmap.IncrementalMapperOptions()
+        mapper_options.min_model_size = self.options["mapper_min_model_size"]
+        mapper_options.max_extra_param = self.options["mapper_max_extra_param"]
+        mapper_options.num_threads = self.options["num_threads"]
+        image_names = self.mapping_image_names()
+        if image_names:
+            mapper_options.image_names = image_names
+        return mapper_options
+
+    def mapping_image_names(self):
+        """Images kept by the match graph pruning, or None to map all images"""
+        if not self.options["prune_images"]:
+            return None
+        return read_kept_images(self.match_graph_path)
+
+    def undistort_options(self):
+        """Configure image undistortion"""
+        undistort_options = pycolmap.UndistortCameraOptions()
+        undistort_options.max_image_size = self.options["max_image_size"]
+        return undistort_options
+
+    def patch_match_options(self):
+        """Configure patch match stereo"""
+        patch_match_options = pycolmap.PatchMatchOptions()
+        patch_match_options.gpu_index = "0" if self.options["use_gpu"] else "-1"
+        patch_match_options.window_radius = self.options["patch_match_window_radius"]
+        patch_match_options.window_step = self.options["patch_match_window_step"]
+        patch_match_options.num_threads = self.options["num_threads"]
+        return patch_match_options
+
+    def fusion_options(self):
+        """Configure stereo fusion"""
+        fusion_options = pycolmap.StereoFusionOptions()
+        fusion_options.min_num_pixels = self.options["fusion_min_num_pixels"]
+        fusion_options.num_threads = self.options["num_threads"]
+        if self.options["mask_images"]:
+            fusion_options.mask_path = self.dense_mask_dir
+        return fusion_options
+
+    def fusion_input_type(self):
+        """Depth maps fused, the CPU backend only writes photometric ones"""
+        return "geometric" if self.options["use_gpu"] else "photometric"
+
+    def meshing_options(self):
+        """Configure Poisson meshing"""
+        meshing_options = pycolmap.PoissonMeshingOptions()
+        meshing_options.trim = self.options["meshing_trim"]
+        return meshing_options
+
+    def colmap_options(self, stage):
+        """Return the exact options objects passed to pycolmap by a stage"""
+        if stage in ("extract_keyframes", "prepare_images", "mask_images"):
+            return self.stage_options(stage)
+        elif stage == "extract_features":
+            return {"sift": self.sift_extraction_options(), "image_reader": self.image_reader_options()}
+        elif stage == "match_features":
+            options = {"method": self.options["match_method"], "sift": self.sift_matching_options(),
+                       "matching": self.matching_options()}
+            if self.options["match_pairs_path"]:
+                options["listed_pairs"] = True
+            elif self.options["match_method"] == "vocab_tree" and not os.path.exists(self.vocab_tree_path()):
+                options["retrieval"] = {
+                    "num_neighbors": self.options["retrieval_num_neighbors"],
+                    "sequential_overlap": self.options["retrieval_sequential_overlap"] if self.options["video_path"] else 0,
+                    "min_num_matches": self.options["min_num_matches"],
+                }
+            return options
+        elif stage == "prune_match_graph":
+            return self.stage_options(stage)
+        elif stage == "incremental_mapping":
+            options = {"mapper": self.mapper_options(), "pose_prior": bool(self.options["pose_prior_path"])}
+            if self.options["partition_mapping"]:
+                options["max_cluster_size"] = self.options["max_cluster_size"]
+                options["cluster_overlap"] = self.options["cluster_overlap"]
+            return options
+        elif stage == "export_sparse_model":
+            return self.stage_options(stage)
+        elif stage == "undistort_images":
+            return {"undistort": self.undistort_options()}
+        elif stage == "patch_match_stereo":
+            if not self.options["use_gpu"]:
+                return {"cpu_stereo": self.stage_options(stage)}
+            return {"patch_match": self.patch_match_options()}
+        elif stage == "stereo_fusion":
+            return {"fusion": self.fusion_options(), "input_type": self.fusion_input_type()}
+        elif stage == "filter_point_cloud":
+            return self.stage_options(stage)
+        elif stage == "poisson_meshing":
+            return {"meshing": self.meshing_options()}
+        elif stage == "mesh_lod":
+            return self.stage_options(stage)
+        return {}
+
+    def stage_inputs(self, stage):
+        """Return the external files a stage reads besides upstream outputs"""
+        if stage == "extract_keyframes":
+            return [self.options["video_path"]]
+        elif stage == "match_features" and self.options["match_pairs_path"]:
+            return [self.options["match_pairs_path"]]
+        elif stage == "match_features" and self.options["match_method"] == "vocab_tree":
+            return [self.vocab_tree_path()]
+        elif stage == "incremental_mapping" and self.options["pose_prior_path"]:
+            return [self.image_dir, self.options["pose_prior_path"]]
+        elif stage in ("prepare_images", "mask_images", "extract_features", "incremental_mapping",
+                       "undistort_images"):
+            return [self.image_dir]
+        return []
+
+    def stage_outputs(self, stage):
+        """Return the files and directories produced by a stage, keyed by cache name"""
+        if stage == "extract_keyframes":
+            return {"images": self.image_dir}
+        elif stage == "prepare_images":
+            return {"prepared_images": self.prepared_dir, "prepared_cameras": self.camera_dir}
+        elif stage == "mask_images":
+            return {"masks": self.mask_dir}
+        elif stage in ("extract_features", "match_features"):
+            return {"database.db": self.database_path}
+        elif stage == "prune_match_graph":
+            return {MATCH_GRAPH_NAME: self.match_graph_path}
+        elif stage == "incremental_mapping":
+            return {"sparse": self.sparse_dir}
+        elif stage == "export_sparse_model":
+            return {COLUMNS_DIR_NAME: self.columns_dir}
+        elif stage == "undistort_images":
+            return {"dense": self.dense_dir}
+        elif stage == "patch_match_stereo":
+            return {"stereo": os.path.join(self.dense_dir, "stereo")}
+        elif stage == "stereo_fusion":
+            return {"fused.ply": self.fused_path}
+        elif stage == "filter_point_cloud":
+            return {"filtered.ply": self.filtered_path}
+        elif stage == "poisson_meshing":
+            return {"meshed.ply": self.meshed_path}
+        elif stage == "mesh_lod":
+            return {"lod": self.lod_dir}
+        return {}
+
+    def cache_key(self, stage, upstream_key):
+        """Content-addressed key of a stage output"""
+        return self.cache.stage_key(stage, upstream_key, self.colmap_options(stage), self.stage_inputs(stage))
+
+    def vocab_tree_path(self):
+        """Location of the vocabulary tree used by vocab_tree matching"""
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), "vocab_tree.bin")
+
+    def reader_image_dir(self):
+        """Directory COLMAP reads the images from, the prepared copies when there are some"""
+        return self.prepared_dir if self.options["prepare_images"] else self.image_dir
+
+    def prepare_images(self, image_names=None):
+        """Step 0.1: Upright images downscaled once to the working size, shared between runs through the cache"""
+        # Pillow is only required when preparing images
+        from image_prep import prepare_images
+        if image_names is None:
+            image_names = list_image_names(self.image_dir)
+        self.log(f"Preparing {len(image_names)} images at {self.options['max_image_size']}px")
+
+        num_workers = self.options["num_threads"] if self.options["num_threads"] > 0 else (os.cpu_count() or 1)
+        cameras = prepare_images(self.image_dir, self.prepared_dir, self.camera_dir, image_names,
+                                 self.options["max_image_size"], self.cache, num_workers, self.is_cancelled, self.log)
+        if cameras is None:
+            self.log("Reconstruction cancelled")
+            return False
+        num_focal = len([camera for camera in cameras.values() if camera["focal_length"]])
+        self.log(f"EXIF focal length found for {num_focal} of {len(cameras)} images")
+        return True
+
+    def write_focal_lengths(self, image_names=None):
+        """Give the cameras of prepared images the focal length read from their EXIF data"""
+        from image_prep import read_cameras
+        connection = colmap_db.connect(self.database_path)
+        with connection:
+            image_cameras = colmap_db.read_image_cameras(connection)
+            names = [name for name in image_names or image_cameras if name in image_cameras]
+            for name, camera in read_cameras(self.camera_dir, names).items():
+                if camera["focal_length"]:
+                    colmap_db.write_focal_length(connection, image_cameras[name], camera["focal_length"])
+        connection.close()
+
+    def mask_images(self, image_names=None):
+        """Step 0.2: Object masks restricting features and fusion to the subject"""
+        # OpenCV is only required when masking
+        from masking import create_masks
+        if image_names is None:
+            image_names = list_image_names(self.image_dir)
+        self.log(f"Segmenting the object in {len(image_names)} images")
+
+        num_workers = self.options["num_threads"] if self.options["num_threads"] > 0 else (os.cpu_count() or 1)
+        fractions = create_masks(self.reader_image_dir(), self.mask_dir, image_names, self.options, num_workers,
+                                 self.is_cancelled)
+        if fractions is None:
+            self.log("Reconstruction cancelled")
+            return False
+        masked = [fraction for fraction in fractions if fraction is not None]
+        if masked:
+            self.log(f"Masked {len(masked)} images, the object covers {100 * sum(masked) / len(masked):.0f}% "
+                     f"of them on average")
+        if len(masked) < len(fractions):
+            self.log(f"No object found in {len(fractions) - len(masked)} images, they are used unmasked")
+        return True
+
+    def extract_features(self):
+        """Step 1: Feature extraction"""
+        self.log(f"Extracting features from images in {self.reader_image_dir()}")
+
+        pycolmap.extract_features(
+            database_path=self.database_path,
+            image_path=self.reader_image_dir(),
+            sift_options=self.sift_extraction_options(),
+            image_reader_options=self.image_reader_options()
+        )
+        if self.options["prepare_images"]:
+            # Prepared images carry no EXIF data for COLMAP to read the focal length from
+            self.write_focal_lengths()
+        return True
+
+    def match_features(self):
+        """Step 2: Feature matching and geometric verification"""
+        self.log("Matching features between images")
+
+        if self.options["match_pairs_path"]:
+            # Only the listed pairs, such as those co-visible in a preview model
+            return match_image_pairs(
+                self.database_path,
+                read_pairs_file(self.options["match_pairs_path"]),
+                self.output_dir,
+                options={"min_num_matches": self.options["min_num_matches"]},
+                log=self.log,
+                is_cancelled=self.is_cancelled
+            )
+
+        match_method = self.options["match_method"]
+        match_options = self.matching_options()
+        if match_method == "exhaustive":
+            # Exhaustive matching (compare all image pairs)
+            pycolmap.match_exhaustive(
+                database_path=self.database_path,
+                sift_options=self.sift_matching_options(),
+                match_options=match_options
+            )
+        elif match_method == "sequential":
+            # Sequential matching (for ordered image sequences)
+            pycolmap.match_sequential(
+                database_path=self.database_path,
+                sift_options=self.sift_matching_options(),
+                match_options=match_options
+            )
+        elif match_method == "vocab_tree":
+            # Vocabulary tree matching (faster for large image sets)
+            vocab_tree_path = self.vocab_tree_path()
+            if not os.path.exists(vocab_tree_path):
+                # Without a pretrained tree, retrieve pairs with a vocabulary trained on this dataset
+                return self.match_retrieval_pairs()
+            else:
+                pycolmap.match_vocabtree(
+                    database_path=self.database_path,
+                    sift_options=self.sift_matching_options(),
+                    match_options=match_options,
+                    vocab_tree_path=vocab_tree_path
+                )
+        elif match_method == "spatial":
+            # Spatial matching (for images with GPS data)
+            pycolmap.match_spatial(
+                database_path=self.database_path,
+                sift_options=self.sift_matching_options(),
+                match_options=match_options
+            )
+        else:
+            self.log(f"Unknown matching method: {match_method}")
+            return False
+
+        # Verify matches to filter outliers
+        if self.is_cancelled():
+            self.log("Reconstruction cancelled")
+            return False
+
+        pycolmap.verify_matches(self.database_path)
+        return True
+
+    def match_retrieval_pairs(self):
+        """Match the top retrieval pairs of a locally trained vocabulary tree, plus video neighbours"""
+        self.log("vocab_tree.bin not found, building a retrieval index from the dataset descriptors")
+        index = RetrievalIndex.build(
+            self.database_path,
+            os.path.join(self.output_dir, INDEX_NAME),
+            log=self.log,
+            is_cancelled=self.is_cancelled
+        )
+        if index is None:
+            self.log("Reconstruction cancelled")
+            return False
+
+        # Keyframes of a video also overlap with their direct successors
+        overlap = self.options["retrieval_sequential_overlap"] if self.options["video_path"] else 0
+        pairs = retrieval_pairs(index, self.options["retrieval_num_neighbors"], overlap)
+        return match_image_pairs(
+            self.database_path,
+            pairs,
+            self.output_dir,
+            options={"min_num_matches": self.options["min_num_matches"]},
+            log=self.log,
+            is_cancelled=self.is_cancelled
+        )
+
+    def prune_match_graph(self):
+        """Step 2.1: Match graph analysis, dropping near duplicates and weakly connected images"""
+        self.log("Analyzing the match graph")
+        report = analyze_match_graph(self.database_path, self.options)
+        write_match_graph(self.match_graph_path, report)
+
+        self.log(f"Match graph: {report['num_images']} images, {report['num_pairs']} verified pairs, "
+                 f"components of sizes {report['components'][:5]}")
+        reasons = {}
+        for reason in report["dropped"].values():
+            reason = reason.split(" of ")[0]
+            reasons[reason] = reasons.get(reason, 0) + 1
+        for reason, count in sorted(reasons.items()):
+            self.log(f"Dropped {count} images: {reason}")
+
+        if not report["kept"]:
+            self.log("No connected images left to reconstruct.")
+            return False
+        self.log(f"Mapping {len(report['kept'])} of {report['num_images']} images")
+        return True
+
+    def incremental_mapping(self):
+        """Step 3: Sparse reconstruction (Structure from Motion)"""
+        self.log("Performing incremental mapping (sparse reconstruction)")
+
+        if self.options["pose_prior_path"]:
+            self.log(f"Starting from the camera poses of {self.options['pose_prior_path']}")
+            prior = self.pose_prior(pycolmap.Reconstruction(self.options["pose_prior_path"]))
+            if prior.num_reg_images() >= 2:
+                return self.prior_mapping(prior)
+            self.log("The prior shares fewer than two images with this database, mapping from scratch")
+        if self.partitioned():
+            # Overlapping clusters of the match graph are mapped in parallel and merged
+            return partitioned_mapping(self)
+
+        # Create reconstruction manager
+        reconstruction_manager = pycolmap.ReconstructionManager()
+
+        os.makedirs(self.sparse_dir, exist_ok=True)
+        pycolmap.incremental_mapping(
+            database_path=self.database_path,
+            image_path=self.reader_image_dir(),
+            output_path=self.sparse_dir,
+            reconstruction_manager=reconstruction_manager,
+            mapper_options=self.mapper_options(),
+            next_image_callback=self.tracker.increment
+        )
+
+        if reconstruction_manager.size() == 0:
+            self.log("Reconstruction failed. No models were created.")
+            return False
+
+        # Get the largest reconstruction
+        reconstruction = reconstruction_manager.get(0)
+        self.log(f"Sparse reconstruction completed with {reconstruction.num_points3D()} 3D points")
+        return True
+
+    def pose_prior(self, prior):
+        """Poses of a prior model carried over to the images and cameras of this database, without points
+
+        The prior may come from another database, such as the low resolution preview, so its image and camera ids,
+        intrinsics and keypoints do not apply here
+        """
+        connection = colmap_db.connect(self.database_path)
+        image_ids = colmap_db.read_images(connection)
+        image_cameras = colmap_db.read_image_cameras(connection)
+        cameras = colmap_db.read_cameras(connection)
+
+        # Step 1: Prior images matched by name
+        prior_images = [prior.images[image_id] for image_id in prior.reg_image_ids()
+                        if prior.images[image_id].name in image_ids]
+
+        # Step 2: Cameras of this database, with the refined intrinsics of the prior rescaled to its image size
+        reconstruction = pycolmap.Reconstruction()
+        prior_cameras = {}
+        for image in prior_images:
+            prior_cameras.setdefault(image_cameras[image.name], prior.cameras[image.camera_id])
+        for camera_id, (model, width, height, params) in cameras.items():
+            prior_camera = prior_cameras.get(camera_id)
+            if prior_camera is not None and prior_camera.model == pycolmap.CameraModelId(model):
+                camera = pycolmap.Camera(model=prior_camera.model, width=prior_camera.width,
+                                         height=prior_camera.height, params=prior_camera.params, camera_id=camera_id)
+                camera.rescale(width, height)
+            else:
+                camera = pycolmap.Camera(model=pycolmap.CameraModelId(model), width=width, height=height,
+                                         params=params, camera_id=camera_id)
+            reconstruction.add_camera(camera)
+
+        # Step 3: Poses only, the 2D points are the keypoints of this database
+        for image in prior_images:
+            image_id = image_ids[image.name]
+            keypoints = colmap_db.read_keypoints(connection, image_id)
+            reconstruction.add_image(pycolmap.Image(
+                name=image.name,
+                points2D=[pycolmap.Point2D(xy) for xy in keypoints.astype(np.float64)],
+                cam_from_world=image.cam_from_world,
+                camera_id=image_cameras[image.name],
+                id=image_id
+            ))
+            reconstruction.register_image(image_id)
+        connection.close()
+        self.log(f"Reusing the poses of {len(prior_images)} of the {prior.num_reg_images()} prior images")
+        return reconstruction
+
+    def prior_mapping(self, prior):
+        """Step 3 from known poses: triangulate from prior cameras, then register the remaining images"""
+        # The points are rebuilt from the keypoints and matches of this database
+        prior_dir = os.path.join(self.output_dir, "sparse_prior")
+        shutil.rmtree(prior_dir, ignore_errors=True)
+        os.makedirs(prior_dir)
+        reconstruction = pycolmap.triangulate_points(prior, self.database_path, self.reader_image_dir(), prior_dir)
+        pycolmap.bundle_adjustment(reconstruction, pycolmap.BundleAdjustmentOptions())
+        reconstruction.write(prior_dir)
+        self.log(f"Triangulated {reconstruction.num_points3D()} points from {reconstruction.num_reg_images()} prior poses")
+
+        if self.is_cancelled():
+            self.log("Reconstruction cancelled")
+            return False
+
+        # Images the prior did not register are added by continuing the model
+        reconstruction_manager = pycolmap.ReconstructionManager()
+        os.makedirs(self.sparse_dir, exist_ok=True)
+        pycolmap.incremental_mapping(
+            database_path=self.database_path,
+            image_path=self.reader_image_dir(),
+            output_path=self.sparse_dir,
+            input_path=prior_dir,
+            reconstruction_manager=reconstruction_manager,
+            mapper_options=self.mapper_options(),
+            next_image_callback=self.tracker.increment
+        )
+        shutil.rmtree(prior_dir, ignore_errors=True)
+
+        if reconstruction_manager.size() == 0:
+            self.log("Reconstruction failed. No models were created.")
+            return False
+        reconstruction = reconstruction_manager.get(0)
+        self.log(f"Sparse reconstruction completed with {reconstruction.num_points3D()} 3D points")
+        return True
+
+    def export_sparse_model(self):
+        """Step 3.1: Columnar NumPy copy of the sparse model, opened without pycolmap by analysis scripts"""
+        self.log("Exporting the sparse model as NumPy arrays")
+        export_reconstruction(self.load_reconstruction(), self.columns_dir, os.path.join(self.sparse_dir, "0"),
+                              log=self.log)
+        return True
+
+    def undistort_images(self):
+        """Step 4.1: Undistort images into the dense workspace"""
+        self.log("Undistorting images")
+        os.makedirs(self.dense_dir, exist_ok=True)
+
+        pycolmap.undistort_images(
+            output_path=self.dense_dir,
+            image_path=self.reader_image_dir(),
+            reconstruction=self.load_reconstruction(),
+            options=self.undistort_options()
+        )
+
+        # Masks are computed again on the undistorted images used by stereo and fusion
+        if self.options["mask_images"]:
+            from masking import create_masks
+            images_dir = os.path.join(self.dense_dir, "images")
+            self.log("Segmenting the object in the undistorted images")
+            if create_masks(images_dir, self.dense_mask_dir, list_image_names(images_dir), self.options,
+                            is_cancelled=self.is_cancelled) is None:
+                self.log("Reconstruction cancelled")
+                return False
+        return True
+
+    def patch_match_stereo(self):
+        """Step 4.2: Patch match stereo"""
+        if not self.options["use_gpu"]:
+            # OpenCV is only required by the CPU stereo backend
+            from cpu_stereo import cpu_patch_match_stereo
+            self.log("Running plane sweep stereo on the CPU")
+            return cpu_patch_match_stereo(self)
+
+        self.log("Running patch match stereo")
+
+        pycolmap.patch_match_stereo(
+            workspace_path=self.dense_dir,
+            options=self.patch_match_options()
+        )
+        return True
+
+    def stereo_fusion(self):
+        """Step 4.3: Stereo fusion"""
+        self.log("Performing stereo fusion")
+        if not restore_maps(os.path.join(self.dense_dir, "stereo"), is_cancelled=self.is_cancelled, log=self.log):
+            self.log("Reconstruction cancelled")
+            return False
+
+        pycolmap.stereo_fusion(
+            workspace_path=self.dense_dir,
+            output_path=self.fused_path,
+            input_type=self.fusion_input_type(),
+            options=self.fusion_options()
+        )
+        return True
+
+    def filter_point_cloud(self):
+        """Step 4.3.1: Crop, downsample and denoise the fused point cloud"""
+        self.log("Filtering the fused point cloud")
+        bounding_box = None
+        if self.options["crop_point_cloud"]:
+            reconstruction = self.load_reconstruction()
+            points = [point.xyz for point in reconstruction.points3D.values()]
+            if points:
+                bounding_box = sparse_bounding_box(points, self.options["crop_margin"])
+
+        num_points = filter_point_cloud(self.fused_path, self.filtered_path, self.options, bounding_box,
+                                        log=self.log, is_cancelled=self.is_cancelled)
+        if num_points is None:
+            self.log("Reconstruction cancelled")
+            return False
+        if num_points == 0:
+            self.log("No points left after filtering the fused point cloud.")
+            return False
+        return True
+
+    def meshing_input_path(self):
+        """Point cloud given to Poisson meshing"""
+        return self.filtered_path if "filter_point_cloud" in self.stages() else self.fused_path
+
+    def poisson_meshing(self):
+        """Step 4.4: Meshing (create a mesh from the fused point cloud)"""
+        self.log("Creating mesh from point cloud")
+
+        pycolmap.poisson_meshing(
+            input_path=self.meshing_input_path(),
+            output_path=self.meshed_path,
+            options=self.meshing_options()
+        )
+        return True
+
+    def mesh_lod(self):
+        """Step 4.5: Simplify the mesh into levels of detail, written as compact glTF files"""
+        self.log("Simplifying the mesh into levels of detail")
+        levels = build_mesh_lods(self.meshed_path, self.lod_dir, self.options["lod_triangle_budgets"], log=self.log,
+                                 is_cancelled=self.is_cancelled)
+        if levels is None:
+            self.log("Reconstruction cancelled")
+            return False
+        return True
+
+
+def build_arg_parser():
+    """Build the command line parser for headless runs"""
+    parser = argparse.ArgumentParser(description="Headless COLMAP 3D reconstruction")
+    parser.add_argument("image_dir", help="Directory containing the input images (keyframes are written here with --video)")
+    parser.add_argument("output_dir", help="Directory receiving the reconstruction")
+    parser.add_argument("--video", dest="video_path", default="", help="Extract keyframes from this video first")
+    parser.add_argument("--resume", action="store_true", help="Resume from the last finished stage")
+    parser.add_argument("--options", dest="options_file",
+                        help="JSON file of options, such as the recommendation of tuner.py, used as defaults")
+    parser.add_argument("--progressive", action="store_true",
+                        help="Reconstruct a low resolution preview first, then refine from its camera poses")
+    parser.add_argument("--add-images", action="store_true",
+                        help="Register images not yet in the database into the existing sparse model")
+    parser.add_argument("--max-image-size", type=int, default=DEFAULT_OPTIONS["max_image_size"])
+    parser.add_argument("--max-num-features", type=int, default=DEFAULT_OPTIONS["max_num_features"])
+    parser.add_argument("--match-method", default=DEFAULT_OPTIONS["match_method"],
+                        choices=MATCH_METHODS)
+    parser.add_argument("--no-dense", dest="dense", action="store_false", help="Skip dense reconstruction")
+    parser.add_argument("--prepare-images", action="store_true",
+                        help="Decode, orient and downscale the images once in parallel, cached between runs")
+    parser.add_argument("--mask-objects", dest="mask_images", action="store_true",
+                        help="Restrict features and fusion to the object in the middle of the images")
+    parser.add_argument("--mask-center-fraction", type=float, default=DEFAULT_OPTIONS["mask_center_fraction"],
+                        help="Size of the central region seeding the object, as a fraction of the image")
+    parser.add_argument("--mask-dilation", type=float, default=DEFAULT_OPTIONS["mask_dilation"],
+                        help="Margin kept around the object, as a fraction of the image size")
+    parser.add_argument("--no-gpu", dest="use_gpu", action="store_false", help="Disable GPU usage")
+    parser.add_argument("--min-num-matches", type=int, default=DEFAULT_OPTIONS["min_num_matches"])
+    parser.add_argument("--retrieval-num-neighbors", type=int, default=DEFAULT_OPTIONS["retrieval_num_neighbors"],
+                        help="Images retrieved per image by vocab_tree matching")
+    parser.add_argument("--retrieval-sequential-overlap", type=int,
+                        default=DEFAULT_OPTIONS["retrieval_sequential_overlap"],
+                        help="Successive keyframes also matched by vocab_tree matching of a video")
+    parser.add_argument("--match-pairs", dest="match_pairs_path", default="",
+                        help="Only match the image pairs listed in this file, one 'name1 name2' per line")
+    parser.add_argument("--pose-prior", dest="pose_prior_path", default="",
+                        help="Sparse model whose camera poses are reused to start mapping")
+    parser.add_argument("--no-sparse-export", dest="export_sparse", action="store_false",
+                        help="Do not copy the sparse model into memory-mappable NumPy arrays")
+    parser.add_argument("--no-pruning", dest="prune_images", action="store_false",
+                        help="Map all images instead of dropping near duplicates and weakly connected ones")
+    parser.add_argument("--prune-min-degree", type=int, default=DEFAULT_OPTIONS["prune_min_degree"],
+                        help="Images verified with fewer other images are not mapped")
+    parser.add_argument("--prune-duplicate-overlap", type=float, default=DEFAULT_OPTIONS["prune_duplicate_overlap"],
+                        help="Inlier fraction above which two images are near duplicates")
+    parser.add_argument("--mapper-min-model-size", type=int, default=DEFAULT_OPTIONS["mapper_min_model_size"])
+    parser.add_argument("--mapper-max-extra-param", type=float, default=DEFAULT_OPTIONS["mapper_max_extra_param"])
+    parser.add_argument("--partition-mapping", action="store_true",
+                        help="Map overlapping clusters of images in parallel processes and merge them")
+    parser.add_argument("--max-cluster-size", type=int, default=DEFAULT_OPTIONS["max_cluster_size"],
+                        help="Largest number of images mapped by one cluster with --partition-mapping")
+    parser.add_argument("--cluster-overlap", type=float, default=DEFAULT_OPTIONS["cluster_overlap"],
+                        help="Fraction of images each cluster shares with its neighbours")
+    parser.add_argument("--patch-match-window-radius", type=int, default=DEFAULT_OPTIONS["patch_match_window_radius"])
+    parser.add_argument("--patch-match-window-step", type=int, default=DEFAULT_OPTIONS["patch_match_window_step"])
+    parser.add_argument("--cpu-stereo-max-image-size", type=int, default=DEFAULT_OPTIONS["cpu_stereo_max_image_size"],
+                        help="Resolution of the depth maps estimated on the CPU with --no-gpu")
+    parser.add_argument("--cpu-stereo-num-depths", type=int, default=DEFAULT_OPTIONS["cpu_stereo_num_depths"],
+                        help="Depth planes swept by the CPU stereo")
+    parser.add_argument("--cpu-stereo-num-sources", type=int, default=DEFAULT_OPTIONS["cpu_stereo_num_sources"],
+                        help="Source images compared with each image by the CPU stereo")
+    parser.add_argument("--fusion-min-num-pixels", type=int, default=DEFAULT_OPTIONS["fusion_min_num_pixels"])
+    parser.add_argument("--no-point-filter", dest="filter_points", action="store_false",
+                        help="Mesh the fused point cloud as is, without cropping, downsampling and outlier removal")
+    parser.add_argument("--no-crop", dest="crop_point_cloud", action="store_false",
+                        help="Keep the fused points outside the bounding box of the sparse model")
+    parser.add_argument("--crop-margin", type=float, default=DEFAULT_OPTIONS["crop_margin"],
+                        help="Fraction of its size added around the sparse bounding box")
+    parser.add_argument("--voxel-size", type=float, default=DEFAULT_OPTIONS["voxel_size"],
+                        help="Voxel size of the downsampled cloud, 0 for 1/1000 of the bounding box diagonal")
+    parser.add_argument("--outlier-min-neighbors", type=int, default=DEFAULT_OPTIONS["outlier_min_neighbors"],
+                        help="Points with fewer neighbours within 3 voxels are removed, 0 to keep them")
+    parser.add_argument("--meshing-trim", type=int, default=DEFAULT_OPTIONS["meshing_trim"])
+    parser.add_argument("--no-mesh-lod", dest="mesh_lod", action="store_false",
+                        help="Do not write simplified levels of detail of the mesh")
+    parser.add_argument("--lod-triangle-budgets", type=int, nargs="+", default=DEFAULT_OPTIONS["lod_triangle_budgets"],
+                        help="Triangle budget of each level of detail of the mesh")
+    parser.add_argument("--retention", choices=RETENTION_POLICIES, default=DEFAULT_OPTIONS["retention"],
+                        help="Once fusion succeeded, keep, compress or remove the undistorted images and depth maps")
+    parser.add_argument("--reference", dest="reference_model", default="",
+                        help="Reference point cloud or mesh the finished model is scored against")
+    parser.add_argument("--reference-alignment", default="",
+                        help="4x4 similarity roughly mapping the model onto the reference, as text")
+    parser.add_argument("--evaluation-thresholds", type=float, nargs="+", default=[],
+                        help="Distance thresholds of the F-scores, in reference units")
+    parser.add_argument("--num-threads", type=int, default=DEFAULT_OPTIONS["num_threads"],
+                        help="Threads used by pycolmap, -1 for all cores")
+    parser.add_argument("--trace", action="store_true", help="Also write a Chrome trace of the stages")
+    parser.add_argument("--no-isolation", dest="isolate_stages", action="store_false",
+                        help="Run the stages in this process instead of killable worker processes")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory of the stage output cache")
+    parser.add_argument("--cache-size-gb", type=float, default=DEFAULT_CACHE_SIZE / 1024 ** 3,
+                        help="Size cap of the stage output cache")
+    parser.add_argument("--no-cache", dest="use_cache", action="store_false", help="Disable the stage output cache")
+    return parser
+
+
+def options_from_args(args):
+    """Extract the pipeline options from parsed command line arguments"""
+    return {key: getattr(args, key) for key in DEFAULT_OPTIONS}
+
+
+def main():
+    parser = build_arg_parser()
+    args, _ = parser.parse_known_args()
+    if args.options_file:
+        # Options from the file replace the defaults, explicit flags still win
+        with open(args.options_file, "r") as f:
+            parser.set_defaults(**json.load(f))
+    args = parser.parse_args()
+
+    cache = StageCache(args.cache_dir, int(args.cache_size_gb * 1024 ** 3)) if args.use_cache else None
+
+    pipeline = ReconstructionPipeline(args.image_dir, args.output_dir, options_from_args(args), cache=cache)
+    if args.add_images:
+        # Dense stages are redone on the updated model
+        success = add_images(pipeline) and pipeline.run(resume=True)
+    elif args.progressive:
+        # Imported here because the progressive module imports this one
+        from progressive import progressive_reconstruction
+        success = progressive_reconstruction(args.image_dir, args.output_dir, options_from_args(args), cache=cache,
+                                             resume=args.resume)
+    else:
+        success = pipeline.run(resume=args.resume)
+
+    raise SystemExit(0 if success else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import os
+import shutil
+import itertools
+import numpy as np
+
+# Points held in memory at once by every pass over a cloud
+CHUNK_SIZE = 1000000
+
+# Without an explicit voxel size, the bounding box diagonal is split into this many voxels
+AUTO_VOXELS_PER_DIAGONAL = 1000
+
+# Radius of the outlier neighbourhood, in voxels
+OUTLIER_RADIUS_VOXELS = 3.0
+
+# Side of the cells spread over the outlier buckets, in neighbourhood radii
+BUCKET_CELL_RADII = 16
+
+# Sparse points outside these percentiles are ignored when bounding the object
+SPARSE_BOX_PERCENTILE = 1.0
+
+PLY_TYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "<i2", "int16": "<i2", "ushort": "<u2", "uint16": "<u2",
+    "int": "<i4", "int32": "<i4", "uint": "<u4", "uint32": "<u4",
+    "float": "<f4", "float32": "<f4", "double": "<f8", "float64": "<f8",
+}
+PLY_NAMES = {"i1": "char", "u1": "uchar", "i2": "short", "u2": "ushort", "i4": "int", "u4": "uint",
+             "f4": "float", "f8": "double"}
+
+
+def read_ply_header(path):
+    """(vertex dtype, vertex count, data offset) of a binary little endian PLY file"""
+    with open(path, "rb") as f:
+        if f.readline().strip() != b"ply":
+            raise ValueError(f"{path} is not a PLY file")
+        fields = []
+        count = None
+        element = None
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f"{path} has no end_header line")
+            words = line.decode("ascii").split()
+            if not words or words[0] in ("comment", "obj_info"):
+                continue
+            if words[0] == "format" and words[1] != "binary_little_endian":
+                raise ValueError(f"{path} is {words[1]}, only binary_little_endian PLY files are supported")
+            elif words[0] == "element":
+                element = words[1]
+                if element == "vertex":
+                    count = int(words[2])
+                elif count is None:
+                    raise ValueError(f"{path} does not start with its vertices")
+            elif words[0] == "property" and element == "vertex":
+                if words[1] == "list":
+                    raise ValueError(f"{path} has list properties on its vertices")
+                fields.append((words[2], PLY_TYPES[words[1]]))
+            elif words[0] == "end_header":
+                return np.dtype(fields), count or 0, f.tell()
+
+
+def ply_header(dtype, count):
+    """Header of a binary little endian PLY file with count vertices"""
+    lines = ["ply", "format binary_little_endian 1.0", f"element vertex {count}"]
+    for name in dtype.names:
+        lines.append(f"property {PLY_NAMES[dtype[name].str[1:]]} {name}")
+    lines.append("end_header")
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+def open_ply_vertices(path):
+    """Read-only memory map of the vertices of a binary PLY file"""
+    dtype, count, offset = read_ply_header(path)
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+
+
+class PlyWriter:
+    """Stream vertices into a PLY file whose count is only known at the end"""
+
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.count = 0
+        self.data_path = path + ".data.tmp"
+        self.data = open(self.data_path, "wb")
+
+    def write(self, vertices):
+        self.data.write(np.ascontiguousarray(vertices, dtype=self.dtype).tobytes())
+        self.count += len(vertices)
+
+    def close(self):
+        """Write the header followed by the buffered vertices"""
+        self.data.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f, open(self.data_path, "rb") as data:
+            f.write(ply_header(self.dtype, self.count))
+            shutil.copyfileobj(data, f)
+        os.remove(self.data_path)
+        os.replace(tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def discard(self):
+        """Drop the vertices written so far, leaving no output file"""
+        self.data.close()
+        os.remove(self.data_path)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and not self.data.closed:
+            self.close()
+        elif not self.data.closed:
+            self.discard()
+
+
+def chunks(vertices, size=CHUNK_SIZE):
+    """In-memory copies of consecutive slices of a vertex array"""
+    for start in range(0, len(vertices), size):
+        yield np.array(vertices[start:start + size])
+
+
+def xyz(vertices):
+    """(N, 3) float64 positions of structured vertices"""
+    return np.stack([vertices["x"], vertices["y"], vertices["z"]], axis=1).astype(np.float64)
+
+
+class BucketFiles:
+    """Temporary files receiving the rows of a cloud split by bucket"""
+
+    def __init__(self, directory, num_buckets, dtype):
+        self.directory = directory
+        self.num_buckets = num_buckets
+        self.dtype = dtype
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, bucket):
+        return os.path.join(self.directory, f"{bucket}.bin")
+
+    def append(self, buckets, rows):
+        order = np.argsort(buckets, kind="stable")
+        counts = np.bincount(buckets, minlength=self.num_buckets)
+        start = 0
+        for bucket in np.nonzero(counts)[0]:
+            with open(self.path(bucket), "ab") as f:
+                f.write(np.ascontiguousarray(rows[order[start:start + counts[bucket]]]).tobytes())
+            start += counts[bucket]
+
+    def read(self, bucket):
+        if not os.path.exists(self.path(bucket)):
+            return np.zeros(0, dtype=self.dtype)
+        return np.fromfile(self.path(bucket), dtype=self.dtype)
+
+
+def hash_buckets(cells, num_buckets):
+    """Bucket of integer cell coordinates, spreading neighbouring cells apart"""
+    cells = cells.astype(np.uint64)
+    mixed = cells[:, 0] * np.uint64(73856093) ^ cells[:, 1] * np.uint64(19349663) ^ cells[:, 2] * np.uint64(83492791)
+    return (mixed % np.uint64(num_buckets)).astype(np.int64)
+
+
+def sparse_bounding_box(points, margin):
+    """Box around the sparse points, ignoring the most distant ones, grown by margin times its size"""
+    low = np.percentile(points, SPARSE_BOX_PERCENTILE, axis=0)
+    high = np.percentile(points, 100 - SPARSE_BOX_PERCENTILE, axis=0)
+    extent = high - low
+    return low - margin * extent, high + margin * extent
+
+
+def cloud_bounds(vertices):
+    """Axis aligned bounds of a cloud, one chunk at a time"""
+    low = np.full(3, np.inf)
+    high = np.full(3, -np.inf)
+    for chunk in chunks(vertices):
+        points = xyz(chunk)
+        low = np.minimum(low, points.min(axis=0))
+        high = np.maximum(high, points.max(axis=0))
+    return low, high
+
+
+def average_voxels(rows, keys):
+    """One vertex per voxel key, averaging every property and renormalizing normals"""
+    unique_keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    averaged = np.zeros(len(unique_keys), dtype=rows.dtype)
+    for name in rows.dtype.names:
+        mean = np.bincount(inverse, weights=rows[name].astype(np.float64), minlength=len(unique_keys)) / counts
+        if np.issubdtype(rows.dtype[name], np.integer):
+            mean = np.round(mean)
+        averaged[name] = mean
+    if all(name in rows.dtype.names for name in ("nx", "ny", "nz")):
+        normals = np.stack([averaged["nx"], averaged["ny"], averaged["nz"]], axis=1)
+        normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+        averaged["nx"], averaged["ny"], averaged["nz"] = normals.T
+    return averaged
+
+
+def count_neighbors(points, queries, radius, block_size=CHUNK_SIZE // 10):
+    """Number of points within radius of each query, through a hash grid of radius sized cells"""
+    cells = np.floor(points / radius).astype(np.int64)
+    query_cells = np.floor(queries / radius).astype(np.int64)
+    # Cells are numbered in a local grid with a border for the neighbour offsets
+    low = np.minimum(cells.min(axis=0), query_cells.min(axis=0)) - 1
+    dims = np.maximum(cells.max(axis=0), query_cells.max(axis=0)) - low + 2
+
+    def encode(grid_cells):
+        grid_cells = grid_cells - low
+        return grid_cells[:, 0] + dims[0] * (grid_cells[:, 1] + dims[1] * grid_cells[:, 2])
+
+    order = np.argsort(encode(cells))
+    sorted_keys = encode(cells)[order]
+    sorted_points = points[order]
+    counts = np.zeros(len(queries), dtype=np.int64)
+    for start in range(0, len(queries), block_size):
+        block = queries[start:start + block_size]
+        block_cells = query_cells[start:start + block_size]
+        for offset in itertools.product((-1, 0, 1), repeat=3):
+            keys = encode(block_cells + np.array(offset))
+            first = np.searchsorted(sorted_keys, keys, side="left")
+            lengths = np.searchsorted(sorted_keys, keys, side="right") - first
+            # One (query, point) pair per point of the neighbouring cell
+            query_index = np.repeat(np.arange(len(block)), lengths)
+            point_index = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - first, lengths)
+            distances = ((sorted_points[point_index] - block[query_index]) ** 2).sum(axis=1)
+            counts[start:start + block_size] += np.bincount(query_index[distances <= radius ** 2],
+                                                            minlength=len(block))
+    return counts
+
+
+def halo_buckets(points, cell_size, radius, num_buckets):
+    """(row, bucket) of every point within radius of a neighbouring cell stored in another bucket"""
+    cells = np.floor(points / cell_size).astype(np.int64)
+    local = points - cells * cell_size
+    near_low = local < radius
+    near_high = local > cell_size - radius
+    home = hash_buckets(cells, num_buckets)
+    rows, buckets = [], []
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        if offset == (0, 0, 0):
+            continue
+        offset = np.array(offset)
+        near = np.all((offset == 0) | ((offset < 0) & near_low) | ((offset > 0) & near_high), axis=1)
+        index = np.nonzero(near)[0]
+        bucket = hash_buckets(cells[index] + offset, num_buckets)
+        index, bucket = index[bucket != home[index]], bucket[bucket != home[index]]
+        rows.append(index)
+        buckets.append(bucket)
+    pairs = np.unique(np.stack([np.concatenate(rows), np.concatenate(buckets)], axis=1), axis=0)
+    return home, pairs[:, 0], pairs[:, 1]
+
+
+def filter_point_cloud(input_path, output_path, options, bounding_box=None, log=print, is_cancelled=None,
+                       work_dir=None):
+    """Crop, voxel downsample and remove isolated points of a PLY cloud in bounded memory, returns the points kept"""
+    is_cancelled = is_cancelled or (lambda: False)
+    vertices = open_ply_vertices(input_path)
+    work_dir = work_dir or output_path + ".work"
+    shutil.rmtree(work_dir, ignore_errors=True)
+    try:
+        # Step 1: Bounds of the object, from the sparse model when cropping
+        low, high = bounding_box if bounding_box is not None else cloud_bounds(vertices)
+        low, high = np.asarray(low, dtype=np.float64), np.asarray(high, dtype=np.float64)
+        voxel_size = options["voxel_size"] or np.linalg.norm(high - low) / AUTO_VOXELS_PER_DIAGONAL
+        dims = np.floor((high - low) / voxel_size).astype(np.int64) + 1
+        if np.prod(dims.astype(np.float64)) >= 2 ** 62:
+            raise ValueError(f"Voxel size {voxel_size} is too small for the extent of the cloud")
+        log(f"Filtering {len(vertices)} points with {voxel_size:.4g} voxels")
+
+        # Step 2: Cropped points spread over buckets by voxel, so no voxel spans two buckets
+        num_buckets = max(1, -(-len(vertices) // CHUNK_SIZE))
+        voxel_files = BucketFiles(os.path.join(work_dir, "voxels"), num_buckets, vertices.dtype)
+        num_cropped = 0
+        for chunk in chunks(vertices):
+            if is_cancelled():
+                return None
+            points = xyz(chunk)
+            inside = np.all((points >= low) & (points <= high), axis=1)
+            chunk, points = chunk[inside], points[inside]
+            num_cropped += len(chunk)
+            voxel_files.append(hash_buckets(np.floor((points - low) / voxel_size), num_buckets), chunk)
+        log(f"Kept {num_cropped} points inside the bounding box")
+
+        # Step 3: One averaged point per voxel, spread over buckets by cell with a halo for the neighbour search
+        radius = OUTLIER_RADIUS_VOXELS * voxel_size
+        cell_size = BUCKET_CELL_RADII * radius
+        bucket_dtype = np.dtype(vertices.dtype.descr + [("halo", "u1")])
+        cell_files = BucketFiles(os.path.join(work_dir, "cells"), num_buckets, bucket_dtype)
+        num_voxels = 0
+        for bucket in range(num_buckets):
+            if is_cancelled():
+                return None
+            rows = voxel_files.read(bucket)
+            if not len(rows):
+                continue
+            voxels = np.floor((xyz(rows) - low) / voxel_size).astype(np.int64)
+            downsampled = average_voxels(rows, voxels[:, 0] + dims[0] * (voxels[:, 1] + dims[1] * voxels[:, 2]))
+            os.remove(voxel_files.path(bucket))
+            num_voxels += len(downsampled)
+
+            tagged = np.zeros(len(downsampled), dtype=bucket_dtype)
+            for name in vertices.dtype.names:
+                tagged[name] = downsampled[name]
+            home, halo_rows, halo_targets = halo_buckets(xyz(downsampled), cell_size, radius, num_buckets)
+            halo = tagged[halo_rows]
+            halo["halo"] = 1
+            cell_files.append(np.concatenate([home, halo_targets]), np.concatenate([tagged, halo]))
+        log(f"Downsampled to {num_voxels} points")
+
+        # Step 4: Radius outlier removal, each bucket seeing the neighbours of its points through the halo
+        min_neighbors = options["outlier_min_neighbors"]
+        with PlyWriter(output_path, vertices.dtype) as writer:
+            for bucket in range(num_buckets):
+                if is_cancelled():
+                    writer.discard()
+                    return None
+                rows = cell_files.read(bucket)
+                core = rows[rows["halo"] == 0]
+                if not len(core):
+                    continue
+                if min_neighbors > 0:
+                    # Each point counts itself
+                    neighbors = count_neighbors(xyz(rows), xyz(core), radius) - 1
+                    core = core[neighbors >= min_neighbors]
+                writer.write(core[list(vertices.dtype.names)])
+        log(f"Removed {num_voxels - writer.count} isolated points, {writer.count} points left")
+        return writer.count
+    finally:
+        del vertices
+        shutil.rmtree(work_dir, ignore_errors=True)
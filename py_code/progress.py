@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import threading
+
+DEFAULT_HISTORY_PATH = os.path.join(os.path.expanduser("~"), ".cache", "colmap_reconstruction", "throughput.json")
+
+# Seconds per work item used until a stage has been measured on this machine
+DEFAULT_SECONDS_PER_ITEM = {
+    "extract_keyframes": 60.0,
+    "prepare_images": 0.3,
+    "mask_images": 0.5,
+    "extract_features": 1.0,
+    "match_features": 0.05,
+    "prune_match_graph": 0.01,
+    "incremental_mapping": 2.0,
+    "export_sparse_model": 0.05,
+    "undistort_images": 0.5,
+    "patch_match_stereo": 20.0,
+    "stereo_fusion": 2.0,
+    "filter_point_cloud": 0.5,
+    "poisson_meshing": 1.0,
+    "mesh_lod": 0.5,
+}
+
+# Weight of the latest run in the moving average of the throughput
+HISTORY_SMOOTHING = 0.3
+
+
+def format_duration(seconds):
+    """Short human readable duration"""
+    if seconds is None:
+        return "?"
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{(seconds % 3600) // 60:02d}m"
+
+
+class ThroughputHistory:
+    """Per-stage seconds per work item measured on previous runs, stored locally"""
+
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.seconds_per_item = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.seconds_per_item = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def get(self, stage):
+        """Expected seconds per work item of a stage"""
+        return self.seconds_per_item.get(stage, DEFAULT_SECONDS_PER_ITEM[stage])
+
+    def update(self, stage, seconds, items):
+        """Blend a new measurement into the stored average"""
+        if not items or seconds <= 0:
+            return
+        with self.lock:
+            measured = seconds / items
+            previous = self.seconds_per_item.get(stage)
+            if previous is None:
+                self.seconds_per_item[stage] = measured
+            else:
+                self.seconds_per_item[stage] = (1 - HISTORY_SMOOTHING) * previous + HISTORY_SMOOTHING * measured
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.seconds_per_item, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+class ProgressTracker:
+    """Overall progress and ETA from live stage counters weighted by measured throughput"""
+
+    def __init__(self, stages, history, report, interval=1.0):
+        self.stages = list(stages)
+        self.history = history
+        self.report = report
+        self.interval = interval
+
+        self.totals = {stage: 1 for stage in self.stages}
+        self.done = set()
+        self.current = None
+        self.counter = None
+        self.count = 0
+        self.stage_start = None
+
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def set_total(self, stage, total):
+        """Set the expected number of work items of a stage"""
+        with self.lock:
+            self.totals[stage] = max(1, int(total or 1))
+
+    def expected_seconds(self, stage):
+        """Expected duration of a whole stage"""
+        return self.totals[stage] * self.history.get(stage)
+
+    def start(self):
+        """Start the periodic reporting thread"""
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the periodic reporting thread"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.report(*self.snapshot())
+
+    def skip_stage(self, stage):
+        """Mark a stage finished without measuring it (resumed or cached)"""
+        with self.lock:
+            self.done.add(stage)
+
+    def start_stage(self, stage, counter=None):
+        """Begin tracking a stage, counter returns the number of items done so far"""
+        with self.lock:
+            self.current = stage
+            self.counter = counter
+            self.count = 0
+            self.stage_start = time.time()
+
+    def increment(self, *args):
+        """Count one item of the current stage, usable as a pycolmap callback"""
+        with self.lock:
+            self.count += 1
+
+    def finish_stage(self, stage, items=None, measured=True):
+        """Mark a stage finished and learn its throughput"""
+        with self.lock:
+            elapsed = time.time() - self.stage_start if self.stage_start else 0
+            self.done.add(stage)
+            self.current = None
+            self.counter = None
+            total = self.totals[stage]
+        if measured:
+            self.history.update(stage, elapsed, items or total)
+
+    def stage_fraction(self):
+        """(items done, fraction) of the current stage"""
+        stage = self.current
+        elapsed = time.time() - self.stage_start
+        count = self.count
+        if self.counter is not None:
+            try:
+                polled = self.counter()
+            except Exception:
+                polled = None
+            if polled is not None:
+                count = polled
+
+        if count:
+            return count, min(count / self.totals[stage], 0.99)
+        # Stages without a counter advance with the expected duration
+        return None, min(elapsed / max(self.expected_seconds(stage), 1e-6), 0.99)
+
+    def snapshot(self):
+        """(percent, message, status) of the whole run"""
+        with self.lock:
+            expected = {stage: self.expected_seconds(stage) for stage in self.stages}
+            total_expected = sum(expected.values()) or 1.0
+            finished = sum(expected[stage] for stage in self.done)
+
+            if self.current is None:
+                percent = 100.0 * finished / total_expected
+                return percent, None, ""
+
+            stage = self.current
+            count, fraction = self.stage_fraction()
+            elapsed = time.time() - self.stage_start
+
+            # The measured rate of the current stage replaces the historical one once it is known
+            if count and fraction > 0.05:
+                stage_remaining = elapsed / fraction - elapsed
+            else:
+                stage_remaining = max(expected[stage] - elapsed, 0.0)
+            later = sum(expected[s] for s in self.stages if s not in self.done and s != stage)
+
+            percent = 100.0 * (finished + fraction * expected[stage]) / total_expected
+            progress_text = f"{count}/{self.totals[stage]}" if count is not None else f"{100 * fraction:.0f}%"
+            status = (f"{stage}: {progress_text}, stage ETA {format_duration(stage_remaining)},"
+                      f" total ETA {format_duration(stage_remaining + later)}")
+            return percent, None, status
@@ -0,0 +1,128 @@
+import os
+from collections import Counter
+from itertools import combinations
+import colmap_db
+from pipeline import ReconstructionPipeline
+from matching import write_pairs_file
+
+# Settings of the fast preview run, everything else follows the full run
+PREVIEW_OPTIONS = {
+    "max_image_size": 800,
+    "max_num_features": 2000,
+    "dense": False,
+}
+
+# Share of the progress bar given to the preview
+PREVIEW_PROGRESS_SHARE = 0.25
+
+# 3D points two registered images must share to be matched again at full resolution
+MIN_COVISIBLE_POINTS = 10
+
+# The listed pairs are matched one by one on the CPU with NumPy, about 0.5 s per pair at 8000 features, while
+# COLMAP's own matchers are multithreaded or run on the GPU. The list therefore replaces the configured matcher
+# only when it cuts the number of pairs by at least this factor
+MIN_PAIR_REDUCTION = 10
+
+PREVIEW_DIR_NAME = "preview"
+PAIRS_NAME = "progressive_pairs.txt"
+
+
+def covisible_pairs(reconstruction, min_points=MIN_COVISIBLE_POINTS):
+    """Name pairs of registered images observing at least min_points common 3D points"""
+    counts = Counter()
+    for point in reconstruction.points3D.values():
+        image_ids = sorted({element.image_id for element in point.track.elements})
+        counts.update(combinations(image_ids, 2))
+    names = {image_id: image.name for image_id, image in reconstruction.images.items()}
+    return {(names[image_id1], names[image_id2]) for (image_id1, image_id2), count in counts.items()
+            if count >= min_points}
+
+
+def unregistered_pairs(database_path, registered_names, min_num_matches):
+    """Verified preview pairs involving an image the preview could not register"""
+    connection = colmap_db.connect(database_path)
+    names = {image_id: name for name, image_id in colmap_db.read_images(connection).items()}
+    image_id1, image_id2, num_inliers, _ = colmap_db.read_two_view_geometry_arrays(connection)
+    connection.close()
+
+    pairs = set()
+    for id1, id2, inliers in zip(image_id1.tolist(), image_id2.tolist(), num_inliers.tolist()):
+        name1, name2 = names[id1], names[id2]
+        if inliers >= min_num_matches and (name1 not in registered_names or name2 not in registered_names):
+            pairs.add((name1, name2))
+    return pairs
+
+
+def scaled_progress(progress, start, share):
+    """Progress callback mapping 0-100 of a run to a slice of the overall bar"""
+    if progress is None:
+        return None
+
+    def report(value, message=None, status=None):
+        progress(start + share * value, message, status)
+    return report
+
+
+def progressive_reconstruction(image_dir, output_dir, options=None, log=print, progress=None, is_cancelled=None,
+                               cache=None, history=None, on_preview=None, resume=False):
+    """Run a low resolution preview, then the full reconstruction constrained by the preview poses"""
+    options = dict(options or {})
+
+    # Step 1: Fast preview, also written as a regular workspace
+    preview_dir = os.path.join(output_dir, PREVIEW_DIR_NAME)
+    preview_options = dict(options)
+    preview_options.update(PREVIEW_OPTIONS)
+    preview_options["max_image_size"] = min(preview_options["max_image_size"],
+                                            options.get("max_image_size", preview_options["max_image_size"]))
+    log(f"Preview at {preview_options['max_image_size']}px with {preview_options['max_num_features']} features")
+    preview = ReconstructionPipeline(
+        image_dir,
+        preview_dir,
+        preview_options,
+        log=log,
+        progress=scaled_progress(progress, 0, PREVIEW_PROGRESS_SHARE),
+        is_cancelled=is_cancelled,
+        cache=cache,
+        history=history
+    )
+    if not preview.run(resume=resume):
+        log("Preview failed, the capture is unlikely to reconstruct.")
+        return False
+
+    reconstruction = preview.load_reconstruction()
+    log(f"Preview ready: {reconstruction.num_reg_images()} of {reconstruction.num_images()} images registered, "
+        f"{reconstruction.num_points3D()} points in {preview.sparse_dir}")
+    if on_preview is not None:
+        on_preview(preview)
+
+    # Step 2: Pairs co-visible in the preview, plus the plausible pairs of unregistered images
+    registered_names = {reconstruction.images[image_id].name for image_id in reconstruction.reg_image_ids()}
+    pairs = covisible_pairs(reconstruction)
+    pairs |= unregistered_pairs(preview.database_path, registered_names, preview.options["min_num_matches"])
+    os.makedirs(output_dir, exist_ok=True)
+    pairs_path = os.path.join(output_dir, PAIRS_NAME)
+    write_pairs_file(pairs_path, sorted(pairs))
+
+    # Step 3: Full resolution run starting from the preview poses
+    full_options = dict(options)
+    full_options["pose_prior_path"] = os.path.join(preview.sparse_dir, "0")
+    # Keyframes were already extracted by the preview
+    full_options["video_path"] = ""
+    full = ReconstructionPipeline(
+        image_dir,
+        output_dir,
+        full_options,
+        log=log,
+        progress=scaled_progress(progress, 100 * PREVIEW_PROGRESS_SHARE, 1 - PREVIEW_PROGRESS_SHARE),
+        is_cancelled=is_cancelled,
+        cache=cache,
+        history=history
+    )
+    planned_pairs = full.expected_num_pairs(reconstruction.num_images())
+    if len(pairs) * MIN_PAIR_REDUCTION <= planned_pairs:
+        full.options["match_pairs_path"] = pairs_path
+        log(f"Full resolution run limited to {len(pairs)} of {planned_pairs} image pairs")
+    else:
+        log(f"Keeping the {full.options['match_method']} matcher: the preview leaves {len(pairs)} of "
+            f"{planned_pairs} pairs, too many to match faster one by one")
+    return full.run(resume=resume)
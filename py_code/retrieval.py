@@ -0,0 +1,194 @@
+import os
+import numpy as np
+import colmap_db
+from matching import normalize_descriptors
+
+# Two-level vocabulary tree, BRANCHING ** 2 visual words
+BRANCHING = 64
+
+# Descriptors sampled over the whole dataset to train the vocabulary
+MAX_TRAINING_DESCRIPTORS = 100000
+KMEANS_ITERATIONS = 10
+
+# Images scored against the whole index at once
+QUERY_BLOCK_SIZE = 512
+
+INDEX_NAME = "retrieval_index.npz"
+
+
+def kmeans(data, k, iterations=KMEANS_ITERATIONS, seed=0):
+    """Lloyd's k-means on float32 rows, returns (k, dims) centers"""
+    rng = np.random.default_rng(seed)
+    if len(data) <= k:
+        # Too little data: every point is a center, repeated to keep a fixed shape
+        return data[np.arange(k) % max(len(data), 1)] if len(data) else np.zeros((k, data.shape[1]), np.float32)
+    centers = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = assign(data, centers)
+        # Per-cluster sums as a single product with the one-hot label matrix
+        sums = np.eye(k, dtype=np.float32)[labels].T @ data
+        counts = np.bincount(labels, minlength=k)
+        filled = counts > 0
+        centers[filled] = sums[filled] / counts[filled, None]
+        # Empty clusters restart from random points
+        empty = np.nonzero(~filled)[0]
+        if len(empty):
+            centers[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+    return centers
+
+
+def assign(data, centers):
+    """Index of the nearest center of each row"""
+    # |x - c|^2 up to the constant |x|^2
+    distances = (centers ** 2).sum(axis=1) - 2.0 * (data @ centers.T)
+    return np.argmin(distances, axis=1)
+
+
+class VocabularyTree:
+    """Hierarchical k-means vocabulary trained on the dataset's own descriptors"""
+
+    def __init__(self, roots, leaves):
+        self.roots = roots
+        self.leaves = leaves
+
+    @property
+    def num_words(self):
+        return self.leaves.shape[0] * self.leaves.shape[1]
+
+    @classmethod
+    def train(cls, descriptors, branching=BRANCHING, seed=0):
+        roots = kmeans(descriptors, branching, seed=seed)
+        labels = assign(descriptors, roots)
+        leaves = np.stack([kmeans(descriptors[labels == branch], branching, seed=seed + 1 + branch)
+                           for branch in range(branching)])
+        return cls(roots, leaves)
+
+    def quantize(self, descriptors):
+        """Visual word of each descriptor, descending the tree branch by branch"""
+        branches = assign(descriptors, self.roots)
+        words = np.empty(len(descriptors), dtype=np.int64)
+        for branch in np.unique(branches):
+            rows = branches == branch
+            words[rows] = branch * self.leaves.shape[1] + assign(descriptors[rows], self.leaves[branch])
+        return words
+
+
+def sample_training_descriptors(connection, image_ids, max_descriptors=MAX_TRAINING_DESCRIPTORS, seed=0):
+    """Evenly sample descriptors across all images"""
+    rng = np.random.default_rng(seed)
+    per_image = max(1, max_descriptors // max(len(image_ids), 1))
+    samples = []
+    for image_id in image_ids.values():
+        descriptors = colmap_db.read_descriptors(connection, image_id)
+        if len(descriptors) > per_image:
+            descriptors = descriptors[rng.choice(len(descriptors), per_image, replace=False)]
+        samples.append(normalize_descriptors(descriptors))
+    return np.concatenate(samples) if samples else np.zeros((0, 128), np.float32)
+
+
+class RetrievalIndex:
+    """Bag of visual words index with tf-idf weighting, cached next to the database"""
+
+    def __init__(self, tree, names, histograms, fingerprints):
+        self.tree = tree
+        self.names = list(names)
+        self.histograms = histograms
+        self.fingerprints = list(fingerprints)
+
+    @classmethod
+    def load(cls, path):
+        """Read a cached index, or None"""
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                tree = VocabularyTree(data["roots"], data["leaves"])
+                return cls(tree, data["names"].tolist(), data["histograms"], data["fingerprints"].tolist())
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, path):
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, roots=self.tree.roots, leaves=self.tree.leaves, names=np.array(self.names),
+                 histograms=self.histograms, fingerprints=np.array(self.fingerprints))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def build(cls, database_path, index_path=None, log=print, is_cancelled=None):
+        """Index every image of the database, reusing the cached vocabulary and unchanged images"""
+        is_cancelled = is_cancelled or (lambda: False)
+        connection = colmap_db.connect(database_path)
+        image_ids = colmap_db.read_images(connection)
+        keypoint_counts = colmap_db.read_keypoint_counts(connection)
+
+        cached = cls.load(index_path) if index_path else None
+        if cached is None:
+            log("Training the retrieval vocabulary on the dataset descriptors")
+            tree = VocabularyTree.train(sample_training_descriptors(connection, image_ids))
+            cached_rows = {}
+        else:
+            tree = cached.tree
+            cached_rows = {(name, fingerprint): row
+                           for row, (name, fingerprint) in enumerate(zip(cached.names, cached.fingerprints))}
+
+        names = sorted(image_ids)
+        fingerprints = [int(keypoint_counts.get(image_ids[name], 0)) for name in names]
+        histograms = np.zeros((len(names), tree.num_words), dtype=np.float32)
+        num_quantized = 0
+        for row, name in enumerate(names):
+            cached_row = cached_rows.get((name, fingerprints[row]))
+            if cached_row is not None:
+                histograms[row] = cached.histograms[cached_row]
+                continue
+            if is_cancelled():
+                connection.close()
+                return None
+            descriptors = normalize_descriptors(colmap_db.read_descriptors(connection, image_ids[name]))
+            if len(descriptors):
+                histograms[row] = np.bincount(tree.quantize(descriptors), minlength=tree.num_words)
+            num_quantized += 1
+        connection.close()
+
+        log(f"Indexed {num_quantized} images, reused {len(names) - num_quantized} from the cached index")
+        index = cls(tree, names, histograms, fingerprints)
+        if index_path:
+            index.save(index_path)
+        return index
+
+    def weighted_vectors(self):
+        """Unit tf-idf vectors of the images"""
+        document_frequency = np.count_nonzero(self.histograms, axis=0)
+        idf = np.log(len(self.names) / np.maximum(document_frequency, 1)).astype(np.float32)
+        term_frequency = self.histograms / np.maximum(self.histograms.sum(axis=1, keepdims=True), 1.0)
+        vectors = term_frequency * idf
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def nearest_neighbors(self, num_neighbors):
+        """Most similar other images of each image, as lists of row indices"""
+        vectors = self.weighted_vectors()
+        num_neighbors = min(num_neighbors, len(self.names) - 1)
+        neighbors = []
+        if num_neighbors <= 0:
+            return [[] for _ in self.names]
+        for start in range(0, len(self.names), QUERY_BLOCK_SIZE):
+            scores = vectors[start:start + QUERY_BLOCK_SIZE] @ vectors.T
+            rows = np.arange(len(scores))
+            scores[rows, start + rows] = -np.inf
+            best = np.argpartition(-scores, num_neighbors - 1, axis=1)[:, :num_neighbors]
+            neighbors.extend(best.tolist())
+        return neighbors
+
+
+def retrieval_pairs(index, num_neighbors, sequential_overlap=0):
+    """Unique image name pairs from the top retrieval results, plus sequential neighbours for videos"""
+    pairs = set()
+    for row, neighbors in enumerate(index.nearest_neighbors(num_neighbors)):
+        for neighbor in neighbors:
+            pairs.add(tuple(sorted((index.names[row], index.names[neighbor]))))
+
+    # Names are sorted, so keyframes are in video order
+    for row in range(len(index.names)):
+        for offset in range(1, sequential_overlap + 1):
+            if row + offset < len(index.names):
+                pairs.add((index.names[row], index.names[row + offset]))
+    return sorted(pairs)
@@ -0,0 +1,455 @@
+import os
+import json
+import time
+import uuid
+import socket
+import argparse
+import threading
+from pipeline import ReconstructionPipeline, build_arg_parser, options_from_args
+from add_images import add_images
+from cache import StageCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE
+from progressive import progressive_reconstruction
+from progress import ThroughputHistory
+
+DEFAULT_JOBS_DIR = os.path.join(os.path.expanduser("~"), ".cache", "colmap_reconstruction", "jobs")
+
+# Resources reserved for a job that does not state its own needs
+DEFAULT_JOB_CORES = 8
+DEFAULT_JOB_MEMORY_MB = 4096
+
+# Fraction of the physical memory the scheduler hands out
+MEMORY_BUDGET_FRACTION = 0.8
+
+SCHEDULE_INTERVAL = 1.0
+
+# Progress of a running job is written next to its outputs at most this often
+PROGRESS_NAME = "progress.json"
+PROGRESS_INTERVAL = 1.0
+
+JOB_STATES = ("queued", "running", "done", "failed", "cancelled")
+
+# How a job runs its pipeline, like the --progressive and --add-images flags of pipeline.py
+JOB_MODES = ("full", "progressive", "add_images")
+
+
+def total_memory_mb():
+    """Physical memory of the machine in MB, or None when unknown"""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 2
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def current_owner():
+    """Identity of this process, recorded on the jobs it runs"""
+    return {"pid": os.getpid(), "host": socket.gethostname()}
+
+
+def owner_alive(owner):
+    """Whether the process that claimed a job may still be running it"""
+    if not owner or owner.get("host") != socket.gethostname():
+        # Processes on other machines sharing the jobs directory cannot be checked
+        return bool(owner)
+    try:
+        os.kill(owner["pid"], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def write_progress(path, progress):
+    """Atomically write the progress of a job"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, path)
+
+
+class JobStore:
+    """Jobs persisted as one JSON file each, so several processes can submit safely"""
+
+    def __init__(self, jobs_dir=DEFAULT_JOBS_DIR):
+        self.jobs_dir = jobs_dir
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def job_path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def cancel_path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.cancel")
+
+    def lock_path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.lock")
+
+    def owner(self, job_id):
+        """Process holding the lock of a job, or None"""
+        try:
+            with open(self.lock_path(job_id), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def claim(self, job_id, owner):
+        """Atomically take the lock of a job before running it, returns False if a live process holds it"""
+        for _ in range(2):
+            try:
+                fd = os.open(self.lock_path(job_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.break_stale_lock(job_id):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump(owner, f)
+            return True
+        return False
+
+    def break_stale_lock(self, job_id):
+        """Remove the lock of a job whose owner died, returns False if the owner is alive"""
+        stale_owner = self.owner(job_id)
+        if owner_alive(stale_owner):
+            return False
+        # Moved aside first, so that only one of several schedulers breaking the same lock removes it
+        stale_path = f"{self.lock_path(job_id)}.{uuid.uuid4().hex}"
+        try:
+            os.rename(self.lock_path(job_id), stale_path)
+        except OSError:
+            return True
+        try:
+            with open(stale_path, "r") as f:
+                moved_owner = json.load(f)
+        except (OSError, ValueError):
+            moved_owner = None
+        if moved_owner != stale_owner:
+            # Another scheduler claimed the job in between, its lock is put back
+            try:
+                os.link(stale_path, self.lock_path(job_id))
+            except OSError:
+                pass
+        os.remove(stale_path)
+        return True
+
+    def release(self, job_id, owner):
+        """Remove the lock of a job if owner holds it"""
+        if self.owner(job_id) == owner:
+            try:
+                os.remove(self.lock_path(job_id))
+            except OSError:
+                pass
+
+    def save(self, job):
+        """Atomically write a job"""
+        tmp_path = self.job_path(job["id"]) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(job, f, indent=2)
+        os.replace(tmp_path, self.job_path(job["id"]))
+
+    def load(self, job_id):
+        """Read a job, or None if it does not exist"""
+        try:
+            with open(self.job_path(job_id), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def list(self):
+        """All jobs, oldest first"""
+        jobs = []
+        for name in os.listdir(self.jobs_dir):
+            if name.endswith(".json"):
+                job = self.load(name[:-len(".json")])
+                if job is not None:
+                    jobs.append(job)
+        return sorted(jobs, key=lambda job: job["created"])
+
+    def submit(self, image_dir, output_dir, options=None, cores=None, memory_mb=None, job_id=None, mode="full"):
+        """Queue a reconstruction and return its job"""
+        if mode not in JOB_MODES:
+            raise ValueError(f"Unknown job mode '{mode}', expected one of {', '.join(JOB_MODES)}")
+        job = {
+            "id": job_id or uuid.uuid4().hex[:12],
+            "image_dir": os.path.abspath(image_dir),
+            "output_dir": os.path.abspath(output_dir),
+            "options": dict(options or {}),
+            "mode": mode,
+            "cores": cores,
+            "memory_mb": memory_mb,
+            "status": "queued",
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+        }
+        self.save(job)
+        return job
+
+    def request_cancel(self, job_id):
+        """Ask the scheduler to cancel a job"""
+        job = self.load(job_id)
+        if job is None:
+            return False
+        if job["status"] == "queued":
+            job["status"] = "cancelled"
+            job["finished"] = time.time()
+            self.save(job)
+        elif job["status"] == "running":
+            open(self.cancel_path(job_id), "w").close()
+        return True
+
+    def cancel_requested(self, job_id):
+        return os.path.exists(self.cancel_path(job_id))
+
+    def clear_cancel(self, job_id):
+        if os.path.exists(self.cancel_path(job_id)):
+            os.remove(self.cancel_path(job_id))
+
+
+class Scheduler:
+    """Runs queued reconstructions concurrently under a global core and memory budget"""
+
+    def __init__(self, store, cores=None, memory_mb=None, cache=None, log=print):
+        self.store = store
+        self.cores = cores or os.cpu_count() or 1
+        self.memory_mb = memory_mb or (total_memory_mb() or DEFAULT_JOB_MEMORY_MB) * MEMORY_BUDGET_FRACTION
+        self.cache = cache
+        self.history = ThroughputHistory()
+        self.log = log
+        self.owner = current_owner()
+
+        self.running = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def job_resources(self, job):
+        """(cores, memory in MB) reserved for a job, capped to the budget"""
+        cores = min(job.get("cores") or DEFAULT_JOB_CORES, self.cores)
+        memory_mb = min(job.get("memory_mb") or DEFAULT_JOB_MEMORY_MB, self.memory_mb)
+        return cores, memory_mb
+
+    def used_resources(self):
+        with self.lock:
+            cores = sum(entry["cores"] for entry in self.running.values())
+            memory_mb = sum(entry["memory_mb"] for entry in self.running.values())
+        return cores, memory_mb
+
+    def recover(self):
+        """Requeue jobs left running by a dead scheduler, they will resume from their checkpoints"""
+        for job in self.store.list():
+            if job["status"] != "running" or job["id"] in self.running:
+                continue
+            # Jobs run by another live scheduler sharing the jobs directory are left alone
+            if owner_alive(self.store.owner(job["id"])):
+                continue
+            if not self.store.break_stale_lock(job["id"]):
+                continue
+            job["status"] = "queued"
+            self.store.save(job)
+            self.log(f"Job {job['id']} requeued after restart")
+
+    def start(self):
+        """Start scheduling in a background thread"""
+        self.recover()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self, wait=True):
+        """Stop scheduling; running jobs are cancelled and will resume on the next start"""
+        self.stop_event.set()
+        if wait and self.thread is not None:
+            self.thread.join()
+            with self.lock:
+                threads = [entry["thread"] for entry in self.running.values()]
+            for thread in threads:
+                thread.join()
+
+    def loop(self):
+        while not self.stop_event.is_set():
+            self.schedule()
+            self.stop_event.wait(SCHEDULE_INTERVAL)
+
+    def schedule(self):
+        """Start as many queued jobs as the free resources allow, oldest first"""
+        used_cores, used_memory = self.used_resources()
+        for job in self.store.list():
+            if job["status"] != "queued" or job["id"] in self.running:
+                continue
+            cores, memory_mb = self.job_resources(job)
+            # Smaller jobs may overtake a large one that does not fit yet
+            if used_cores + cores > self.cores or used_memory + memory_mb > self.memory_mb:
+                continue
+            # Another scheduler sharing the jobs directory may take the same job
+            job_id = job["id"]
+            if not self.store.claim(job_id, self.owner):
+                continue
+            job = self.store.load(job_id)
+            if job is None or job["status"] != "queued":
+                self.store.release(job_id, self.owner)
+                continue
+            used_cores += cores
+            used_memory += memory_mb
+            self.launch(job, cores, memory_mb)
+
+    def launch(self, job, cores, memory_mb):
+        """Run a job in its own thread with the given thread count"""
+        job["status"] = "running"
+        job["started"] = time.time()
+        job["threads"] = cores
+        job["owner"] = self.owner
+        self.store.save(job)
+
+        thread = threading.Thread(target=self.run_job, args=(job,), name=f"job-{job['id']}", daemon=True)
+        with self.lock:
+            self.running[job["id"]] = {"thread": thread, "cores": cores, "memory_mb": memory_mb}
+        self.log(f"Starting job {job['id']} with {cores} threads and {memory_mb:.0f} MB")
+        thread.start()
+
+    def run_job(self, job):
+        """Run the pipeline of a job and record its outcome"""
+        job_id = job["id"]
+        os.makedirs(job["output_dir"], exist_ok=True)
+        log_path = os.path.join(job["output_dir"], "job.log")
+
+        options = dict(job["options"])
+        options["num_threads"] = job["threads"]
+
+        with open(log_path, "a") as log_file:
+            def log(message):
+                log_file.write(message + "\n")
+                log_file.flush()
+
+            progress_path = os.path.join(job["output_dir"], PROGRESS_NAME)
+            last_write = [0.0]
+
+            def progress(value, message=None, status=None):
+                if message:
+                    log(message)
+                now = time.time()
+                if now - last_write[0] < PROGRESS_INTERVAL and value < 100:
+                    return
+                last_write[0] = now
+                write_progress(progress_path, {"percent": value, "status": status, "updated": now})
+
+            pipeline = ReconstructionPipeline(
+                job["image_dir"],
+                job["output_dir"],
+                options,
+                log=log,
+                progress=progress,
+                is_cancelled=lambda: self.stop_event.is_set() or self.store.cancel_requested(job_id),
+                cache=self.cache,
+                history=self.history
+            )
+            mode = job.get("mode", "full")
+            try:
+                # Requeued jobs continue from their last finished stage
+                if mode == "progressive":
+                    success = progressive_reconstruction(
+                        job["image_dir"],
+                        job["output_dir"],
+                        options,
+                        log=log,
+                        progress=progress,
+                        is_cancelled=pipeline.is_cancelled,
+                        cache=self.cache,
+                        history=self.history,
+                        resume=True
+                    )
+                elif mode == "add_images":
+                    # Images already registered by an interrupted attempt are not added twice
+                    success = add_images(pipeline) and pipeline.run(resume=True)
+                else:
+                    success = pipeline.run(resume=True)
+            except Exception as e:
+                log(f"Error: {str(e)}")
+                success = False
+
+        job = self.store.load(job_id) or job
+        if self.store.cancel_requested(job_id):
+            job["status"] = "cancelled"
+            self.store.clear_cancel(job_id)
+        elif self.stop_event.is_set() and not success:
+            # Interrupted by shutdown, picked up again on the next start
+            job["status"] = "queued"
+        else:
+            job["status"] = "done" if success else "failed"
+        job["finished"] = time.time() if job["status"] != "queued" else None
+        self.store.save(job)
+        self.store.release(job_id, self.owner)
+
+        with self.lock:
+            del self.running[job_id]
+        self.log(f"Job {job_id} {job['status']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Queue and run several reconstructions under a resource budget")
+    parser.add_argument("--jobs-dir", default=DEFAULT_JOBS_DIR, help="Directory holding the persisted jobs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the scheduler until interrupted")
+    run_parser.add_argument("--cores", type=int, help="Total cores to hand out (default: all)")
+    run_parser.add_argument("--memory-gb", type=float, help="Total memory to hand out (default: 80%% of RAM)")
+    run_parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory of the stage output cache")
+    run_parser.add_argument("--cache-size-gb", type=float, default=DEFAULT_CACHE_SIZE / 1024 ** 3,
+                            help="Size cap of the stage output cache")
+    run_parser.add_argument("--no-cache", dest="use_cache", action="store_false", help="Disable the stage output cache")
+
+    submit_parser = subparsers.add_parser("submit", help="Queue a reconstruction", parents=[build_arg_parser()],
+                                          add_help=False, conflict_handler="resolve")
+    submit_parser.add_argument("--cores", type=int, help=f"Cores for this job (default: {DEFAULT_JOB_CORES})")
+    submit_parser.add_argument("--memory-gb", type=float, help="Memory reserved for this job")
+
+    subparsers.add_parser("list", help="List the jobs")
+
+    cancel_parser = subparsers.add_parser("cancel", help="Cancel a queued or running job")
+    cancel_parser.add_argument("job_id")
+
+    args, _ = parser.parse_known_args()
+    if args.command == "submit" and args.options_file:
+        # Options from the file replace the defaults, explicit flags still win, as in pipeline.py
+        with open(args.options_file, "r") as f:
+            submit_parser.set_defaults(**json.load(f))
+    args = parser.parse_args()
+    store = JobStore(args.jobs_dir)
+
+    if args.command == "run":
+        memory_mb = args.memory_gb * 1024 if args.memory_gb else None
+        cache = StageCache(args.cache_dir, int(args.cache_size_gb * 1024 ** 3)) if args.use_cache else None
+        scheduler = Scheduler(store, args.cores, memory_mb, cache=cache)
+        scheduler.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            scheduler.log("Stopping, running jobs will resume on the next start")
+            scheduler.stop()
+    elif args.command == "submit":
+        # The cache is shared by the jobs of a scheduler, jobs always resume from their checkpoints
+        if args.cache_dir != DEFAULT_CACHE_DIR or args.cache_size_gb != DEFAULT_CACHE_SIZE / 1024 ** 3 \
+                or not args.use_cache:
+            submit_parser.error("--cache-dir, --cache-size-gb and --no-cache are options of 'scheduler.py run'")
+        if args.progressive and args.add_images:
+            submit_parser.error("--progressive and --add-images cannot be combined")
+        mode = "progressive" if args.progressive else "add_images" if args.add_images else "full"
+        memory_mb = args.memory_gb * 1024 if args.memory_gb else None
+        job = store.submit(args.image_dir, args.output_dir, options_from_args(args), args.cores, memory_mb,
+                           mode=mode)
+        print(job["id"])
+    elif args.command == "list":
+        for job in store.list():
+            print(f"{job['id']}  {job['status']:<9}  {job['image_dir']} -> {job['output_dir']}")
+    elif args.command == "cancel":
+        if not store.request_cancel(args.job_id):
+            raise SystemExit(f"Unknown job {args.job_id}")
+
+if __name__ == "__main__":
+    main()
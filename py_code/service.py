@@ -0,0 +1,385 @@
+import os
+import json
+import uuid
+import shutil
+import tarfile
+import zipfile
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from pipeline import DEFAULT_OPTIONS, MANIFEST_NAME, METRICS_NAME, MATCH_METHODS, STAGES
+from storage import RETENTION_POLICIES
+from add_images import IMAGE_EXTENSIONS
+from cache import StageCache
+from scheduler import JobStore, Scheduler, DEFAULT_JOBS_DIR, PROGRESS_NAME
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_WORKSPACE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "colmap_reconstruction", "service")
+
+# Uploads and downloads are copied in chunks of this size, never held in memory
+CHUNK_SIZE = 1024 ** 2
+MAX_UPLOAD_SIZE = 50 * 1024 ** 3
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz")
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".m4v", ".webm")
+
+# Options clients may set, never file paths on the server
+UPLOAD_OPTIONS = (
+    "max_image_size", "max_num_features", "match_method", "dense", "prepare_images", "mask_images",
+    "mask_center_fraction", "mask_dilation", "use_gpu", "min_num_matches", "retrieval_num_neighbors",
+    "retrieval_sequential_overlap", "prune_images", "prune_min_degree", "prune_duplicate_overlap",
+    "mapper_min_model_size", "mapper_max_extra_param", "partition_mapping", "max_cluster_size", "cluster_overlap",
+    "export_sparse", "patch_match_window_radius", "patch_match_window_step", "cpu_stereo_max_image_size",
+    "cpu_stereo_num_depths", "cpu_stereo_num_sources", "fusion_min_num_pixels", "filter_points",
+    "crop_point_cloud", "crop_margin", "voxel_size", "outlier_min_neighbors", "meshing_trim", "mesh_lod",
+    "lod_triangle_budgets", "retention", "evaluation_thresholds", "trace", "isolate_stages",
+)
+PATH_OPTIONS = ("video_path", "match_pairs_path", "pose_prior_path", "reference_model", "reference_alignment")
+OPTION_CHOICES = {"match_method": MATCH_METHODS, "retention": RETENTION_POLICIES}
+
+# Files clients may download, relative to the output directory
+DOWNLOADS = {
+    "sparse": "sparse",
+    "sparse_columns": "sparse_columns",
+    "fused.ply": os.path.join("dense", "fused.ply"),
+    "filtered.ply": os.path.join("dense", "filtered.ply"),
+    "meshed.ply": os.path.join("dense", "meshed.ply"),
+    "lod": os.path.join("dense", "lod"),
+}
+
+
+class RequestError(Exception):
+    """Error reported to the client with an HTTP status"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_option(key, value):
+    """Convert a query string value to the type of the default option"""
+    default = DEFAULT_OPTIONS[key]
+    if isinstance(default, bool):
+        if value.lower() in ("1", "true", "yes", "on"):
+            return True
+        if value.lower() in ("0", "false", "no", "off"):
+            return False
+        raise ValueError(f"expected a boolean, got '{value}'")
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    if isinstance(default, list):
+        item_type = type(default[0]) if default else float
+        return [item_type(item) for item in value.split(",") if item]
+    if key in OPTION_CHOICES and value not in OPTION_CHOICES[key]:
+        raise ValueError(f"{key} must be one of {', '.join(OPTION_CHOICES[key])}")
+    return value
+
+
+def safe_member_path(root, name):
+    """Destination of an archive member, or None if it would escape the root"""
+    path = os.path.realpath(os.path.join(root, name))
+    if not path.startswith(os.path.realpath(root) + os.sep):
+        return None
+    return path
+
+
+def extract_images(archive_path, image_dir):
+    """Extract the images of a zip or tar archive, returning their number"""
+    os.makedirs(image_dir, exist_ok=True)
+    count = 0
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for member in archive.infolist():
+                path = safe_member_path(image_dir, member.filename)
+                if member.is_dir() or path is None or not path.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with archive.open(member) as src, open(path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                count += 1
+    else:
+        # Streamed member by member, the archive may be compressed
+        with tarfile.open(archive_path, "r|*") as archive:
+            for member in archive:
+                path = safe_member_path(image_dir, member.name)
+                if not member.isfile() or path is None or not path.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with archive.extractfile(member) as src, open(path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                count += 1
+    return count
+
+
+class ReconstructionServer(ThreadingHTTPServer):
+    """HTTP server sharing one job queue between several clients"""
+
+    daemon_threads = True
+
+    def __init__(self, address, store, workspace_dir=DEFAULT_WORKSPACE_DIR, log=print):
+        super().__init__(address, ReconstructionRequestHandler)
+        self.store = store
+        self.workspace_dir = workspace_dir
+        self.log = log
+        os.makedirs(workspace_dir, exist_ok=True)
+
+
+class ReconstructionRequestHandler(BaseHTTPRequestHandler):
+    """REST endpoints of the reconstruction service
+
+    POST   /jobs?filename=<name>&<option>=<value>  upload images (zip/tar) or a video and queue a job
+    GET    /jobs                                   list the jobs
+    GET    /jobs/<id>                              job status
+    GET    /jobs/<id>/progress                     progress and finished stages
+    GET    /jobs/<id>/metrics                      metrics of the run
+    GET    /jobs/<id>/download/<name>              sparse, sparse_columns or lod (tar), fused.ply, filtered.ply or meshed.ply
+    DELETE /jobs/<id>                              cancel the job
+    """
+
+    server_version = "ColmapReconstruction/1.0"
+
+    def log_message(self, format, *args):
+        self.server.log(f"{self.address_string()} {format % args}")
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, indent=2).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self):
+        """(path parts, query) of the request"""
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        if not parts or parts[0] != "jobs":
+            raise RequestError(404, "Not found")
+        return parts[1:], parse_qs(url.query)
+
+    def load_job(self, job_id):
+        job = self.server.store.load(job_id)
+        if job is None:
+            raise RequestError(404, f"Unknown job {job_id}")
+        return job
+
+    def handle_request(self, method):
+        try:
+            parts, query = self.route()
+            method(parts, query)
+        except RequestError as e:
+            self.send_json({"error": str(e)}, e.status)
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.log(f"{self.address_string()} disconnected")
+        except OSError as e:
+            # Disk full, missing outputs removed by another process...
+            self.server.log(f"{self.address_string()} {self.command} {self.path} failed: {e}")
+            self.send_json({"error": f"Server error: {e}"}, 500)
+
+    def do_GET(self):
+        self.handle_request(self.get)
+
+    def do_POST(self):
+        self.handle_request(self.post)
+
+    def do_DELETE(self):
+        self.handle_request(self.delete)
+
+    def get(self, parts, query):
+        if not parts:
+            self.send_json(self.server.store.list())
+            return
+        job = self.load_job(parts[0])
+        if len(parts) == 1:
+            self.send_json(job)
+        elif parts[1:] == ["progress"]:
+            self.send_json(self.job_progress(job))
+        elif parts[1:] == ["metrics"]:
+            metrics_path = os.path.join(job["output_dir"], METRICS_NAME)
+            if not os.path.exists(metrics_path):
+                raise RequestError(404, "No metrics yet")
+            self.send_file(metrics_path, "application/json")
+        elif len(parts) == 3 and parts[1] == "download":
+            self.download(job, parts[2])
+        else:
+            raise RequestError(404, "Not found")
+
+    def post(self, parts, query):
+        if parts:
+            raise RequestError(404, "Not found")
+        filename = os.path.basename(query.get("filename", [""])[0])
+        if not filename.lower().endswith(ARCHIVE_EXTENSIONS + VIDEO_EXTENSIONS):
+            raise RequestError(400, "filename must name an image archive (zip, tar) or a video")
+
+        options = {}
+        cores = memory_mb = None
+        try:
+            for key, values in query.items():
+                if key == "filename":
+                    continue
+                if key == "cores":
+                    cores = int(values[-1])
+                elif key == "memory_gb":
+                    memory_mb = float(values[-1]) * 1024
+                elif key in UPLOAD_OPTIONS:
+                    options[key] = parse_option(key, values[-1])
+                elif key in PATH_OPTIONS:
+                    raise RequestError(400, f"Option '{key}' names a server path and cannot be set")
+                else:
+                    raise RequestError(400, f"Unknown option '{key}'")
+        except ValueError as e:
+            raise RequestError(400, str(e))
+
+        job_id = uuid.uuid4().hex[:12]
+        workspace = os.path.join(self.server.workspace_dir, job_id)
+        image_dir = os.path.join(workspace, "images")
+        output_dir = os.path.join(workspace, "output")
+        upload_path = os.path.join(workspace, "upload", filename)
+        try:
+            self.receive_upload(upload_path)
+            if filename.lower().endswith(VIDEO_EXTENSIONS):
+                options["video_path"] = upload_path
+            else:
+                try:
+                    num_images = extract_images(upload_path, image_dir)
+                except (tarfile.TarError, zipfile.BadZipFile, EOFError) as e:
+                    raise RequestError(400, f"Invalid archive: {e}")
+                os.remove(upload_path)
+                if num_images == 0:
+                    raise RequestError(400, "The archive contains no images")
+        except Exception:
+            shutil.rmtree(workspace, ignore_errors=True)
+            raise
+
+        job = self.server.store.submit(image_dir, output_dir, options, cores, memory_mb, job_id=job_id)
+        self.server.log(f"Queued job {job_id} from {self.address_string()}")
+        self.send_json(job, 201)
+
+    def delete(self, parts, query):
+        if len(parts) != 1:
+            raise RequestError(404, "Not found")
+        self.load_job(parts[0])
+        self.server.store.request_cancel(parts[0])
+        self.send_json(self.server.store.load(parts[0]), 202)
+
+    def receive_upload(self, path):
+        """Stream the request body to a file in fixed size chunks"""
+        length = self.headers.get("Content-Length")
+        if length is None:
+            raise RequestError(411, "Content-Length is required")
+        try:
+            remaining = int(length)
+        except ValueError:
+            raise RequestError(400, f"Invalid Content-Length '{length}'")
+        if remaining < 0:
+            raise RequestError(400, f"Invalid Content-Length '{length}'")
+        if remaining > MAX_UPLOAD_SIZE:
+            raise RequestError(413, "Upload too large")
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".part", "wb") as f:
+            while remaining > 0:
+                chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise RequestError(400, "Upload ended early")
+                f.write(chunk)
+                remaining -= len(chunk)
+        os.replace(path + ".part", path)
+
+    def job_progress(self, job):
+        """Latest progress report and checkpointed stages of a job"""
+        progress = {"id": job["id"], "status": job["status"], "percent": None, "stage_status": None}
+        try:
+            with open(os.path.join(job["output_dir"], PROGRESS_NAME), "r") as f:
+                report = json.load(f)
+            progress["percent"] = report["percent"]
+            progress["stage_status"] = report["status"]
+            progress["updated"] = report["updated"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        stages = {}
+        try:
+            with open(os.path.join(job["output_dir"], MANIFEST_NAME), "r") as f:
+                stages = json.load(f).get("stages", {})
+        except (OSError, ValueError):
+            pass
+        progress["completed_stages"] = [stage for stage in STAGES
+                                        if stages.get(stage, {}).get("status") == "done"]
+        if job["status"] == "done":
+            progress["percent"] = 100.0
+        return progress
+
+    def download(self, job, name):
+        if name not in DOWNLOADS:
+            raise RequestError(404, f"Unknown download '{name}'")
+        path = os.path.join(job["output_dir"], DOWNLOADS[name])
+        if not os.path.exists(path):
+            raise RequestError(404, f"{name} is not available yet")
+        if os.path.isdir(path):
+            self.send_tar(path, name)
+        else:
+            self.send_file(path, "application/octet-stream", attachment=name)
+
+    def send_file(self, path, content_type, attachment=None):
+        """Stream a file with its length known up front"""
+        with open(path, "rb") as f:
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            if attachment:
+                self.send_header("Content-Disposition", f'attachment; filename="{attachment}"')
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+
+    def send_tar(self, path, name):
+        """Stream a directory as a tar archive, the end of the body is marked by closing the connection"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-tar")
+        self.send_header("Content-Disposition", f'attachment; filename="{name}.tar"')
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        with tarfile.open(fileobj=self.wfile, mode="w|") as archive:
+            archive.add(path, arcname=name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve reconstructions over HTTP to several clients")
+    parser.add_argument("--host", default=DEFAULT_HOST,
+                        help="Address to listen on (default: localhost only, use 0.0.0.0 to share on the network)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--jobs-dir", default=DEFAULT_JOBS_DIR, help="Directory holding the persisted jobs")
+    parser.add_argument("--workspace-dir", default=DEFAULT_WORKSPACE_DIR,
+                        help="Directory receiving uploads and reconstruction outputs")
+    parser.add_argument("--cores", type=int, help="Total cores to hand out (default: all)")
+    parser.add_argument("--memory-gb", type=float, help="Total memory to hand out (default: 80%% of RAM)")
+    parser.add_argument("--no-cache", dest="use_cache", action="store_false", help="Disable the stage output cache")
+    parser.add_argument("--no-scheduler", dest="run_scheduler", action="store_false",
+                        help="Only queue jobs, they are run by a separate 'scheduler.py run'")
+    args = parser.parse_args()
+
+    # The queue is shared with the GUI and 'scheduler.py run', their schedulers claim each job before running it
+    store = JobStore(args.jobs_dir)
+    scheduler = None
+    if args.run_scheduler:
+        memory_mb = args.memory_gb * 1024 if args.memory_gb else None
+        scheduler = Scheduler(store, args.cores, memory_mb, cache=StageCache() if args.use_cache else None)
+        scheduler.start()
+
+    server = ReconstructionServer((args.host, args.port), store, args.workspace_dir)
+    server.log(f"Serving on http://{args.host}:{args.port}/jobs")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.log("Stopping, running jobs will resume on the next start")
+    finally:
+        server.server_close()
+        if scheduler is not None:
+            scheduler.stop()
+
+if __name__ == "__main__":
+    main()
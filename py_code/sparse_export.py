@@ -0,0 +1,147 @@
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+
+# Directory of the columnar copy of sparse/0, in the output directory
+COLUMNS_DIR_NAME = "sparse_columns"
+COLUMNS_MANIFEST_NAME = "manifest.json"
+COLUMNS_FORMAT_VERSION = 1
+
+
+def write_columns(output_dir, arrays, manifest):
+    """Write every array as its own .npy file with a manifest describing them, replacing output_dir at once"""
+    tmp_dir = output_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    manifest["arrays"] = {}
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), values)
+        manifest["arrays"][name] = {"file": name + ".npy", "dtype": values.dtype.str, "shape": list(values.shape)}
+    with open(os.path.join(tmp_dir, COLUMNS_MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(tmp_dir, output_dir)
+
+
+def export_reconstruction(reconstruction, output_dir, source="", log=print):
+    """Columnar copy of a pycolmap reconstruction: points, CSR packed tracks, cameras and registered image poses"""
+    # Step 1: Observations of the registered images, gathered image by image
+    image_ids = sorted(reconstruction.reg_image_ids())
+    observation_points, observation_images, observation_indices, observation_xy = [], [], [], []
+    for image_id in image_ids:
+        image = reconstruction.images[image_id]
+        for index, point2D in enumerate(image.points2D):
+            if point2D.has_point3D():
+                observation_points.append(point2D.point3D_id)
+                observation_images.append(image_id)
+                observation_indices.append(index)
+                observation_xy.append(point2D.xy)
+
+    # Step 2: Points sorted by id, their observations packed in the same order
+    point_ids = np.array(sorted(reconstruction.points3D.keys()), dtype=np.uint64)
+    points = [reconstruction.points3D[int(point_id)] for point_id in point_ids]
+    observation_rows = np.searchsorted(point_ids, np.array(observation_points, dtype=np.uint64))
+    order = np.argsort(observation_rows, kind="stable")
+    track_offsets = np.zeros(len(point_ids) + 1, dtype=np.int64)
+    track_offsets[1:] = np.cumsum(np.bincount(observation_rows, minlength=len(point_ids)))
+
+    # Step 3: Intrinsics padded to the longest parameter list of the models used
+    camera_ids = sorted(reconstruction.cameras.keys())
+    cameras = [reconstruction.cameras[camera_id] for camera_id in camera_ids]
+    num_params = max([len(camera.params) for camera in cameras], default=0)
+    camera_params = np.full((len(cameras), num_params), np.nan)
+    for row, camera in enumerate(cameras):
+        camera_params[row, :len(camera.params)] = camera.params
+
+    images = [reconstruction.images[image_id] for image_id in image_ids]
+    arrays = {
+        "point_ids": point_ids,
+        "point_xyz": np.array([point.xyz for point in points], dtype=np.float64).reshape(-1, 3),
+        "point_rgb": np.array([point.color for point in points], dtype=np.uint8).reshape(-1, 3),
+        "point_error": np.array([point.error for point in points], dtype=np.float64),
+        "track_offsets": track_offsets,
+        "track_image_ids": np.array(observation_images, dtype=np.uint32)[order],
+        "track_point2D_idx": np.array(observation_indices, dtype=np.uint32)[order],
+        "track_xy": np.array(observation_xy, dtype=np.float32).reshape(-1, 2)[order],
+        "camera_ids": np.array(camera_ids, dtype=np.uint32),
+        "camera_models": np.array([camera.model.name for camera in cameras], dtype=np.bytes_),
+        "camera_sizes": np.array([(camera.width, camera.height) for camera in cameras], dtype=np.uint32)
+        .reshape(-1, 2),
+        "camera_params": camera_params,
+        "image_ids": np.array(image_ids, dtype=np.uint32),
+        "image_camera_ids": np.array([image.camera_id for image in images], dtype=np.uint32),
+        "image_names": np.array([image.name.encode("utf-8") for image in images], dtype=np.bytes_),
+        "image_cam_from_world": np.array([image.cam_from_world.matrix() for image in images], dtype=np.float64)
+        .reshape(-1, 3, 4),
+    }
+    manifest = {
+        "version": COLUMNS_FORMAT_VERSION,
+        "source": source,
+        "num_points": len(point_ids),
+        "num_observations": int(track_offsets[-1]),
+        "num_cameras": len(cameras),
+        "num_images": len(images),
+    }
+    write_columns(output_dir, arrays, manifest)
+    log(f"Exported {len(point_ids)} points, {track_offsets[-1]} observations and {len(images)} images "
+        f"to {output_dir}")
+    return manifest
+
+
+class SparseColumns:
+    """Memory mapped columnar sparse model, arrays are read from disk only when sliced"""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, COLUMNS_MANIFEST_NAME), "r") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("version") != COLUMNS_FORMAT_VERSION:
+            raise ValueError(f"{directory} has columnar format version {self.manifest.get('version')}, "
+                             f"expected {COLUMNS_FORMAT_VERSION}")
+        self.directory = directory
+        for name, description in self.manifest["arrays"].items():
+            setattr(self, name, np.load(os.path.join(directory, description["file"]), mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.point_ids)
+
+    def point_index(self, point_id):
+        """Row of a 3D point id, or None"""
+        row = int(np.searchsorted(self.point_ids, point_id))
+        if row < len(self.point_ids) and self.point_ids[row] == point_id:
+            return row
+        return None
+
+    def track(self, row):
+        """(image ids, point2D indices, xy) observing the point of a row"""
+        start, end = self.track_offsets[row], self.track_offsets[row + 1]
+        return self.track_image_ids[start:end], self.track_point2D_idx[start:end], self.track_xy[start:end]
+
+    def track_lengths(self):
+        """Number of observations of every point"""
+        return np.diff(self.track_offsets)
+
+    def image_centers(self):
+        """(M, 3) camera centers of the images, in world coordinates"""
+        rotations = self.image_cam_from_world[:, :, :3]
+        translations = self.image_cam_from_world[:, :, 3]
+        return -np.einsum("nji,nj->ni", rotations, translations)
+
+    def image_name_list(self):
+        """Names of the images, decoded"""
+        return [name.decode("utf-8") for name in self.image_names]
+
+
+def main():
+    # pycolmap is only needed to export, loading the arrays only needs NumPy
+    import pycolmap
+
+    parser = argparse.ArgumentParser(description="Export a COLMAP sparse model as memory-mappable NumPy arrays")
+    parser.add_argument("model", help="Sparse model directory, such as sparse/0")
+    parser.add_argument("output_dir")
+    args = parser.parse_args()
+    export_reconstruction(pycolmap.Reconstruction(args.model), args.output_dir, os.path.abspath(args.model))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import time
+import queue
+import traceback
+import multiprocessing
+
+# How often the parent checks the cancel flag and forwards worker messages
+POLL_INTERVAL = 0.2
+
+# Grace period between terminate and kill
+TERMINATE_TIMEOUT = 5.0
+
+
+class QueueTracker:
+    """Stand-in for the progress tracker inside a worker, forwarding counts to the parent"""
+
+    def __init__(self, events):
+        self.events = events
+
+    def increment(self, *args):
+        self.events.put(("increment", None))
+
+
+def stage_worker(image_dir, output_dir, options, stage, events):
+    """Entry point of the worker process running a single stage"""
+    # Imported here because the pipeline module imports this one
+    from pipeline import ReconstructionPipeline
+    from metrics import process_usage
+
+    def log(message):
+        events.put(("log", message))
+
+    try:
+        pipeline = ReconstructionPipeline(image_dir, output_dir, options, log=log)
+        pipeline.tracker = QueueTracker(events)
+        success = getattr(pipeline, stage)()
+        # This process only ran the stage, so its peak memory and I/O are those of the stage
+        events.put(("usage", process_usage()))
+        events.put(("result", bool(success)))
+    except Exception as e:
+        events.put(("error", f"{e}\n{traceback.format_exc()}"))
+
+
+def forward_events(pipeline, events, outcome):
+    """Forward queued worker messages to the parent pipeline"""
+    while True:
+        try:
+            kind, value = events.get_nowait()
+        except queue.Empty:
+            return
+        if kind == "log":
+            pipeline.log(value)
+        elif kind == "increment":
+            if pipeline.tracker is not None:
+                pipeline.tracker.increment()
+        else:
+            outcome[kind] = value
+
+
+def run_stage_in_process(pipeline, stage):
+    """Run a stage in a supervised worker process that is killed as soon as the run is cancelled"""
+    context = multiprocessing.get_context("spawn")
+    events = context.Queue()
+    process = context.Process(
+        target=stage_worker,
+        args=(pipeline.image_dir, pipeline.output_dir, pipeline.options, stage, events),
+        name=f"stage-{stage}",
+        daemon=True
+    )
+    process.start()
+
+    outcome = {}
+    cancelled = False
+    while process.is_alive():
+        forward_events(pipeline, events, outcome)
+        if pipeline.is_cancelled():
+            cancelled = True
+            process.terminate()
+            process.join(TERMINATE_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+            break
+        process.join(POLL_INTERVAL)
+    process.join()
+    forward_events(pipeline, events, outcome)
+    events.close()
+
+    if cancelled:
+        # Partial outputs of an interrupted stage are never valid
+        pipeline.reset_stage(stage)
+        pipeline.log(f"Stage '{stage}' interrupted")
+        return False
+
+    if "error" in outcome:
+        pipeline.reset_stage(stage)
+        raise RuntimeError(f"Stage '{stage}' failed: {outcome['error']}")
+    if "result" not in outcome:
+        pipeline.reset_stage(stage)
+        raise RuntimeError(f"Stage '{stage}' worker exited with code {process.exitcode}")
+    pipeline.worker_usage = outcome.get("usage")
+    return outcome["result"]
+
+
+def run_in_pool(function, tasks, num_workers, is_cancelled, on_result=None):
+    """Run function over argument tuples in a spawned process pool, returns False if cancelled"""
+    context = multiprocessing.get_context("spawn")
+    pool = context.Pool(num_workers)
+    try:
+        results = [pool.apply_async(function, task) for task in tasks]
+        pending = set(range(len(results)))
+        while pending:
+            if is_cancelled():
+                # Workers are killed at once, like isolated stages
+                pool.terminate()
+                return False
+            for index in sorted(index for index in pending if results[index].ready()):
+                pending.discard(index)
+                value = results[index].get()
+                if on_result is not None:
+                    on_result(index, value)
+            time.sleep(POLL_INTERVAL)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return True
@@ -0,0 +1,269 @@
+import os
+import zlib
+import shutil
+import struct
+import argparse
+import numpy as np
+from stage_runner import run_in_pool
+
+RETENTION_POLICIES = ("keep", "compress", "discard")
+
+# Compressed depth and normal maps are stored next to the COLMAP ones with this suffix
+COMPRESSED_SUFFIX = ".z"
+MAP_MAGIC = b"ZMAP"
+MAP_VERSION = 1
+
+# Rows of one channel held in memory and compressed together
+ROWS_PER_CHUNK = 64
+COMPRESSION_LEVEL = 3
+
+MAP_DIRS = ("depth_maps", "normal_maps")
+
+# Written by patch match for debugging only, nothing downstream reads them
+DISCARDED_MAP_DIRS = ("consistency_graphs",)
+
+# Dense directories removed by the discard policy, by the stage producing them
+DISCARDED_OUTPUTS = {
+    "undistort_images": "images",
+    "patch_match_stereo": os.path.join("stereo", "depth_maps"),
+}
+
+# Directories whose entries are measured one by one in the footprint of a run
+EXPANDED_DIRS = ("dense", os.path.join("dense", "stereo"))
+
+
+def path_size(path):
+    """Bytes used by a file or by everything under a directory"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # Removed while walking
+                pass
+    return total
+
+
+def footprint(output_dir):
+    """Bytes used by each entry of an output directory, with the dense workspace split further"""
+    sizes = {}
+
+    def measure(relative_dir):
+        directory = os.path.join(output_dir, relative_dir)
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            relative_path = os.path.join(relative_dir, name) if relative_dir else name
+            if relative_path in EXPANDED_DIRS and os.path.isdir(os.path.join(output_dir, relative_path)):
+                measure(relative_path)
+            else:
+                sizes[relative_path] = path_size(os.path.join(output_dir, relative_path))
+
+    measure("")
+    return sizes
+
+
+def read_map_header(f):
+    """(width, height, channels) of a COLMAP depth or normal map, leaving f at the first value"""
+    header = b""
+    while header.count(b"&") < 3:
+        character = f.read(1)
+        if not character:
+            raise ValueError(f"{f.name} is not a COLMAP depth or normal map")
+        header += character
+    width, height, channels = (int(value) for value in header.split(b"&")[:3])
+    return width, height, channels
+
+
+def shuffle_bytes(values):
+    """Group the bytes of float32 values by significance, which zlib compresses much better"""
+    return np.ascontiguousarray(values.view(np.uint8).reshape(-1, 4).T).tobytes()
+
+
+def unshuffle_bytes(data):
+    """float32 values of byte shuffled data"""
+    return np.ascontiguousarray(np.frombuffer(data, np.uint8).reshape(4, -1).T).view(np.float32).ravel()
+
+
+def compress_map(path, output_path):
+    """Chunked, byte shuffled zlib copy of a COLMAP map, one band of rows of one channel per chunk"""
+    tmp_path = output_path + ".tmp"
+    with open(path, "rb") as source, open(tmp_path, "wb") as f:
+        width, height, channels = read_map_header(source)
+        # COLMAP stores each channel as a row-major plane, so chunks follow the file order
+        chunk_rows = [min(ROWS_PER_CHUNK, height - start) for _ in range(channels)
+                      for start in range(0, height, ROWS_PER_CHUNK)]
+        f.write(MAP_MAGIC + struct.pack("<6I", MAP_VERSION, width, height, channels, ROWS_PER_CHUNK,
+                                        len(chunk_rows)))
+        table_offset = f.tell()
+        f.write(b"\0" * 8 * len(chunk_rows))
+        sizes = []
+        for rows in chunk_rows:
+            values = np.fromfile(source, np.float32, rows * width)
+            if len(values) != rows * width:
+                raise ValueError(f"{path} is truncated")
+            data = zlib.compress(shuffle_bytes(values), COMPRESSION_LEVEL)
+            f.write(data)
+            sizes.append(len(data))
+        f.seek(table_offset)
+        f.write(struct.pack(f"<{len(sizes)}Q", *sizes))
+    os.replace(tmp_path, output_path)
+
+
+def iter_map_chunks(path):
+    """Stream a compressed map as (channel, first row, (rows, width) float32 array) chunks"""
+    with open(path, "rb") as f:
+        if f.read(4) != MAP_MAGIC:
+            raise ValueError(f"{path} is not a compressed map")
+        version, width, height, channels, rows_per_chunk, num_chunks = struct.unpack("<6I", f.read(24))
+        if version != MAP_VERSION:
+            raise ValueError(f"{path} has version {version}, expected {MAP_VERSION}")
+        sizes = struct.unpack(f"<{num_chunks}Q", f.read(8 * num_chunks))
+        bands = -(-height // rows_per_chunk)
+        for index, size in enumerate(sizes):
+            channel, start = divmod(index, bands)
+            start *= rows_per_chunk
+            values = unshuffle_bytes(zlib.decompress(f.read(size)))
+            yield channel, start, values.reshape(-1, width)
+
+
+def map_shape(path):
+    """(height, width, channels) of a compressed map"""
+    with open(path, "rb") as f:
+        if f.read(4) != MAP_MAGIC:
+            raise ValueError(f"{path} is not a compressed map")
+        _, width, height, channels = struct.unpack("<4I", f.read(16))
+    return height, width, channels
+
+
+def read_compressed_map(path):
+    """Whole compressed map, shaped like cpu_stereo.read_array"""
+    height, width, channels = map_shape(path)
+    array = np.zeros((height, width, channels), dtype=np.float32)
+    for channel, start, rows in iter_map_chunks(path):
+        array[start:start + len(rows), :, channel] = rows
+    return array.squeeze()
+
+
+def restore_map(path, output_path):
+    """Write a compressed map back in the COLMAP format, one chunk at a time"""
+    height, width, channels = map_shape(path)
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(f"{width}&{height}&{channels}&".encode())
+        for _, _, rows in iter_map_chunks(path):
+            rows.tofile(f)
+    os.replace(tmp_path, output_path)
+
+
+def map_files(stereo_dir, suffix):
+    """Paths of the maps of a stereo workspace ending with suffix"""
+    paths = []
+    for name in MAP_DIRS:
+        for root, dirs, files in os.walk(os.path.join(stereo_dir, name)):
+            paths.extend(os.path.join(root, file_name) for file_name in sorted(files) if file_name.endswith(suffix))
+    return paths
+
+
+def compress_map_file(path):
+    """Worker entry point replacing a COLMAP map by its compressed copy"""
+    compress_map(path, path + COMPRESSED_SUFFIX)
+    os.remove(path)
+
+
+def restore_map_file(path):
+    """Worker entry point replacing a compressed map by its COLMAP copy"""
+    restore_map(path, path[:-len(COMPRESSED_SUFFIX)])
+    os.remove(path)
+
+
+def convert_maps(function, paths, num_workers, is_cancelled):
+    """Run a map conversion over paths, returning False if cancelled"""
+    is_cancelled = is_cancelled or (lambda: False)
+    if num_workers <= 1:
+        # Daemon stage workers cannot start a pool of their own
+        for path in paths:
+            if is_cancelled():
+                return False
+            function(path)
+        return True
+    return run_in_pool(function, [(path,) for path in paths], min(num_workers, max(1, len(paths))), is_cancelled)
+
+
+def compress_maps(stereo_dir, num_workers=1, is_cancelled=None, log=print):
+    """Compress the depth and normal maps of a stereo workspace, returns the bytes freed or None"""
+    paths = map_files(stereo_dir, ".bin")
+    if not paths:
+        return 0
+    before = sum(os.path.getsize(path) for path in paths)
+    if not convert_maps(compress_map_file, paths, num_workers, is_cancelled):
+        return None
+    after = sum(os.path.getsize(path + COMPRESSED_SUFFIX) for path in paths)
+    log(f"Compressed {len(paths)} depth and normal maps from {before / 1024 ** 2:.0f} MB "
+        f"to {after / 1024 ** 2:.0f} MB")
+    return before - after
+
+
+def restore_maps(stereo_dir, num_workers=1, is_cancelled=None, log=print):
+    """Decompress the maps of a stereo workspace for COLMAP, returns False if cancelled"""
+    paths = map_files(stereo_dir, ".bin" + COMPRESSED_SUFFIX)
+    if paths:
+        log(f"Restoring {len(paths)} compressed depth and normal maps")
+    return convert_maps(restore_map_file, paths, num_workers, is_cancelled)
+
+
+def release_dense_intermediates(dense_dir, policy, num_workers=1, is_cancelled=None, log=print):
+    """Compress or remove the stereo inputs of fusion once it succeeded, returns the bytes freed or None"""
+    stereo_dir = os.path.join(dense_dir, "stereo")
+    freed = 0
+    for name in DISCARDED_MAP_DIRS:
+        freed += path_size(os.path.join(stereo_dir, name))
+        shutil.rmtree(os.path.join(stereo_dir, name), ignore_errors=True)
+
+    if policy == "compress":
+        compressed = compress_maps(stereo_dir, num_workers, is_cancelled, log=log)
+        return None if compressed is None else freed + compressed
+
+    # Undistorted images and maps are removed, the point clouds and meshes stay
+    for path in (os.path.join(dense_dir, "images"), *[os.path.join(stereo_dir, name) for name in MAP_DIRS]):
+        freed += path_size(path)
+        shutil.rmtree(path, ignore_errors=True)
+    log(f"Removed the undistorted images and the depth and normal maps, {freed / 1024 ** 2:.0f} MB freed")
+    return freed
+
+
+def format_size(size):
+    """Human readable size"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report and reduce the disk footprint of reconstructions")
+    parser.add_argument("output_dirs", nargs="+", help="Output directories of pipeline runs")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--compress", action="store_true", help="Compress the depth and normal maps")
+    action.add_argument("--discard", action="store_true",
+                        help="Remove the undistorted images and the depth and normal maps")
+    action.add_argument("--restore", action="store_true", help="Decompress the depth and normal maps for COLMAP")
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    for output_dir in args.output_dirs:
+        dense_dir = os.path.join(output_dir, "dense")
+        if args.restore:
+            restore_maps(os.path.join(dense_dir, "stereo"), args.num_workers)
+        elif args.compress or args.discard:
+            release_dense_intermediates(dense_dir, "compress" if args.compress else "discard", args.num_workers)
+        sizes = footprint(output_dir)
+        print(f"{output_dir}: {format_size(sum(sizes.values()))}")
+        for name, size in sorted(sizes.items(), key=lambda item: -item[1]):
+            print(f"  {format_size(size):>10}  {name}")
+
+if __name__ == "__main__":
+    main()
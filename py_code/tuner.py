@@ -0,0 +1,215 @@
+import os
+import json
+import math
+import random
+import shutil
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from add_images import list_image_names
+from benchmark import run_configuration, expand_grid, clear_workspace
+
+DEFAULT_TUNER_SETTINGS = {
+    # Number of candidates evaluated on the first rung
+    "num_candidates": 27,
+    # Fraction of the candidates promoted to the next rung
+    "eta": 3,
+    # Fraction of the images used on the first rung
+    "min_image_fraction": 1.0 / 9,
+    # Image size cap on the first rung, the last rung uses the candidate's own value
+    "min_image_size": 800,
+    "seed": 0,
+}
+
+
+def evenly_spaced(items, count):
+    """Pick count items spread over the whole list, preserving order"""
+    if count >= len(items):
+        return list(items)
+    step = len(items) / count
+    return [items[int(i * step)] for i in range(count)]
+
+
+def make_image_subset(image_dir, subset_dir, fraction):
+    """Materialize an evenly spaced subset of the images, return its size"""
+    names = list_image_names(image_dir)
+    subset = evenly_spaced(names, max(2, int(round(len(names) * fraction))))
+
+    shutil.rmtree(subset_dir, ignore_errors=True)
+    for name in subset:
+        source = os.path.abspath(os.path.join(image_dir, name))
+        destination = os.path.join(subset_dir, name)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        try:
+            os.symlink(source, destination)
+        except (OSError, NotImplementedError):
+            # Symbolic links may need extra privileges on Windows
+            shutil.copy2(source, destination)
+    return len(subset)
+
+
+def quality_score(result, num_images):
+    """Higher is better: registered fraction times track length, penalized by reprojection error"""
+    if not result.get("success") or not result.get("num_reg_images"):
+        return 0.0
+    registered = result["num_reg_images"] / max(num_images, 1)
+    return registered * result["mean_track_length"] / (1.0 + result["mean_reprojection_error"])
+
+
+class SuccessiveHalvingTuner:
+    """Budgeted search over pipeline options, promoting promising candidates to larger image subsets"""
+
+    def __init__(self, image_dir, output_dir, space, base_options=None, settings=None,
+                 time_budget=None, quality_target=None, log=print):
+        self.image_dir = image_dir
+        self.output_dir = output_dir
+        self.space = space
+        self.base_options = dict(base_options or {})
+        self.settings = dict(DEFAULT_TUNER_SETTINGS)
+        if settings:
+            self.settings.update(settings)
+        self.time_budget = time_budget
+        self.quality_target = quality_target
+        self.log = log
+        self.history = []
+
+    def sample_candidates(self):
+        """Random sample of the search grid"""
+        candidates = expand_grid(self.space)
+        random.Random(self.settings["seed"]).shuffle(candidates)
+        return candidates[:self.settings["num_candidates"]]
+
+    def rung_schedule(self, num_candidates):
+        """(image fraction, image size cap) of each rung, ending on the full dataset"""
+        eta = self.settings["eta"]
+        num_rungs = max(1, int(math.ceil(math.log(max(num_candidates, 1), eta))) + 1)
+        schedule = []
+        for rung in range(num_rungs):
+            # Geometric interpolation from the first rung to the full dataset
+            t = rung / (num_rungs - 1) if num_rungs > 1 else 1.0
+            fraction = self.settings["min_image_fraction"] ** (1.0 - t)
+            image_size = None if rung == num_rungs - 1 else int(
+                self.settings["min_image_size"] * (1.0 / self.settings["min_image_fraction"]) ** (t / 2)
+            )
+            schedule.append((fraction, image_size))
+        return schedule
+
+    def rank_key(self, evaluation):
+        """Sort key, best first, according to the time budget or quality target"""
+        quality = evaluation["quality"]
+        projected_time = evaluation["projected_time"]
+
+        if self.quality_target is not None:
+            # Cheapest candidate reaching the target, then the closest to it
+            meets_target = quality >= self.quality_target
+            return (not meets_target, projected_time if meets_target else -quality)
+        if self.time_budget is not None:
+            # Best quality within the budget, then the fastest over it
+            within_budget = projected_time <= self.time_budget
+            return (not within_budget, -quality if within_budget else projected_time)
+        return (0, -quality)
+
+    def evaluate(self, candidate, rung, fraction, image_size, subset_dir, num_images, executor):
+        """Run one candidate on the current rung"""
+        options = dict(self.base_options)
+        options.update(candidate)
+        if image_size is not None:
+            options["max_image_size"] = min(options.get("max_image_size", image_size), image_size)
+
+        index = len(self.history)
+        workspace = os.path.join(self.output_dir, f"run_{index:03d}")
+        shutil.rmtree(workspace, ignore_errors=True)
+        result = executor.submit(run_configuration, subset_dir, workspace, options, index).result()
+
+        # Only the metrics are kept
+        clear_workspace(workspace)
+
+        evaluation = {
+            "rung": rung,
+            "fraction": fraction,
+            "num_images": num_images,
+            "candidate": candidate,
+            "result": result,
+            "quality": quality_score(result, num_images),
+            # Time is linearly extrapolated to the full dataset
+            "projected_time": result["total_time"] / fraction,
+        }
+        self.history.append(evaluation)
+        return evaluation
+
+    def run(self):
+        """Run successive halving, return the recommended option set"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        candidates = self.sample_candidates()
+        schedule = self.rung_schedule(len(candidates))
+        eta = self.settings["eta"]
+        context = multiprocessing.get_context("spawn")
+
+        ranked = []
+        for rung, (fraction, image_size) in enumerate(schedule):
+            subset_dir = os.path.join(self.output_dir, f"images_rung_{rung}")
+            num_images = make_image_subset(self.image_dir, subset_dir, fraction)
+            self.log(f"Rung {rung}: {len(candidates)} candidates on {num_images} images"
+                     f" (max image size {image_size or 'full'})")
+
+            evaluations = []
+            for candidate in candidates:
+                # A fresh process per run keeps memory from accumulating
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    evaluation = self.evaluate(candidate, rung, fraction, image_size, subset_dir, num_images, executor)
+                evaluations.append(evaluation)
+                self.log(f"  {candidate} -> quality {evaluation['quality']:.3f}"
+                         f" in {evaluation['result']['total_time']:.1f} s")
+            shutil.rmtree(subset_dir, ignore_errors=True)
+
+            ranked = sorted(evaluations, key=self.rank_key)
+            self.save()
+
+            num_promoted = max(1, len(candidates) // eta)
+            candidates = [evaluation["candidate"] for evaluation in ranked[:num_promoted]]
+
+        best = ranked[0]
+        recommended = dict(self.base_options)
+        recommended.update(best["candidate"])
+        self.log(f"Recommended options: {recommended} (quality {best['quality']:.3f},"
+                 f" {best['result']['total_time']:.1f} s)")
+        self.save(recommended)
+        return recommended
+
+    def save(self, recommended=None):
+        """Write the search history and the recommendation"""
+        with open(os.path.join(self.output_dir, "tuning_history.json"), "w") as f:
+            json.dump(self.history, f, indent=2)
+        if recommended is not None:
+            with open(os.path.join(self.output_dir, "recommended_options.json"), "w") as f:
+                json.dump(recommended, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune COLMAP settings with successive halving on image subsets")
+    parser.add_argument("image_dir", help="Directory containing the images of the dataset")
+    parser.add_argument("output_dir", help="Directory receiving the runs and the recommendation")
+    parser.add_argument("space", help='JSON file {"base": {option: value}, "grid": {option: [values]}}')
+    parser.add_argument("--time-budget", type=float, help="Maximum reconstruction time on the full dataset, in seconds")
+    parser.add_argument("--quality-target", type=float, help="Minimum quality score to reach as fast as possible")
+    parser.add_argument("--num-candidates", type=int, default=DEFAULT_TUNER_SETTINGS["num_candidates"])
+    parser.add_argument("--eta", type=int, default=DEFAULT_TUNER_SETTINGS["eta"])
+    parser.add_argument("--seed", type=int, default=DEFAULT_TUNER_SETTINGS["seed"])
+    args = parser.parse_args()
+
+    with open(args.space, "r") as f:
+        spec = json.load(f)
+
+    tuner = SuccessiveHalvingTuner(
+        args.image_dir,
+        args.output_dir,
+        spec.get("grid", {}),
+        base_options=spec.get("base"),
+        settings={"num_candidates": args.num_candidates, "eta": args.eta, "seed": args.seed},
+        time_budget=args.time_budget,
+        quality_target=args.quality_target
+    )
+    tuner.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import os
+import cv2
+import numpy as np
+
+KEYFRAME_PREFIX = "frame_"
+
+DEFAULT_KEYFRAME_OPTIONS = {
+    "keyframe_analysis_width": 640,
+    "keyframe_min_sharpness": 50.0,
+    "keyframe_blur_ratio": 0.6,
+    "keyframe_min_motion": 0.05,
+    "keyframe_min_overlap": 0.5,
+    "keyframe_window": 5,
+    "keyframe_jpeg_quality": 95,
+}
+
+
+def sharpness_score(gray):
+    """Variance of the Laplacian, higher means sharper"""
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+class KeyframeSelector:
+    """Streaming keyframe selection based on sharpness and inter-frame motion"""
+
+    def __init__(self, options=None):
+        self.options = dict(DEFAULT_KEYFRAME_OPTIONS)
+        if options:
+            self.options.update({key: options[key] for key in DEFAULT_KEYFRAME_OPTIONS if key in options})
+
+        # State of the last keyframe
+        self.key_gray = None
+        self.key_points = None
+
+        # Running sharpness average used for the relative blur test
+        self.mean_sharpness = None
+
+        # Best candidate of the current selection window
+        self.candidate = None
+        self.window_left = 0
+
+    def analysis_image(self, frame):
+        """Downscale a frame to grayscale for cheap analysis"""
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        width = self.options["keyframe_analysis_width"]
+        if gray.shape[1] > width:
+            height = int(round(gray.shape[0] * width / gray.shape[1]))
+            gray = cv2.resize(gray, (width, height), interpolation=cv2.INTER_AREA)
+        return gray
+
+    def is_blurry(self, sharpness):
+        """Reject frames below the absolute or running sharpness threshold"""
+        if self.mean_sharpness is None:
+            self.mean_sharpness = sharpness
+        else:
+            self.mean_sharpness = 0.9 * self.mean_sharpness + 0.1 * sharpness
+
+        if sharpness < self.options["keyframe_min_sharpness"]:
+            return True
+        return sharpness < self.options["keyframe_blur_ratio"] * self.mean_sharpness
+
+    def motion_from_keyframe(self, gray):
+        """Return (median displacement / diagonal, tracked fraction) relative to the last keyframe"""
+        if self.key_points is None or len(self.key_points) == 0:
+            return 1.0, 0.0
+
+        points, status, _ = cv2.calcOpticalFlowPyrLK(self.key_gray, gray, self.key_points, None)
+        tracked = status.reshape(-1) == 1
+        if not np.any(tracked):
+            return 1.0, 0.0
+
+        displacement = np.linalg.norm((points - self.key_points).reshape(-1, 2)[tracked], axis=1)
+        diagonal = np.hypot(gray.shape[0], gray.shape[1])
+        return float(np.median(displacement) / diagonal), float(np.mean(tracked))
+
+    def set_keyframe(self, gray):
+        """Make a frame the reference for the motion estimate"""
+        self.key_gray = gray
+        self.key_points = cv2.goodFeaturesToTrack(gray, maxCorners=300, qualityLevel=0.01, minDistance=8)
+
+    def push(self, index, frame):
+        """Feed one frame, return the (index, frame) keyframe selected by it, if any"""
+        gray = self.analysis_image(frame)
+        sharpness = sharpness_score(gray)
+        if self.is_blurry(sharpness):
+            return self.tick()
+
+        # The first sharp frame is always a keyframe
+        if self.key_gray is None:
+            self.set_keyframe(gray)
+            return index, frame
+
+        # Keep the sharpest frame of the window opened once enough motion happened
+        if self.candidate is not None:
+            if sharpness > self.candidate[0]:
+                self.candidate = (sharpness, index, frame, gray)
+            return self.tick()
+
+        motion, overlap = self.motion_from_keyframe(gray)
+        if overlap < self.options["keyframe_min_overlap"]:
+            # Tracking is about to be lost, take this frame right away
+            self.set_keyframe(gray)
+            return index, frame
+
+        if motion >= self.options["keyframe_min_motion"]:
+            self.candidate = (sharpness, index, frame, gray)
+            self.window_left = self.options["keyframe_window"]
+            return self.tick()
+        return None
+
+    def tick(self):
+        """Advance the candidate window, emitting the candidate when it closes"""
+        if self.candidate is None:
+            return None
+        self.window_left -= 1
+        if self.window_left > 0:
+            return None
+        return self.flush()
+
+    def flush(self):
+        """Emit the pending candidate, if any"""
+        if self.candidate is None:
+            return None
+        _, index, frame, gray = self.candidate
+        self.candidate = None
+        self.set_keyframe(gray)
+        return index, frame
+
+
+def clear_keyframes(image_dir):
+    """Remove keyframes written by a previous extraction"""
+    if not os.path.isdir(image_dir):
+        return
+    for name in os.listdir(image_dir):
+        if name.startswith(KEYFRAME_PREFIX) and name.endswith(".jpg"):
+            os.remove(os.path.join(image_dir, name))
+
+
+def extract_keyframes(video_path, image_dir, options=None, log=print, is_cancelled=None):
+    """Stream a video and write the selected keyframes into image_dir, return their count"""
+    selector = KeyframeSelector(options)
+    is_cancelled = is_cancelled or (lambda: False)
+    os.makedirs(image_dir, exist_ok=True)
+
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise IOError(f"Could not open video {video_path}")
+
+    quality = [cv2.IMWRITE_JPEG_QUALITY, selector.options["keyframe_jpeg_quality"]]
+
+    def write(keyframe):
+        index, frame = keyframe
+        cv2.imwrite(os.path.join(image_dir, f"{KEYFRAME_PREFIX}{index:06d}.jpg"), frame, quality)
+
+    num_frames = 0
+    num_keyframes = 0
+    try:
+        while not is_cancelled():
+            ok, frame = capture.read()
+            if not ok:
+                break
+            keyframe = selector.push(num_frames, frame)
+            num_frames += 1
+            if keyframe is not None:
+                write(keyframe)
+                num_keyframes += 1
+
+        keyframe = selector.flush()
+        if keyframe is not None:
+            write(keyframe)
+            num_keyframes += 1
+    finally:
+        capture.release()
+
+    log(f"Kept {num_keyframes} keyframes out of {num_frames} frames")
+    return num_keyframes